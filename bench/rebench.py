@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+import click
+import redis
+
+# The benchmark drives the components of this repository, run them from the working tree
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, 'common'), os.path.join(_ROOT, 'frontend', 'refrontend'),
+                os.path.join(_ROOT, 'workers', 'reworker'), os.path.join(_ROOT, 'clients', 'python')]
+
+from requeue.requeue import create_queue
+from reclient.client import ReClient, ReClientException
+
+_FROM_EMAIL = 'rebench@example.org'
+_TO_EMAIL = 'rebench@example.org'
+
+
+class StubBackend(object):
+
+    def __init__(self, latency, error_rate, delivered, latencies):
+        """
+        A worker backend which pretends to send emails.
+
+        :param latency: seconds spent sending each email
+        :param error_rate: fraction of emails rejected (and thereby discarded)
+        :param delivered: shared counter of sent and rejected emails
+        :param latencies: list receiving the end-to-end latency of each email, from submission to sending
+        """
+
+        self._latency = latency
+        self._error_rate = error_rate
+        self._delivered = delivered
+        self._latencies = latencies
+
+    def send(self, **kwargs):
+        from workers.exceptions import WorkerInvalidEmail
+
+        if self._latency > 0:
+            time.sleep(self._latency)
+
+        self._latencies.append(time.time() - float(kwargs['subject'].split()[-1]))
+
+        with self._delivered.get_lock():
+            self._delivered.value += 1
+
+        if random.random() < self._error_rate:
+            raise WorkerInvalidEmail('Rejected by stub backend')
+
+
+def _percentiles(values):
+    """
+    :return: dict of the 50th, 90th and 99th percentile and the maximum of values, in milliseconds
+    """
+
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    return {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99), 'max': values[-1] * 1000}
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+
+    while 1:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise click.ClickException('Nothing is listening on port %s' % port)
+            time.sleep(0.05)
+
+
+def _start_redis():
+    """
+    Start a throwaway redis-server without persistence.
+
+    :return: (process, url)
+    """
+
+    port = _free_port()
+
+    try:
+        process = subprocess.Popen(['redis-server', '--port', str(port), '--bind', '127.0.0.1', '--save', '',
+                                    '--appendonly', 'no'], stdout=open(os.devnull, 'w'))
+    except OSError:
+        raise click.ClickException('redis-server not found, install redis or pass --redis-url')
+
+    _wait_for_port(port)
+    return process, 'redis://127.0.0.1:%s?db=0' % port
+
+
+def _run_frontend(redis_url, partitions, port):
+    settings = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+    settings.write('DEFAULT_FROM_EMAIL = %r\nREDIS_SERVER_URL = %r\nQUEUE_PARTITIONS = %r\n' %
+                   (_FROM_EMAIL, redis_url, partitions))
+    settings.close()
+    os.environ['REFRONTEND_SETTINGS'] = settings.name
+
+    from werkzeug.serving import make_server
+    import refrontend
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # do not log each request
+    make_server('127.0.0.1', port, refrontend.app, threaded=True).serve_forever()
+
+
+def _run_worker(redis_url, partitions, concurrency, batch_size, latency, error_rate, delivered, results, stop):
+    import worker
+
+    latencies = []
+    backends = [StubBackend(latency, error_rate, delivered, latencies) for _ in range(concurrency)]
+
+    worker.run(backends[0] if concurrency == 1 else backends, create_queue([redis_url], partitions),
+               wait_on_empty=1, batch_size=batch_size, stop=stop, backend_name='stub')
+
+    results.put(latencies)
+
+
+def _submit(client, count, body, submit_batch_size, latencies, failures):
+    for offset in range(0, count, submit_batch_size):
+        start = time.time()
+
+        # The subject carries the time of submission, from which the stub backend measures end-to-end latency
+        chunk = [{'subject': 'rebench %.6f' % start, 'body': body, 'to_email': _TO_EMAIL}
+                 for _ in range(min(submit_batch_size, count - offset))]
+
+        if submit_batch_size == 1:
+            try:
+                client.submit(**chunk[0])
+            except ReClientException:
+                failures.append(1)
+        else:
+            failures.extend(1 for result in client.submit_many(chunk) if result is not True)
+
+        latencies.append(time.time() - start)
+
+
+def _redis_stats(connection):
+    commands = dict((name[len('cmdstat_'):], stats['calls'])
+                    for name, stats in connection.info('commandstats').items())
+    return connection.info('stats')['total_commands_processed'], commands
+
+
+@click.command()
+@click.option('--redis-url', default=None,
+              help='Benchmark against this redis (or sqlite:// database) instead of a throwaway redis-server. '
+                   'The email queue in it is reset!')
+@click.option('--partitions', default=1, type=click.IntRange(1, None),
+              help='Number of partitions the email queue is split into.')
+@click.option('--emails', default=10000, type=click.IntRange(1, None), help='Number of emails submitted.')
+@click.option('--body-size', default=100, type=click.IntRange(1, None), help='Size of each email body in bytes.')
+@click.option('--clients', default=4, type=click.IntRange(1, None), help='Number of concurrent submitting clients.')
+@click.option('--submit-batch-size', default=1, type=click.IntRange(1, None),
+              help='Emails submitted per request. Batches larger than 1 use the /batch endpoint.')
+@click.option('--workers', default=2, type=click.IntRange(1, None), help='Number of worker processes.')
+@click.option('--concurrency', default=1, type=click.IntRange(1, None),
+              help='Number of emails sent concurrently by each worker process.')
+@click.option('--batch-size', default=10, type=click.IntRange(1, None),
+              help='Maximum number of emails reserved by a worker at once.')
+@click.option('--send-latency', default=0.0, type=float, help='Milliseconds spent by the stub backend per email.')
+@click.option('--error-rate', default=0.0, type=float,
+              help='Fraction of emails rejected by the stub backend.')
+@click.option('--timeout', default=300, type=click.IntRange(1, None),
+              help='Seconds to wait for all emails to be delivered.')
+@click.option('--output', default='-', type=click.File('w'), help='Write the results as JSON to this file.')
+def cli(redis_url, partitions, emails, body_size, clients, submit_batch_size, workers, concurrency, batch_size,
+        send_latency, error_rate, timeout, output):
+    """
+    Benchmark submitting emails through the web frontend and sending them by workers with a stub backend.
+
+    Reports submit latency, end-to-end delivery throughput and latency, and redis commands per email as JSON.
+    """
+
+    config = dict(partitions=partitions, emails=emails, body_size=body_size, clients=clients,
+                  submit_batch_size=submit_batch_size, workers=workers, concurrency=concurrency,
+                  batch_size=batch_size, send_latency=send_latency, error_rate=error_rate)
+
+    redis_process = None
+    if redis_url is None:
+        redis_process, redis_url = _start_redis()
+
+    processes = []
+
+    try:
+        if not 0 <= error_rate <= 1:
+            raise click.BadParameter('must be between 0 and 1', param_hint='--error-rate')
+
+        create_queue([redis_url], partitions).reset()
+        connection = None if redis_url.startswith('sqlite:') else redis.StrictRedis.from_url(redis_url)
+
+        frontend_port = _free_port()
+        processes.append(multiprocessing.Process(target=_run_frontend, args=(redis_url, partitions, frontend_port)))
+
+        delivered = multiprocessing.Value('l', 0)
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+
+        for _ in range(workers):
+            processes.append(multiprocessing.Process(target=_run_worker, args=(
+                redis_url, partitions, concurrency, batch_size, send_latency / 1000.0, error_rate, delivered,
+                results, stop)))
+
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        _wait_for_port(frontend_port)
+
+        client = ReClient('http://127.0.0.1:%s/' % frontend_port, pool_size=clients, chunk_size=submit_batch_size)
+        body = 'x' * body_size
+
+        submit_latencies = []
+        failures = []
+        threads = []
+
+        commands_before, command_calls_before = _redis_stats(connection) if connection is not None else (0, {})
+        start = time.time()
+
+        for i in range(clients):
+            threads.append(threading.Thread(target=_submit, args=(client, len(range(i, emails, clients)), body,
+                                                                  submit_batch_size, submit_latencies, failures)))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        submitted = time.time()
+        accepted = emails - len(failures)
+
+        while delivered.value < accepted and time.time() - start < timeout:
+            time.sleep(0.01)
+
+        # Wait for the last emails to be acknowledged
+        queue = create_queue([redis_url], partitions)
+        while queue.size_processing() > 0 and time.time() - start < timeout:
+            time.sleep(0.01)
+
+        drained = time.time()
+        commands_after, command_calls_after = _redis_stats(connection) if connection is not None else (0, {})
+
+        stop.set()
+        delivery_latencies = []
+        for _ in range(workers):
+            delivery_latencies.extend(results.get())
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+        if redis_process is not None:
+            redis_process.terminate()
+            redis_process.wait()
+
+    command_calls = dict((name, calls - command_calls_before.get(name, 0))
+                         for name, calls in command_calls_after.items()
+                         if calls != command_calls_before.get(name, 0))
+    scripts = command_calls.get('evalsha', 0) + command_calls.get('eval', 0)
+
+    json.dump({
+        'config': config,
+        'submit': {
+            'requests': len(submit_latencies),
+            'accepted': accepted,
+            'failed': len(failures),
+            'seconds': submitted - start,
+            'emails_per_second': accepted / (submitted - start),
+            'latency_ms': _percentiles(submit_latencies)
+        },
+        'delivery': {
+            'delivered': delivered.value,
+            'complete': delivered.value >= accepted,
+            'seconds': drained - start,
+            'emails_per_second': delivered.value / (drained - start),
+            'latency_ms': _percentiles(delivery_latencies)
+        },
+        'redis': {
+            'commands_per_email': (commands_after - commands_before) / float(max(accepted, 1)),
+            'scripts_per_email': scripts / float(max(accepted, 1)),
+            'commands': command_calls
+        }
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,27 +1,165 @@
 #!/usr/bin/env python
 
+import re
 import click
-from requeue.requeue import DistributedQueue
+import json
+import time
+from requeue.requeue import create_queue
 
 
 @click.group()
-@click.option('--redis-url', default=None, help='Redis cluster used to persist email queue.')
+@click.option('--redis-url', multiple=True,
+              help='Redis cluster used to persist email queue. Repeat if partitions are spread over several instances.')
+@click.option('--partitions', default=1, type=click.IntRange(1, None),
+              help='Number of partitions the email queue is split into.')
 @click.pass_context
-def cli(ctx, redis_url):
-    if redis_url is None:
-        redis_url = 'redis://localhost:6379?db=0'
-
-    ctx.obj = DistributedQueue(redis_url)
+def cli(ctx, redis_url, partitions):
+    ctx.obj = create_queue(list(redis_url) or ['redis://localhost:6379?db=0'], partitions)
 
 
 @cli.command()
 @click.pass_context
 def size(ctx):
     click.echo('Queue: %s' % ctx.obj.size())
+    for priority in ctx.obj.priorities:
+        click.echo('  %s: %s' % (priority, ctx.obj.size(priority)))
     click.echo('Processing: %s' % ctx.obj.size_processing())
+    click.echo('Retrying: %s' % ctx.obj.size_retrying())
     click.echo('Discarded: %s' % ctx.obj.size_discarded())
 
 
+@cli.command()
+@click.option('--batch-size', default=1000, type=click.IntRange(1, None),
+              help='Maximum number of expired emails recovered per round trip to redis.')
+@click.option('--interval', default=None, type=click.IntRange(1, None),
+              help='Keep running, reaping every INTERVAL seconds.')
+@click.pass_context
+def reap(ctx, batch_size, interval):
+    """
+    Move emails with an expired lease (e.g. reserved by a dead worker) back to the queue.
+    Emails due for another attempt are moved back as well (which workers also do while running).
+    """
+
+    while 1:
+        click.echo('Recovered: %s' % ctx.obj.reap(batch_size))
+        click.echo('Promoted: %s' % ctx.obj.promote(batch_size))
+
+        if interval is None:
+            break
+
+        time.sleep(interval)
+
+
+@cli.command()
+@click.option('--batch-size', default=1000, type=click.IntRange(1, None),
+              help='Maximum number of emails moved per round trip to redis.')
+@click.pass_context
+def migrate(ctx, batch_size):
+    """
+    Move emails left in processing by workers of a release storing emails as plain JSON back to the queue.
+    Run once when upgrading from such a release, after stopping its workers and before starting the new workers.
+    """
+
+    click.echo('Migrated: %s' % ctx.obj.migrate(batch_size))
+
+
+@cli.command()
+@click.option('--from', 'source', default='queue', type=click.Choice(['queue', 'processing', 'retrying', 'discard']),
+              help='Queue to export.')
+@click.option('--priority', default=None, help='Only export the queue of this priority lane.')
+@click.option('--chunk-size', default=1000, type=click.IntRange(1, None),
+              help='Maximum number of emails read per round trip to redis.')
+@click.option('--output', default='-', type=click.File('w'), help='Write the emails to this file instead of stdout.')
+@click.pass_context
+def export(ctx, source, priority, chunk_size, output):
+    """
+    Write the emails in a queue as newline delimited JSON (NDJSON), e.g. to inspect stuck or discarded emails.
+    The emails are read in chunks, such that any number of emails is exported in constant memory.
+    """
+
+    if priority is not None and (source != 'queue' or priority not in ctx.obj.priorities):
+        ctx.fail('--priority must be one of %s, and is only supported for --from queue' %
+                 ', '.join(ctx.obj.priorities))
+
+    exported = 0
+    for email in ctx.obj.scan(source, priority, chunk_size):
+        output.write(json.dumps(email) + '\n')
+        exported += 1
+
+    click.echo('Exported: %s' % exported, err=True)
+
+cli.add_command(export, name='dump')
+
+
+@cli.command(name='import')
+@click.argument('ndjson', default='-', type=click.File('r'))
+@click.option('--batch-size', default=1000, type=click.IntRange(1, None),
+              help='Maximum number of emails pushed per round trip to redis.')
+@click.pass_context
+def import_(ctx, ndjson, batch_size):
+    """
+    Push the emails in a newline delimited JSON (NDJSON) file, as written by export, to the queue.
+    The file is read as a stream and pushed in batches, such that any number of emails is imported in constant memory.
+    """
+
+    batch = []
+    imported = 0
+
+    for number, line in enumerate(ndjson, 1):
+        if line.strip() == '':
+            continue
+
+        try:
+            email = json.loads(line)
+        except ValueError:
+            email = None
+
+        if not isinstance(email, dict):
+            raise click.ClickException('Line %s is not a JSON object, imported %s emails' % (number, imported))
+
+        batch.append(email)
+        if len(batch) == batch_size:
+            imported += ctx.obj.push_many(batch)
+            batch = []
+
+    imported += ctx.obj.push_many(batch)
+    click.echo('Imported: %s' % imported)
+
+
+def _parse_filters(ctx, param, values):
+    filters = []
+
+    for value in values:
+        match = re.match(r'^(\w+)([=~])(.*)$', value)
+        if match is None:
+            raise click.BadParameter('expected FIELD=VALUE or FIELD~VALUE, got: %s' % value)
+        filters.append(match.groups())
+
+    return filters
+
+
+@cli.command()
+@click.option('--from', 'source', default='discard', type=click.Choice(['discard', 'processing']),
+              help='Queue to requeue emails from.')
+@click.option('--filter', 'filters', multiple=True, callback=_parse_filters,
+              help='Only requeue emails with FIELD=VALUE (or containing it, FIELD~VALUE), e.g. to_domain=example.org or '
+                   'reason~SendGridClientError. Repeat to require several filters.')
+@click.option('--limit', default=None, type=click.IntRange(1, None), help='Maximum number of emails to requeue.')
+@click.option('--chunk-size', default=1000, type=click.IntRange(1, None),
+              help='Maximum number of emails examined per round trip to redis.')
+@click.pass_context
+def requeue(ctx, source, filters, limit, chunk_size):
+    """
+    Move discarded emails (or emails stuck in processing with an expired lease) back to the queue, e.g. after a
+    misconfigured backend rejected valid emails. Emails are filtered and moved in atomic chunks by redis.
+
+    Fields are the fields of an email (e.g. subject or to_email), to_domain (the domain of the recipient) and reason
+    (why the email was discarded). Emails in processing whose lease has not expired are left to the worker holding them.
+    """
+
+    click.echo('Requeued: %s' % ctx.obj.requeue(source, filters, limit, chunk_size))
+
+
 @cli.command()
 @click.pass_context
 def clear(ctx):
@@ -1,7 +1,10 @@
-
+import errno
+import httplib
+import socket
 import urllib
-import urllib2
+import urlparse
 import json
+import Queue
 
 
 class ReClientException(Exception):
@@ -9,16 +12,108 @@ class ReClientException(Exception):
         super(ReClientException, self).__init__(*args, **kwargs)
 
 
+def _closed_by_peer(ex, sent):
+    """
+    Whether a request on an idle connection failed because the frontend had already closed the connection, i.e.
+    before any byte of the response arrived, such that the frontend never handled the request and it is safe to send
+    it again. A timeout never qualifies, as the frontend may still be handling the request.
+    """
+
+    if isinstance(ex, socket.timeout):
+        return False
+
+    if not sent:
+        return isinstance(ex, socket.error) and ex.errno in (errno.ECONNRESET, errno.EPIPE)
+
+    # No status line at all (a malformed one means the frontend did respond)
+    return isinstance(ex, httplib.BadStatusLine) and (ex.line == repr('') or ex.line.startswith('No status line'))
+
+
 class ReClient(object):
 
-    def __init__(self, server_url):
+    def __init__(self, server_url, pool_size=4, timeout=10, chunk_size=1000):
         """
         :param server_url: url to a reliable-email web frontend
+        :param pool_size: maximum number of idle (keep-alive) connections kept open to the web frontend
+        :param timeout: timeout in seconds for connecting to and waiting on the web frontend
+        :param chunk_size: maximum number of emails sent per request by submit_many
         :return:
         """
         self._url = server_url
+        self._timeout = timeout
+        self._chunk_size = chunk_size
+
+        url = urlparse.urlsplit(server_url)
+        self._connection_class = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+        self._host = url.netloc
+        self._path = url.path or '/'
+        self._batch_path = urlparse.urljoin(self._path if self._path.endswith('/') else self._path + '/', 'batch')
+
+        # Idle connections, shared between threads
+        self._pool = Queue.LifoQueue(pool_size)
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait(), True
+        except Queue.Empty:
+            return self._connection_class(self._host, timeout=self._timeout), False
+
+    def _release_connection(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    def _request(self, path, body, content_type):
+        """
+        POST body to the web frontend, reusing an idle connection if possible.
+
+        :return: (status, data) where data is the decoded JSON response (or None)
+        """
+
+        headers = {'Content-Type': content_type, 'Connection': 'keep-alive'}
+
+        while 1:
+            connection, reused = self._get_connection()
+            sent = False
+
+            try:
+                connection.request('POST', path, body, headers)
+                sent = True
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error), ex:
+                connection.close()
+
+                if reused and _closed_by_peer(ex, sent):
+                    # The frontend closed the idle connection before we used it, retry on a new connection
+                    continue
 
-    def submit(self, subject, body, to_email, to_name='', from_email='', from_name=''):
+                raise ReClientException(str(ex))
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release_connection(connection)
+
+            try:
+                return response.status, json.loads(content)
+            except ValueError:
+                return response.status, None
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+
+        while 1:
+            try:
+                self._pool.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    def submit(self, subject, body, to_email, to_name='', from_email='', from_name='', priority='',
+               idempotency_key=''):
         """
         Submit an email to the reliable-email service.
 
@@ -28,6 +123,9 @@ class ReClient(object):
         :param str to_name: (optional)
         :param str from_email: (optional)
         :param str from_name: (optional)
+        :param str priority: (optional) priority lane, e.g. high, normal or bulk
+        :param str idempotency_key: (optional) unique key of the email, such that the email is only sent once when
+                                    submitted again (e.g. after a timeout) with the same key
         :return: True
         :raises: ReClientException if the email could not be submitted
         """
@@ -38,20 +136,52 @@ class ReClient(object):
             'to': to_email,
             'to_name': to_name,
             'from': from_email,
-            'from_name': from_name
+            'from_name': from_name,
+            'priority': priority,
+            'idempotency_key': idempotency_key
         })
 
-        try:
-            request = urllib2.Request(self._url, data)
-            response = urllib2.urlopen(request)
-        except urllib2.URLError, ex:
-            raise ReClientException(ex.reason)
+        status, data = self._request(self._path, data, 'application/x-www-form-urlencoded')
+
+        if status != 200:
+            raise ReClientException(data.get('error_message', 'Unknown error.') if data else 'Unknown error.')
+
+        return True
+
+    def submit_many(self, emails):
+        """
+        Submit a list of emails to the reliable-email service, in chunks of at most chunk_size emails per request.
+
+        :param list emails: dicts with the keyword arguments accepted by submit (subject, body, to_email, ...)
+        :return: a list with, for each email in order, True if submitted or a ReClientException describing why not
+        """
+
+        results = []
+
+        for offset in range(0, len(emails), self._chunk_size):
+            chunk = emails[offset:offset + self._chunk_size]
+
+            body = json.dumps([{
+                'subject': email.get('subject', ''),
+                'body': email.get('body', ''),
+                'to': email.get('to_email', ''),
+                'to_name': email.get('to_name', ''),
+                'from': email.get('from_email', ''),
+                'from_name': email.get('from_name', ''),
+                'priority': email.get('priority', ''),
+                'idempotency_key': email.get('idempotency_key', '')
+            } for email in chunk])
 
-        if response.getcode() != 200:
             try:
-                data = json.load(response)
-                raise ReClientException(data.message)
-            except:
-                raise ReClientException('Unknown error.')
+                status, data = self._request(self._batch_path, body, 'application/json')
+
+                if status != 200:
+                    raise ReClientException(data.get('error_message', 'Unknown error.') if data else 'Unknown error.')
+            except ReClientException, ex:
+                results.extend([ex] * len(chunk))
+                continue
+
+            for result in data['results']:
+                results.append(True if result['ok'] else ReClientException(result.get('error_message')))
 
-        return True
\ No newline at end of file
+        return results
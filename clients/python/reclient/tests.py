@@ -1,6 +1,7 @@
 
 import unittest
 import os
+import socket
 
 import client
 
@@ -29,6 +30,56 @@ class TestReClient(unittest.TestCase):
     def test_invalid_submit(self):
         self.assertRaises(client.ReClientException, self.client.submit, 'test email', 'body body', '')
 
+    def _count_connects(self):
+        connects = []
+        connection_class = self.client._connection_class
+
+        class CountingConnection(connection_class):
+            def connect(self):
+                connects.append(self)
+                connection_class.connect(self)
+
+        self.client._connection_class = CountingConnection
+        return connects
+
+    def test_connection_reuse(self):
+        connects = self._count_connects()
+
+        for i in range(3):
+            self.assertTrue(self.client.submit('test email', 'body body', 'example@example.org'))
+
+        self.assertEqual(len(connects), 1)
+        self.assertEqual(self.client._pool.qsize(), 1)
+
+    def test_closed_connection_retried(self):
+        connects = self._count_connects()
+        self.assertTrue(self.client.submit('test email', 'body body', 'example@example.org'))
+
+        # The idle connection is closed, as if by the frontend, before it is reused
+        connects[0].sock.shutdown(socket.SHUT_RDWR)
+
+        self.assertTrue(self.client.submit('test email', 'body body', 'example@example.org'))
+        self.assertEqual(len(connects), 2)
+
+    def test_submit_many(self):
+        results = self.client.submit_many([
+            {'subject': 'test email', 'body': 'body body', 'to_email': 'example@example.org'},
+            {'subject': 'test email', 'body': 'body body', 'to_email': ''},
+            {'subject': 'test email', 'body': 'body body', 'to_email': 'example@example.org', 'to_name': 'Jane Doe'}
+        ])
+
+        self.assertEqual(len(results), 3)
+        self.assertTrue(results[0] is True)
+        self.assertTrue(isinstance(results[1], client.ReClientException))
+        self.assertTrue(results[2] is True)
+
+    def test_submit_many_chunks(self):
+        chunked_client = client.ReClient(TEST_SERVICE_URL, chunk_size=2)
+        results = chunked_client.submit_many(
+            [{'subject': 'test email', 'body': 'body body', 'to_email': 'example@example.org'}] * 5)
+
+        self.assertEqual(results, [True] * 5)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
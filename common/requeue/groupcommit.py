@@ -0,0 +1,79 @@
+import time
+import threading
+
+
+class _Pending(object):
+
+    def __init__(self, email):
+        self.email = email
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+
+    def __init__(self, queue, window=0.002, max_batch=1000):
+        """
+        Coalesces pushes of concurrent callers (e.g. requests served by different threads) into a single push_many.
+
+        A background thread waits window seconds after the first pending email, such that concurrent callers can join
+        the batch, and pushes up to max_batch emails at once. push returns once the batch holding its email has been
+        written to redis, and raises the error of the batch otherwise, such that callers keep their durability
+        guarantee.
+        """
+
+        self._queue = queue
+        self._window = window
+        self._max_batch = max_batch
+
+        self._pending = []
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def push(self, email):
+        """
+        Push an email, blocking until it is persisted.
+
+        :raises: the exception raised by the queue when pushing the batch holding the email
+        """
+
+        pending = _Pending(email)
+
+        with self._condition:
+            self._pending.append(pending)
+            self._condition.notify()
+
+        # Wait with a timeout, as waiting without one cannot be interrupted in python 2
+        while not pending.done.wait(60):
+            pass
+
+        if pending.error is not None:
+            raise pending.error
+
+    def _run(self):
+        while 1:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                full = len(self._pending) >= self._max_batch
+
+            if not full and self._window > 0:
+                time.sleep(self._window)
+
+            with self._condition:
+                batch = self._pending[:self._max_batch]
+                del self._pending[:self._max_batch]
+
+            try:
+                self._queue.push_many([pending.email for pending in batch])
+                error = None
+            except Exception, ex:
+                error = ex
+
+            for pending in batch:
+                pending.error = error
+                pending.done.set()
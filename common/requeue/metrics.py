@@ -0,0 +1,275 @@
+import time
+import threading
+import BaseHTTPServer
+
+# Default histogram buckets, in seconds
+_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry(object):
+    """
+    A collection of metrics, exposed in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.expose())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+class _Metric(object):
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames, registry, child):
+        """
+        :param child: callable creating the metric of a single combination of label values
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+
+        self._child = child
+        self._children = {}
+        self._lock = threading.Lock()
+
+        registry.register(self)
+
+    def labels(self, *values):
+        """
+        :return: the metric for the given label values, which should be kept by callers on hot paths
+        """
+
+        values = tuple(values)
+        child = self._children.get(values)
+
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+
+        return child
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Counter(_Metric):
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        super(Counter, self).__init__(name, documentation, labelnames, registry, _CounterChild)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def expose(self):
+        return ['%s%s %r' % (self.name, _format_labels(self._labelnames, values), child.value)
+                for values, child in self._items()]
+
+
+class _GaugeChild(object):
+
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """
+        Report the value returned by function when exposed, instead of the set value.
+        """
+        self._function = function
+
+    @property
+    def value(self):
+        return float(self._function()) if self._function is not None else self._value
+
+
+class Gauge(_Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        super(Gauge, self).__init__(name, documentation, labelnames, registry, _GaugeChild)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def expose(self):
+        return ['%s%s %r' % (self.name, _format_labels(self._labelnames, values), child.value)
+                for values, child in self._items()]
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.time()
+
+    def __exit__(self, *args):
+        self._histogram.observe(time.time() - self._start)
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._sum += value
+            self._count += 1
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def time(self):
+        """
+        :return: context manager observing the time spent in it
+        """
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+
+class Histogram(_Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=_BUCKETS):
+        self._buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, documentation, labelnames, registry,
+                                        lambda: _HistogramChild(self._buckets))
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def expose(self):
+        lines = []
+
+        for values, child in self._items():
+            counts, total, count = child.snapshot()
+
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %s' % (self.name, _format_labels(self._labelnames, values, [('le', bound)]),
+                                                 cumulative))
+
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(self._labelnames, values, [('le', '+Inf')]),
+                                             count))
+            lines.append('%s_sum%s %r' % (self.name, _format_labels(self._labelnames, values), total))
+            lines.append('%s_count%s %s' % (self.name, _format_labels(self._labelnames, values), count))
+
+        return lines
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        output = self.registry.expose()
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, *args):
+        pass  # do not log every scrape to stderr
+
+
+def start_http_server(port, address='', registry=REGISTRY):
+    """
+    Expose the metrics of registry over HTTP on the given port, from a background thread.
+
+    :return: the server
+    """
+
+    class MetricsHandler(_MetricsHandler):
+        pass
+
+    MetricsHandler.registry = registry
+
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
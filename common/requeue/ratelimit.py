@@ -0,0 +1,70 @@
+import redis
+import time
+
+from requeue import connection_timeout_decorator
+
+# Generic cell rate algorithm (GCRA). The key holds the theoretical arrival time (TAT) in microseconds, i.e. the time
+# at which the bucket is empty again. Each call reserves n slots and returns how long the caller must wait before
+# using them, such that callers sharing the key are paced to the given rate. Redis time is used, such that the
+# clocks of the callers do not matter.
+_ACQUIRE_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+
+local tat = tonumber(redis.call('GET', KEYS[1]))
+if not tat or tat < now then
+    tat = now
+end
+
+tat = tat + interval * tonumber(ARGV[3])
+redis.call('SET', KEYS[1], string.format('%d', tat), 'PX', math.ceil((tat - now) / 1000) + 1)
+
+return math.max(0, tat - tolerance - now)
+"""
+
+
+class RateLimiter(object):
+
+    def __init__(self, redis_url, name, rate, burst=1, namespace='reliableemail'):
+        """
+        A rate limiter shared by all processes using the same redis, namespace and name.
+
+        Accepts the connection_timeout parameters of DistributedQueue.
+
+        :param name: name of the limited resource, e.g. the backend
+        :param rate: maximum number of acquisitions per second
+        :param burst: number of acquisitions allowed at once after a period of inactivity
+        """
+
+        self._redis = redis.StrictRedis.from_url(redis_url)
+        self._key = namespace + ".ratelimit." + name
+
+        self.burst = burst
+
+        self._interval = int(1000000 / float(rate))  # microseconds between each acquisition
+        self._tolerance = self._interval * burst
+
+        self._acquire_script = self._redis.register_script(_ACQUIRE_SCRIPT)
+
+    @connection_timeout_decorator()
+    def acquire(self, n=1):
+        """
+        Acquire n slots, blocking until the slots may be used. Only acquire more than burst slots at once if the
+        slots are used evenly, as the rate is exceeded when they are used at once.
+
+        :return: the number of seconds waited
+        """
+
+        delay = self._acquire_script(keys=[self._key], args=[self._interval, self._tolerance, n]) / 1000000.0
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return delay
+
+    @connection_timeout_decorator()
+    def reset(self):
+        self._redis.delete(self._key)
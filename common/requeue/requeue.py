@@ -2,6 +2,17 @@
 import redis
 import json
 import time
+import math
+import zlib
+import hashlib
+import random
+
+from metrics import Counter
+
+RETRIES = Counter('reliableemail_connection_retries_total',
+                  'Calls retried by connection_timeout_decorator after a connection error', ['operation'])
+DUPLICATES = Counter('reliableemail_duplicates_total',
+                     'Emails dropped for carrying the idempotency key of an earlier email', ['stage'])
 
 
 class DistributedQueueEmpty(Exception):
@@ -16,6 +27,8 @@ class DistributedQueueException(Exception):
 
 def connection_timeout_decorator(ex_class=redis.ConnectionError):
     def decorator(func):
+        retries = RETRIES.labels(func.__name__)
+
         def wrapper(*args, **kwargs):
             connection_timeout = kwargs.pop('connection_timeout', None)
             connection_timeout_interval = kwargs.pop('connection_timeout_interval', 5)
@@ -26,6 +39,7 @@ def connection_timeout_decorator(ex_class=redis.ConnectionError):
                     try:
                         return func(*args, **kwargs)
                     except ex_class:
+                        retries.inc()
                         time.sleep(connection_timeout_interval)
 
             return func(*args, **kwargs)            
@@ -34,9 +48,475 @@ def connection_timeout_decorator(ex_class=redis.ConnectionError):
     return decorator
 
 
+# Upper bound on the number of pending wakeup signals, see push and reserve
+_MAX_SIGNALS = 1000
+
+# Bodies of at least this many bytes are stored compressed and content addressed, see push
+_BODY_THRESHOLD = 1024
+
+# Version prefixes of stored bodies
+_BODY_RAW = '\x01'
+_BODY_ZLIB = '\x02'
+
+# Priority lanes (name, weight) in order of priority. Under backlog, lanes are served in proportion to their weights.
+_LANES = (('high', 16), ('normal', 4), ('bulk', 1))
+_DEFAULT_LANE = 'normal'
+
+# Emails failing temporarily are retried after an exponential backoff (in seconds), see retry_many
+_RETRY_BASE_DELAY = 30
+_RETRY_MAX_DELAY = 3600
+_RETRY_MAX_ATTEMPTS = 10
+
+# Idempotency keys are remembered for between one and two windows (in seconds), see push
+_IDEMPOTENCY_WINDOW = 3600
+
+# Seconds a blocking reserve of a partitioned queue waits on each redis instance in turn, see PartitionedQueue.reserve
+_WAIT_SLICE = 1
+
+# KEYS holds the fixed keys, the current and previous bucket of submitted idempotency keys, followed by the lane
+# queues. ARGV holds the maximum number of signals, the default lane and the expiry time of the current bucket followed
+# by (payload, lane, body hash, body, idempotency key) quintuples. The body hash and body are empty strings if the body
+# is stored in the payload, and the body is only passed once per call. Stored bodies are reference counted by the
+# emails using them. Emails with an idempotency key found in either bucket are dropped.
+_PUSH_MANY_SCRIPT = """
+local accepted, bodies, keyed = {}, {}, false
+for i = 0, (#ARGV - 3) / 5 - 1 do
+    local key = ARGV[5 * i + 8]
+    if ARGV[5 * i + 7] ~= '' then
+        bodies[ARGV[5 * i + 6]] = ARGV[5 * i + 7]
+    end
+    if key == '' then
+        accepted[#accepted + 1] = i
+    elseif redis.call('SISMEMBER', KEYS[10], key) == 0 and redis.call('SADD', KEYS[9], key) == 1 then
+        accepted[#accepted + 1] = i
+        keyed = true
+    end
+end
+if keyed then
+    redis.call('EXPIREAT', KEYS[9], ARGV[3])
+end
+
+local n = #accepted
+if n == 0 then
+    return 0
+end
+local first = redis.call('INCRBY', KEYS[1], n) - n + 1
+for j, i in ipairs(accepted) do
+    local id = first + j - 1
+    local lane = tonumber(ARGV[5 * i + 5])
+    local hash = ARGV[5 * i + 6]
+    local key = ARGV[5 * i + 8]
+    redis.call('HSET', KEYS[2], id, ARGV[5 * i + 4])
+    if hash ~= '' then
+        if bodies[hash] then
+            redis.call('HSETNX', KEYS[4], hash, bodies[hash])
+            bodies[hash] = nil
+        end
+        redis.call('HINCRBY', KEYS[5], hash, 1)
+        redis.call('HSET', KEYS[6], id, hash)
+    end
+    if lane ~= tonumber(ARGV[2]) then
+        redis.call('HSET', KEYS[7], id, lane)
+    end
+    if key ~= '' then
+        redis.call('HSET', KEYS[8], id, key)
+    end
+    redis.call('LPUSH', KEYS[10 + lane], id)
+end
+for i = 1, math.min(n, tonumber(ARGV[1])) do
+    redis.call('LPUSH', KEYS[3], 1)
+end
+redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[1]) - 1)
+return n
+"""
+
+# Tokens are the id of an email and its generation, the number of times it was reserved. A token is only accepted while
+# the email is still reserved by that reservation, such that a worker whose lease expired can not acknowledge the email
+# once it was reaped and reserved by another worker.
+_TOKEN_LUA = """
+local function release(token, processing, leases, generations)
+    local id, generation = string.match(token, '^(.+):(%d+)$')
+    if id and redis.call('HGET', generations, id) == generation and redis.call('SREM', processing, id) == 1 then
+        redis.call('ZREM', leases, id)
+        return id
+    end
+end
+"""
+
+# Lanes are picked by smooth weighted round robin over the non-empty lanes. The scheduling state is kept in redis,
+# such that lanes are served fairly across all workers. KEYS holds the fixed keys, the current and previous bucket of
+# sent idempotency keys, followed by the lane queues. Each email is returned with a flag telling whether an email with
+# its idempotency key was already sent. Emails queued as plain JSON by releases before ids were introduced are given
+# an id when reserved. The processing set was a list of such emails, which is moved back to the queue by migrate.
+_RESERVE_MANY_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok == 'list' then
+    return redis.error_reply('Processing holds emails reserved by a previous release, run recli migrate')
+end
+
+local lanes = #KEYS - 12
+local fields = {}
+for l = 1, lanes do
+    fields[l] = l
+end
+local state = redis.call('HMGET', KEYS[7], unpack(fields))
+
+local weights, current, sizes = {}, {}, {}
+for l = 1, lanes do
+    weights[l] = tonumber(ARGV[2 + l])
+    current[l] = tonumber(state[l]) or 0
+    sizes[l] = redis.call('LLEN', KEYS[12 + l])
+end
+
+local items = {}
+for i = 1, tonumber(ARGV[1]) do
+    local total, lane = 0, nil
+    for l = 1, lanes do
+        if sizes[l] > 0 then
+            current[l] = current[l] + weights[l]
+            total = total + weights[l]
+            if not lane or current[l] > current[lane] then
+                lane = l
+            end
+        end
+    end
+    if not lane then
+        break
+    end
+    current[lane] = current[lane] - total
+    sizes[lane] = sizes[lane] - 1
+
+    local id = redis.call('RPOP', KEYS[12 + lane])
+    if string.sub(id, 1, 1) == '{' then
+        local payload = id
+        id = tostring(redis.call('INCR', KEYS[9]))
+        redis.call('HSET', KEYS[2], id, payload)
+    end
+    redis.call('SADD', KEYS[1], id)
+    redis.call('ZADD', KEYS[4], ARGV[2], id)
+    items[#items + 1] = id .. ':' .. redis.call('HINCRBY', KEYS[10], id, 1)
+    items[#items + 1] = redis.call('HGET', KEYS[2], id)
+    local hash = redis.call('HGET', KEYS[6], id)
+    items[#items + 1] = hash and redis.call('HGET', KEYS[5], hash) or ''
+    local key = redis.call('HGET', KEYS[8], id)
+    local sent = key and (redis.call('SISMEMBER', KEYS[11], key) == 1 or redis.call('SISMEMBER', KEYS[12], key) == 1)
+    items[#items + 1] = sent and 1 or 0
+end
+
+local empty = true
+for l = 1, lanes do
+    fields[2 * l - 1] = l
+    fields[2 * l] = current[l]
+    empty = empty and sizes[l] == 0
+end
+-- The state only changes when an email is reserved, such that polling an empty queue writes nothing
+if #items > 0 then
+    redis.call('HMSET', KEYS[7], unpack(fields))
+end
+if empty then
+    redis.call('DEL', KEYS[3])
+end
+return items
+"""
+
+# KEYS holds the fixed keys followed by the current bucket of sent idempotency keys, and ARGV holds the expiry time of
+# the bucket followed by the tokens. The idempotency key of an email is marked as sent even if its lease expired, such
+# that a reaped copy of the email is not sent again.
+_COMPLETE_MANY_SCRIPT = _TOKEN_LUA + """
+local removed, keyed = 0, false
+for i = 2, #ARGV do
+    local key = redis.call('HGET', KEYS[9], string.match(ARGV[i], '^(.*):') or '')
+    if key then
+        redis.call('SADD', KEYS[11], key)
+        keyed = true
+    end
+    local id = release(ARGV[i], KEYS[1], KEYS[3], KEYS[10])
+    if id then
+        redis.call('HDEL', KEYS[2], id)
+        redis.call('HDEL', KEYS[7], id)
+        redis.call('HDEL', KEYS[8], id)
+        redis.call('HDEL', KEYS[9], id)
+        redis.call('HDEL', KEYS[10], id)
+        local hash = redis.call('HGET', KEYS[6], id)
+        if hash then
+            redis.call('HDEL', KEYS[6], id)
+            if redis.call('HINCRBY', KEYS[5], hash, -1) <= 0 then
+                redis.call('HDEL', KEYS[5], hash)
+                redis.call('HDEL', KEYS[4], hash)
+            end
+        end
+        removed = removed + 1
+    end
+end
+if keyed then
+    redis.call('EXPIREAT', KEYS[11], ARGV[1])
+end
+return removed
+"""
+
+# ARGV holds (token, reason) pairs, where the reason is the empty string if not given
+_DISCARD_MANY_SCRIPT = _TOKEN_LUA + """
+local moved = 0
+for i = 1, #ARGV, 2 do
+    local id = release(ARGV[i], KEYS[1], KEYS[3], KEYS[6])
+    if id then
+        redis.call('HDEL', KEYS[4], id)
+        if ARGV[i + 1] ~= '' then
+            redis.call('HSET', KEYS[5], id, ARGV[i + 1])
+        end
+        redis.call('LPUSH', KEYS[2], id)
+        moved = moved + 1
+    end
+end
+return moved
+"""
+
+# ARGV holds the time, the base and maximum delay and the maximum number of attempts, followed by (token, jitter) pairs
+# where jitter is a random number in [0, 1). The delay doubles with each failed attempt, and half of it is jittered
+# such that emails failing together are not retried together.
+_RETRY_MANY_SCRIPT = _TOKEN_LUA + """
+local retried, discarded = 0, 0
+for i = 5, #ARGV, 2 do
+    local id = release(ARGV[i], KEYS[1], KEYS[2], KEYS[7])
+    if id then
+        local attempts = redis.call('HINCRBY', KEYS[4], id, 1)
+        if attempts >= tonumber(ARGV[4]) then
+            redis.call('HDEL', KEYS[4], id)
+            redis.call('HSET', KEYS[6], id, 'Too many attempts')
+            redis.call('LPUSH', KEYS[5], id)
+            discarded = discarded + 1
+        else
+            local delay = math.min(tonumber(ARGV[3]), tonumber(ARGV[2]) * 2 ^ (attempts - 1))
+            delay = delay / 2 + delay / 2 * tonumber(ARGV[i + 1])
+            redis.call('ZADD', KEYS[3], tonumber(ARGV[1]) + delay, id)
+            retried = retried + 1
+        end
+    end
+end
+return {retried, discarded}
+"""
+
+_PROMOTE_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for i, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    local lane = tonumber(redis.call('HGET', KEYS[3], id)) or tonumber(ARGV[4])
+    redis.call('RPUSH', KEYS[3 + lane], id)
+    redis.call('LPUSH', KEYS[2], 1)
+end
+if #ids > 0 then
+    redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[3]) - 1)
+end
+return #ids
+"""
+
+# Functions shared by the requeue scripts. KEYS holds the source of the emails, the leases, payloads, discard reasons,
+# attempts, signals and email lanes followed by the lane queues. ARGV holds the maximum number of emails moved, the
+# maximum number of signals, the default lane, the number of emails examined, the number of emails skipped and the
+# current time, followed by (field, operator, value) filter triples. Emails are compared case insensitively, either for equality ('=') or
+# containing the value ('~'). The payload of an email is only decoded if a filter needs it. Emails discarded by releases
+# before ids were introduced are plain JSON instead of an id, and are given an id once requeued and reserved.
+_REQUEUE_LUA = """
+local function payload(id)
+    if string.sub(id, 1, 1) == '{' then
+        return id
+    end
+    return redis.call('HGET', KEYS[3], id) or '{}'
+end
+
+local function matches(id)
+    local email
+    for i = 7, #ARGV, 3 do
+        local field, value, actual = ARGV[i], string.lower(ARGV[i + 2]), nil
+        if field == 'reason' then
+            actual = redis.call('HGET', KEYS[4], id)
+        else
+            email = email or cjson.decode(payload(id))
+            if field == 'to_domain' then
+                actual = type(email.to_email) == 'string' and string.match(email.to_email, '@([^@]*)$')
+            else
+                actual = email[field]
+            end
+        end
+        if type(actual) ~= 'string' then
+            return false
+        end
+        actual = string.lower(actual)
+        if ARGV[i + 1] == '=' and actual ~= value then
+            return false
+        end
+        if ARGV[i + 1] == '~' and not string.find(actual, value, 1, true) then
+            return false
+        end
+    end
+    return true
+end
+
+local function requeue(id)
+    redis.call('HDEL', KEYS[4], id)
+    redis.call('HDEL', KEYS[5], id)
+    local lane = tonumber(redis.call('HGET', KEYS[7], id)) or tonumber(ARGV[3])
+    redis.call('LPUSH', KEYS[7 + lane], id)
+    redis.call('LPUSH', KEYS[6], 1)
+end
+"""
+
+# Examines emails from the tail of the discard list, requeueing matching emails and rotating the others to the head,
+# such that a pass over the emails discarded before the first call examines each email once
+_REQUEUE_DISCARDED_SCRIPT = _REQUEUE_LUA + """
+local examined, moved = 0, 0
+while examined < tonumber(ARGV[4]) and moved < tonumber(ARGV[1]) do
+    local id = redis.call('RPOP', KEYS[1])
+    if not id then
+        break
+    end
+    examined = examined + 1
+    if matches(id) then
+        requeue(id)
+        moved = moved + 1
+    else
+        redis.call('LPUSH', KEYS[1], id)
+    end
+end
+redis.call('LTRIM', KEYS[6], 0, tonumber(ARGV[2]) - 1)
+return {examined, moved}
+"""
+
+# Examines the emails in processing with an expired lease (like reap), skipping those examined before (which did not
+# match, as matching emails were moved), such that emails still held by a worker are never requeued
+_REQUEUE_PROCESSING_SCRIPT = _REQUEUE_LUA + """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[6], 'LIMIT', ARGV[5], ARGV[4])
+local skipped, moved = tonumber(ARGV[5]), 0
+for i, id in ipairs(ids) do
+    if moved >= tonumber(ARGV[1]) then
+        break
+    end
+    if matches(id) and redis.call('SREM', KEYS[1], id) == 1 then
+        redis.call('ZREM', KEYS[2], id)
+        requeue(id)
+        moved = moved + 1
+    else
+        skipped = skipped + 1
+    end
+end
+redis.call('LTRIM', KEYS[6], 0, tonumber(ARGV[2]) - 1)
+return {#ids, skipped, moved}
+"""
+
+# Emails queued or discarded by releases before ids were introduced are plain JSON instead of an id
+_FETCH_SCRIPT = """
+local items = {}
+for i, id in ipairs(ARGV) do
+    if string.sub(id, 1, 1) == '{' then
+        items[#items + 1] = id
+        items[#items + 1] = ''
+    else
+        local payload = redis.call('HGET', KEYS[1], id)
+        if payload then
+            local hash = redis.call('HGET', KEYS[3], id)
+            items[#items + 1] = payload
+            items[#items + 1] = hash and redis.call('HGET', KEYS[2], hash) or ''
+        end
+    end
+end
+return items
+"""
+
+_EXTEND_LEASE_SCRIPT = """
+local id, generation = string.match(ARGV[1], '^(.+):(%d+)$')
+if id and redis.call('HGET', KEYS[2], id) == generation and redis.call('ZSCORE', KEYS[1], id) then
+    redis.call('ZADD', KEYS[1], ARGV[2], id)
+    return 1
+end
+return 0
+"""
+
+# Moves emails left in the processing list of a release before ids were introduced (whose workers must have been
+# stopped) back to the default lane as plain JSON, which reserve gives an id
+_MIGRATE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then
+    return 0
+end
+local moved = 0
+while moved < tonumber(ARGV[1]) do
+    local payload = redis.call('RPOP', KEYS[1])
+    if not payload then
+        break
+    end
+    redis.call('RPUSH', KEYS[3], payload)
+    redis.call('LPUSH', KEYS[2], 1)
+    moved = moved + 1
+end
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[2]) - 1)
+return moved
+"""
+
+_REAP_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local recovered = 0
+for i, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    if redis.call('SREM', KEYS[2], id) == 1 then
+        local lane = tonumber(redis.call('HGET', KEYS[4], id)) or tonumber(ARGV[4])
+        redis.call('RPUSH', KEYS[4 + lane], id)
+        redis.call('LPUSH', KEYS[3], 1)
+        recovered = recovered + 1
+    end
+end
+redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[3]) - 1)
+return {#ids, recovered}
+"""
+
+
+def _encode_body(body):
+    """
+    :return: (hash, encoded body) of a body to be stored separately from its email
+    """
+
+    data = body.encode('utf-8') if isinstance(body, unicode) else body
+    compressed = zlib.compress(data)
+
+    if len(compressed) < len(data):
+        return hashlib.sha1(data).hexdigest(), _BODY_ZLIB + compressed
+
+    return hashlib.sha1(data).hexdigest(), _BODY_RAW + data
+
+
+def _digest_key(key):
+    """
+    :return: a short digest of an idempotency key, such that remembering a key costs the same no matter its length
+    """
+
+    data = key.encode('utf-8') if isinstance(key, unicode) else key
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def _decode_body(encoded):
+    version, data = encoded[:1], encoded[1:]
+
+    if version == _BODY_ZLIB:
+        data = zlib.decompress(data)
+    elif version != _BODY_RAW:
+        raise DistributedQueueException("Unknown body encoding")
+
+    return data.decode('utf-8')
+
+
+def _decode_email(payload, body):
+    """
+    :return: the email stored as payload, and body if the body is stored separately (otherwise the empty string)
+    """
+
+    email = json.loads(payload)
+    if body:
+        email['body'] = _decode_body(body)
+
+    return email
+
+
 class DistributedQueue(object):
 
-    def __init__(self, redis_url, namespace='reliableemail'):
+    def __init__(self, redis_url, namespace='reliableemail', lease_timeout=600, body_threshold=_BODY_THRESHOLD,
+                 lanes=_LANES, default_lane=_DEFAULT_LANE, idempotency_window=_IDEMPOTENCY_WINDOW, socket_timeout=None):
         """
         A persistent and reliable queue backed by redis.
 
@@ -44,10 +524,54 @@ class DistributedQueue(object):
         connection_timeout: time in seconds a call blocks if no connection can be made to redis, supply 0 for no limit (default None, no timeout)
         connection_timeout_interval: the number of seconds to wait between each retry (default 5 seconds)
 
+        Each email is assigned a compact id, and its payload is stored once in a hash. The queues only
+        contain ids, such that reserving, completing and discarding an email are O(1) operations.
+
+        Reserved emails are leased for lease_timeout seconds. Emails with an expired lease (e.g. because the worker
+        died) are moved back to the queue by reap. Each reservation of an email has a token of its own, which is
+        rejected once the lease expired and the email was reaped, such that a worker which lost the lease can not
+        acknowledge the email on behalf of the worker holding it now.
+
+        Bodies of at least body_threshold bytes are compressed and stored once per distinct body (identified by
+        its hash) no matter how many emails use it. Supply None to always store bodies in the email's payload.
+
+        Emails are queued in priority lanes, given as a list of (name, weight) and selected by the email's 'priority'
+        (default_lane if not given). When several lanes hold emails, then the lanes are served in proportion to their
+        weights, such that emails in a high priority lane are not stuck behind a backlog in a low priority lane.
+
+        Emails may carry an 'idempotency_key'. An email is dropped when pushed if an email with the same key was pushed
+        before, and completed without being sent when reserved if an email with the same key was sent before. Keys are
+        remembered in sets rotated every idempotency_window seconds, such that a key is remembered for between one and
+        two windows, and memory only depends on the number of keys used within the last two windows.
+
+        Calls to redis raise redis.TimeoutError once they take longer than socket_timeout seconds (default: no limit),
+        which must then exceed the timeout of blocking reserves.
+
         """
 
-        self._redis = redis.StrictRedis.from_url(redis_url)  # According to docs redis is thread safe
+        # According to docs redis is thread safe
+        self._redis = redis.StrictRedis.from_url(redis_url, socket_timeout=socket_timeout)
+        self._lanes = [name for name, weight in lanes]
+        self._weights = [weight for name, weight in lanes]
+        self._default_lane = self._lanes.index(default_lane)
         self.namespace = namespace
+        self.lease_timeout = lease_timeout
+        self.body_threshold = body_threshold
+        self.idempotency_window = int(idempotency_window)
+
+        # Operations are implemented as lua scripts, such that each call is atomic and costs one round trip
+        self._push_many_script = self._redis.register_script(_PUSH_MANY_SCRIPT)
+        self._reserve_many_script = self._redis.register_script(_RESERVE_MANY_SCRIPT)
+        self._complete_many_script = self._redis.register_script(_COMPLETE_MANY_SCRIPT)
+        self._discard_many_script = self._redis.register_script(_DISCARD_MANY_SCRIPT)
+        self._extend_lease_script = self._redis.register_script(_EXTEND_LEASE_SCRIPT)
+        self._reap_script = self._redis.register_script(_REAP_SCRIPT)
+        self._retry_many_script = self._redis.register_script(_RETRY_MANY_SCRIPT)
+        self._promote_script = self._redis.register_script(_PROMOTE_SCRIPT)
+        self._fetch_script = self._redis.register_script(_FETCH_SCRIPT)
+        self._requeue_discarded_script = self._redis.register_script(_REQUEUE_DISCARDED_SCRIPT)
+        self._requeue_processing_script = self._redis.register_script(_REQUEUE_PROCESSING_SCRIPT)
+        self._migrate_script = self._redis.register_script(_MIGRATE_SCRIPT)
 
     @property
     def namespace(self):
@@ -56,16 +580,171 @@ class DistributedQueue(object):
     @namespace.setter
     def namespace(self, value):
         self._namespace = value
-        self._key_queue = value + ".queue"
-        self._key_processing = value + ".processing"
-        self._key_discard = value + ".discard"
+        self._key_queue = value + ".queue"  # list of ids in the default lane
+        self._key_lanes = [self._key_queue if i == self._default_lane else self._key_queue + "." + name
+                           for i, name in enumerate(self._lanes)]  # list of ids per lane
+        self._key_processing = value + ".processing"  # set of ids
+        self._key_leases = value + ".leases"  # sorted set of ids scored by lease deadline
+        self._key_discard = value + ".discard"  # list of ids
+        self._key_reasons = value + ".reasons"  # hash of id -> reason, for discarded emails
+        self._key_payloads = value + ".payloads"  # hash of id -> serialized email
+        self._key_bodies = value + ".bodies"  # hash of body hash -> encoded body
+        self._key_body_counts = value + ".bodycounts"  # hash of body hash -> number of emails using the body
+        self._key_body_refs = value + ".bodyrefs"  # hash of id -> body hash, for emails with a stored body
+        self._key_email_lanes = value + ".lanes"  # hash of id -> lane, for emails not in the default lane
+        self._key_lane_state = value + ".lanestate"  # hash of lane -> scheduling state
+        self._key_ids = value + ".ids"  # id counter
+        self._key_signal = value + ".signal"  # wakeup signals for blocked workers
+        self._key_retries = value + ".retries"  # sorted set of ids scored by the time of their next attempt
+        self._key_attempts = value + ".attempts"  # hash of id -> number of failed attempts
+        self._key_idempotency_keys = value + ".idemkeys"  # hash of id -> idempotency key digest, for emails with a key
+        self._key_generations = value + ".generations"  # hash of id -> number of times reserved, for reserved emails
+        self._key_submitted = value + ".submitted"  # prefix of sets of idempotency keys pushed, per time bucket
+        self._key_sent = value + ".sent"  # prefix of sets of idempotency keys sent, per time bucket
+
+        # Keys passed to each script, push and reserve are passed the idempotency buckets before the lanes
+        self._keys_push = [self._key_ids, self._key_payloads, self._key_signal, self._key_bodies,
+                           self._key_body_counts, self._key_body_refs, self._key_email_lanes,
+                           self._key_idempotency_keys]
+        self._keys_reserve = [self._key_processing, self._key_payloads, self._key_signal, self._key_leases,
+                              self._key_bodies, self._key_body_refs, self._key_lane_state, self._key_idempotency_keys,
+                              self._key_ids, self._key_generations]
+        self._keys_complete = [self._key_processing, self._key_payloads, self._key_leases, self._key_bodies,
+                               self._key_body_counts, self._key_body_refs, self._key_email_lanes, self._key_attempts,
+                               self._key_idempotency_keys, self._key_generations]
+        self._keys_discard = [self._key_processing, self._key_discard, self._key_leases, self._key_attempts,
+                              self._key_reasons, self._key_generations]
+        self._keys_reap = [self._key_leases, self._key_processing, self._key_signal,
+                           self._key_email_lanes] + self._key_lanes
+        self._keys_retry = [self._key_processing, self._key_leases, self._key_retries, self._key_attempts,
+                            self._key_discard, self._key_reasons, self._key_generations]
+        self._keys_promote = [self._key_retries, self._key_signal, self._key_email_lanes] + self._key_lanes
+        self._keys_requeue = [self._key_leases, self._key_payloads, self._key_reasons, self._key_attempts,
+                              self._key_signal, self._key_email_lanes] + self._key_lanes  # after the source
+
+    @property
+    def priorities(self):
+        """
+        Names of the priority lanes, highest priority first
+        """
+        return list(self._lanes)
+
+    def _lane(self, priority):
+        """
+        :return: index of the lane for the given priority (None for the default lane)
+        """
+
+        if priority is None:
+            return self._default_lane
+
+        try:
+            return self._lanes.index(priority)
+        except ValueError:
+            raise DistributedQueueException("Unknown priority: %s" % priority)
+
+    def _idempotency_buckets(self, key):
+        """
+        :return: (keys of the current and previous bucket of the given sets, expiry time of the current bucket)
+        """
+
+        bucket = int(time.time()) // self.idempotency_window
+        return ['%s.%s' % (key, bucket), '%s.%s' % (key, bucket - 1)], (bucket + 2) * self.idempotency_window
+
+    def _push_many(self, emails):
+        buckets, expire_at = self._idempotency_buckets(self._key_submitted)
+        args = [_MAX_SIGNALS, self._default_lane + 1, expire_at]
+        stored = set()  # hashes of bodies already passed in this call
+
+        for email in emails:
+            body = email.get('body', None)
+            lane = self._lane(email.get('priority', None)) + 1
+            key = email.get('idempotency_key', None)
+
+            envelope = dict(email)
+            envelope.pop('idempotency_key', None)
+            key = _digest_key(key) if key is not None else ''
+
+            if self.body_threshold is None or body is None or len(body) < self.body_threshold:
+                args.extend([json.dumps(envelope), lane, '', '', key])
+                continue
+
+            digest, encoded = _encode_body(body)
+            del envelope['body']
+
+            args.extend([json.dumps(envelope), lane, digest, encoded if digest not in stored else '', key])
+            stored.add(digest)
+
+        pushed = self._push_many_script(keys=self._keys_push + buckets + self._key_lanes, args=args)
+
+        if pushed < len(emails):
+            DUPLICATES.labels('push').inc(len(emails) - pushed)
+
+        return pushed
 
     @connection_timeout_decorator()
     def push(self, email):
-        self._redis.lpush(self._key_queue, json.dumps(email))
+        """
+        Push an email to the lane given by its (optional) 'priority'.
+
+        :return: True, or False if the email was dropped as a duplicate (see 'idempotency_key')
+        """
+
+        return self._push_many([email]) == 1
+
+    @connection_timeout_decorator()
+    def push_many(self, emails):
+        """
+        Push a list of emails in a single (atomic) round trip.
+
+        :return: the number of emails pushed, excluding emails dropped as duplicates (see 'idempotency_key')
+        """
+
+        if not emails:
+            return 0
+
+        return self._push_many(emails)
+
+    def _reserve_many(self, n):
+        while 1:
+            buckets, _ = self._idempotency_buckets(self._key_sent)
+            data = self._reserve_many_script(keys=self._keys_reserve + buckets + self._key_lanes,
+                                             args=[n, time.time() + self.lease_timeout] + self._weights)
+
+            reserved = []
+            duplicates = []
+
+            for i in range(0, len(data), 4):
+                if data[i + 3] == 1:
+                    duplicates.append(data[i])
+                else:
+                    reserved.append((_decode_email(data[i + 1], data[i + 2]), data[i]))
+
+            if not duplicates:
+                return reserved
+
+            # An email with the same idempotency key was sent already, e.g. before the lease of this email expired
+            self._complete_many(duplicates)
+            DUPLICATES.labels('send').inc(len(duplicates))
+
+            if reserved:
+                return reserved
+
+    @staticmethod
+    def _wait(queues, timeout):
+        """
+        Block for up to timeout seconds (0 for no limit) until an email is pushed to any of the given queues, which
+        must share a redis instance.
+
+        :return: True if an email was pushed, False on timeout
+        """
+
+        # Every push leaves a signal, which are cleared when the queue is drained. Thus, blocking on
+        # the signal lists wakes us as soon as an email is pushed, without polling the queues.
+        keys = [queue._key_signal for queue in queues]
+        return queues[0]._redis.brpop(keys, int(math.ceil(timeout))) is not None
 
     @connection_timeout_decorator()
-    def reserve(self):
+    def reserve(self, timeout=None):
         """
         Pops an email from the queue for processing.
         The email is still stored in redis in case the worker dies.
@@ -73,61 +752,704 @@ class DistributedQueue(object):
         When processed call complete with the returned token to mark the email as sent.
         If the email is invalid then mark it for manual inspection by calling discard.
 
-        If a reserved email is not handled it will eventually be moved back to the
-        email queue for processing.
+        If a reserved email is not handled within the lease timeout it will eventually be moved back to the
+        email queue for processing (see reap). Call extend_lease to keep a slow email reserved.
 
+        :param timeout: if given, block for up to timeout seconds (0 for no limit) waiting for an email
+                        to become available instead of returning immediately if the queue is empty
         :return: (email, token)
         """
 
-        data = self._redis.rpoplpush(self._key_queue, self._key_processing)
-        if data is None:
+        reserved = self._reserve_many(1)
+
+        if not reserved and timeout is not None and self._wait([self], timeout):
+            reserved = self._reserve_many(1)
+
+        if not reserved:
+            raise DistributedQueueEmpty()
+
+        return reserved[0]
+
+    @connection_timeout_decorator()
+    def reserve_many(self, n):
+        """
+        Pops up to n emails from the queue for processing in a single round trip.
+
+        See reserve. Each returned token must be passed to complete(_many) or discard(_many).
+
+        :return: [(email, token), ...] with at least one element
+        """
+
+        reserved = self._reserve_many(n)
+        if not reserved:
             raise DistributedQueueEmpty()
 
-        return json.loads(data), data
+        return reserved
+
+    def _complete_many(self, tokens):
+        buckets, expire_at = self._idempotency_buckets(self._key_sent)
+        return self._complete_many_script(keys=self._keys_complete + buckets[:1], args=[expire_at] + list(tokens))
 
     @connection_timeout_decorator()
     def complete(self, token):
-        removed = self._redis.lrem(self._key_processing, 1, token)
+        removed = self._complete_many([token])
 
         if removed != 1:
             raise DistributedQueueException("Token not found")
 
     @connection_timeout_decorator()
-    def discard(self, token):
+    def complete_many(self, tokens):
+        """
+        Mark a list of reserved emails as sent in a single (atomic) round trip.
+        """
+
+        if not tokens:
+            return
+
+        removed = self._complete_many(tokens)
+
+        if removed != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - removed, len(tokens)))
+
+    def _discard_many(self, tokens, reasons):
+        args = []
+        for token, reason in zip(tokens, reasons or [None] * len(tokens)):
+            args.extend([token, reason or ''])
+
+        return self._discard_many_script(keys=self._keys_discard, args=args)
+
+    @connection_timeout_decorator()
+    def discard(self, token, reason=None):
         """
         Discard a token from the processing queue to the discard queue.
 
         :param token:
+        :param reason: why the email was discarded (optional), see requeue
         :return:
         """
 
-        # Transaction start
-        pipeline = self._redis.pipeline()
-        pipeline.lpush(self._key_discard, token)
-        pipeline.lrem(self._key_processing, 1, token)
-        resp = pipeline.execute()
+        moved = self._discard_many([token], [reason])
+
+        if moved != 1:
+            raise DistributedQueueException("Token not found")
+
+    @connection_timeout_decorator()
+    def discard_many(self, tokens, reasons=None):
+        """
+        Discard a list of tokens from the processing queue to the discard queue in a single (atomic) round trip.
+
+        Only tokens found in the processing queue are moved to the discard queue.
+
+        :param reasons: list with the reason each email was discarded (optional), see requeue
+        """
+
+        if not tokens:
+            return
+
+        moved = self._discard_many(tokens, reasons)
+
+        if moved != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - moved, len(tokens)))
+
+    @connection_timeout_decorator()
+    def extend_lease(self, token, lease_timeout=None):
+        """
+        Extend the lease of a reserved email to lease_timeout seconds from now (default: the queue's lease timeout).
+
+        Raises DistributedQueueException if the email is no longer reserved, e.g. if the lease expired and the
+        email was reaped.
+        """
 
-        if resp[1] != 1:
-            # This is bad, try to remove the token from the discard list again and return
-            # This can lead to some interesting inconsistency
-            pipeline.lrem(self._key_discard, 1, token)
+        if lease_timeout is None:
+            lease_timeout = self.lease_timeout
 
+        if self._extend_lease_script(keys=[self._key_leases, self._key_generations],
+                                     args=[token, time.time() + lease_timeout]) != 1:
             raise DistributedQueueException("Token not found")
 
     @connection_timeout_decorator()
-    def size(self):
-        return self._redis.llen(self._key_queue)
+    def reap(self, batch_size=1000):
+        """
+        Move reserved emails with an expired lease back to the queue.
+
+        Expired leases are found by a range query on the leases, and are handled in atomic batches of at most
+        batch_size emails, such that the cost only depends on the number of expired emails.
+
+        :return: the number of recovered emails
+        """
+
+        recovered = 0
+        while 1:
+            found, moved = self._reap_script(keys=self._keys_reap,
+                                             args=[time.time(), batch_size, _MAX_SIGNALS, self._default_lane + 1])
+
+            recovered += moved
+            if found < batch_size:
+                return recovered
+
+    @connection_timeout_decorator()
+    def migrate(self, batch_size=1000):
+        """
+        Move the emails left in processing by workers of a release before ids were introduced back to the queue, in
+        atomic batches of at most batch_size emails. All workers of that release must be stopped first, and the new
+        workers started once done, as reserve refuses to run while such emails are left.
+
+        Emails queued or discarded by that release are plain JSON, which are read as is and given an id when reserved,
+        such that the queue need not be drained and frontends may be upgraded in any order.
+
+        :return: the number of moved emails
+        """
+
+        migrated = 0
+        while 1:
+            moved = self._migrate_script(keys=[self._key_processing, self._key_signal, self._key_queue],
+                                         args=[batch_size, _MAX_SIGNALS])
+
+            migrated += moved
+            if moved < batch_size:
+                return migrated
+
+    @connection_timeout_decorator()
+    def retry_many(self, tokens, base_delay=_RETRY_BASE_DELAY, max_delay=_RETRY_MAX_DELAY,
+                   max_attempts=_RETRY_MAX_ATTEMPTS):
+        """
+        Schedule a list of reserved emails, which failed temporarily, for another attempt in a single round trip.
+
+        The delay before the next attempt doubles with each failed attempt, starting at base_delay seconds and
+        bounded by max_delay seconds, and is jittered by up to half. Emails which failed max_attempts times are
+        discarded instead. Emails are moved back to the queue by promote once their delay has passed.
+
+        :return: (retried, discarded) number of emails
+        """
+
+        if not tokens:
+            return 0, 0
+
+        args = [time.time(), base_delay, max_delay, max_attempts]
+        for token in tokens:
+            args.extend([token, random.random()])
+
+        retried, discarded = self._retry_many_script(keys=self._keys_retry, args=args)
+
+        if retried + discarded != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - retried - discarded,
+                                                                           len(tokens)))
+
+        return retried, discarded
+
+    @connection_timeout_decorator()
+    def promote(self, batch_size=1000):
+        """
+        Move emails scheduled for another attempt (see retry_many) back to the queue once their delay has passed.
+
+        Due emails are found by a range query, and are moved in atomic batches of at most batch_size emails.
+
+        :return: the number of promoted emails
+        """
+
+        promoted = 0
+        while 1:
+            moved = self._promote_script(keys=self._keys_promote,
+                                         args=[time.time(), batch_size, _MAX_SIGNALS, self._default_lane + 1])
+
+            promoted += moved
+            if moved < batch_size:
+                return promoted
+
+    @connection_timeout_decorator()
+    def requeue(self, source='discard', filters=None, limit=None, chunk_size=1000):
+        """
+        Move discarded emails (or emails stuck in processing, if source is 'processing') back to the queue, e.g. after
+        a misconfigured backend rejected valid emails. Requeued emails start over with no failed attempts. Only emails
+        in processing with an expired lease are requeued, as the others may still be sent by the worker holding them.
+
+        Emails are matched against filters, a list of (field, operator, value) where field is a field of the email
+        (e.g. 'subject' or 'to_email'), 'to_domain' (the domain of the recipient) or 'reason' (why the email was
+        discarded), and operator is '=' (equal) or '~' (contains). Values are compared case insensitively, and an email
+        must match all filters.
+
+        Emails are examined in chunks of chunk_size emails, each moved atomically by a script in a single round trip,
+        such that emails are filtered without transferring them and redis is never blocked for long.
+
+        :param limit: maximum number of emails to requeue (default: no limit)
+        :return: the number of requeued emails
+        """
+
+        filters = filters or []
+        args = []
+
+        for field, operator, value in filters:
+            if operator not in ('=', '~'):
+                raise DistributedQueueException("Unknown filter operator: %s" % operator)
+            args.extend([field, operator, value])
+
+        requeued = 0
+
+        if source == 'discard':
+            # Only examine the emails discarded so far, as emails not matching are rotated back into the list
+            remaining = self._redis.llen(self._key_discard)
+
+            while remaining > 0 and (limit is None or requeued < limit):
+                examined, moved = self._requeue_discarded_script(
+                    keys=[self._key_discard] + self._keys_requeue,
+                    args=[chunk_size if limit is None else limit - requeued, _MAX_SIGNALS, self._default_lane + 1,
+                          min(chunk_size, remaining), 0, 0] + args)
+
+                requeued += moved
+                remaining -= examined
+                if examined == 0:
+                    break
+
+        elif source == 'processing':
+            skipped = 0
+            now = time.time()
+
+            while limit is None or requeued < limit:
+                examined, skipped, moved = self._requeue_processing_script(
+                    keys=[self._key_processing] + self._keys_requeue,
+                    args=[chunk_size if limit is None else limit - requeued, _MAX_SIGNALS, self._default_lane + 1,
+                          chunk_size, skipped, now] + args)
+
+                requeued += moved
+                if examined < chunk_size:
+                    break
+
+        else:
+            raise DistributedQueueException("Unknown source: %s" % source)
+
+        return requeued
+
+    def _scan_ids(self, source, priority, chunk_size):
+        """
+        :return: generator of lists of at most chunk_size ids in source
+        """
+
+        if source == 'processing':
+            cursor = 0
+            while 1:
+                cursor, ids = self._redis.sscan(self._key_processing, cursor, count=chunk_size)
+                if ids:
+                    yield ids
+                if int(cursor) == 0:
+                    return
+
+        if source == 'retrying':
+            keys = [self._key_retries]
+            read = self._redis.zrange
+        elif source == 'discard':
+            keys = [self._key_discard]
+            read = self._redis.lrange
+        elif source == 'queue':
+            keys = self._key_lanes if priority is None else [self._key_lanes[self._lane(priority)]]
+            read = self._redis.lrange
+        else:
+            raise DistributedQueueException("Unknown source: %s" % source)
+
+        for key in keys:
+            start = 0
+            while 1:
+                ids = read(key, start, start + chunk_size - 1)
+                if ids:
+                    yield ids
+                if len(ids) < chunk_size:
+                    break
+                start += chunk_size
+
+    def scan(self, source='queue', priority=None, chunk_size=1000):
+        """
+        Iterate over the emails in source, one of 'queue' (all lanes, or the lane of the given priority),
+        'processing', 'retrying' or 'discard'.
+
+        Emails are read in chunks of chunk_size emails, each costing two short round trips, such that redis is never
+        blocked for long and memory does not depend on the size of the queue. The chunks do not form a snapshot,
+        such that an email moved while scanning may be skipped or returned twice.
+
+        :return: generator of emails
+        """
+
+        for ids in self._scan_ids(source, priority, chunk_size):
+            data = self._fetch_script(keys=[self._key_payloads, self._key_bodies, self._key_body_refs], args=ids)
+
+            for i in range(0, len(data), 2):
+                yield _decode_email(data[i], data[i + 1])
+
+    @connection_timeout_decorator()
+    def size(self, priority=None):
+        """
+        :return: number of queued emails in the given priority lane, or in all lanes if no priority is given
+        """
+
+        if priority is not None:
+            return self._redis.llen(self._key_lanes[self._lane(priority)])
+
+        pipeline = self._redis.pipeline(transaction=False)
+        for key in self._key_lanes:
+            pipeline.llen(key)
+
+        return sum(pipeline.execute())
 
     @connection_timeout_decorator()
     def size_processing(self):
-        return self._redis.llen(self._key_processing)
+        return self._redis.scard(self._key_processing)
 
     @connection_timeout_decorator()
     def size_discarded(self):
         return self._redis.llen(self._key_discard)
 
+    @connection_timeout_decorator()
+    def size_retrying(self):
+        return self._redis.zcard(self._key_retries)
+
     @connection_timeout_decorator()
     def reset(self):
-        self._redis.delete(self._key_queue)
-        self._redis.delete(self._key_processing)
-        self._redis.delete(self._key_discard)
+        # Older buckets of idempotency keys have expired
+        buckets = self._idempotency_buckets(self._key_submitted)[0] + self._idempotency_buckets(self._key_sent)[0]
+
+        self._redis.delete(self._key_processing, self._key_discard, self._key_payloads, self._key_ids,
+                           self._key_signal, self._key_leases, self._key_bodies, self._key_body_counts,
+                           self._key_body_refs, self._key_email_lanes, self._key_lane_state, self._key_retries,
+                           self._key_attempts, self._key_idempotency_keys, self._key_reasons, self._key_generations,
+                           *(buckets + self._key_lanes))
+
+
+class PartitionedQueue(object):
+
+    def __init__(self, redis_urls, partitions, namespace='reliableemail', engine=None, **kwargs):
+        """
+        A queue partitioned into a number of DistributedQueues (or queues of the given engine class, see
+        create_queue), which are spread over the given redis instances.
+
+        Supports the same calls as DistributedQueue, and accepts the same keyword arguments.
+
+        The keys of each partition share a hash tag, such that a partition lives in a single slot of a redis cluster
+        while the partitions are spread over all slots. Emails are pushed to the partitions in a round robin fashion,
+        and reserved from all partitions (starting with a new partition each time), such that workers steal work from
+        each other's partitions. Emails with an idempotency key are pushed to the partition given by the key instead,
+        such that duplicates meet in the same partition.
+
+        Tokens are prefixed with the partition of the email.
+        """
+
+        if isinstance(redis_urls, basestring):
+            redis_urls = [redis_urls]
+
+        self._engine = engine or DistributedQueue
+        self._partitions = [self._engine(redis_urls[i % len(redis_urls)], **kwargs) for i in range(partitions)]
+        self.namespace = namespace
+
+        # Partitions grouped by the redis instance they live on
+        servers = {}
+        for i in range(partitions):
+            servers.setdefault(redis_urls[i % len(redis_urls)], []).append(i)
+        self._servers = sorted(servers.values())
+
+        self._next_push = random.randrange(partitions)
+        self._next_reserve = random.randrange(partitions)
+
+    @property
+    def namespace(self):
+        return self._namespace
+
+    @namespace.setter
+    def namespace(self, value):
+        self._namespace = value
+        for i, partition in enumerate(self._partitions):
+            partition.namespace = '%s{%s}' % (value, i)
+
+    @property
+    def lease_timeout(self):
+        return self._partitions[0].lease_timeout
+
+    @lease_timeout.setter
+    def lease_timeout(self, value):
+        for partition in self._partitions:
+            partition.lease_timeout = value
+
+    def _push_partition(self, email=None):
+        key = email.get('idempotency_key', None) if email is not None else None
+
+        if key is not None:
+            data = key.encode('utf-8') if isinstance(key, unicode) else key
+            return (zlib.crc32(data) & 0xffffffff) % len(self._partitions)
+
+        self._next_push = (self._next_push + 1) % len(self._partitions)
+        return self._next_push
+
+    def _reserve_order(self):
+        """
+        :return: the partitions to reserve from, in order
+        """
+
+        self._next_reserve = (self._next_reserve + 1) % len(self._partitions)
+        return [(self._next_reserve + i) % len(self._partitions) for i in range(len(self._partitions))]
+
+    def _split(self, token):
+        partition, token = token.split(':', 1)
+        return self._partitions[int(partition)], token
+
+    def _group(self, tokens):
+        """
+        :return: dict of partition index -> tokens of that partition
+        """
+
+        groups = {}
+        for token in tokens:
+            partition, token = token.split(':', 1)
+            groups.setdefault(int(partition), []).append(token)
+
+        return groups
+
+    def _each(self, groups, call):
+        """
+        Call call(partition, group) for each group of tokens (see _group). Tokens rejected by a partition (e.g. of
+        expired leases) are raised once all partitions were called, such that the other tokens are still handled.
+
+        :return: list of the results of the calls
+        """
+
+        results = []
+        errors = []
+
+        for i, group in groups.items():
+            try:
+                results.append(call(self._partitions[i], group))
+            except DistributedQueueException, ex:
+                errors.append(str(ex))
+
+        if errors:
+            raise DistributedQueueException(', '.join(errors))
+
+        return results
+
+    @connection_timeout_decorator()
+    def push(self, email):
+        return self._partitions[self._push_partition(email)].push(email)
+
+    @connection_timeout_decorator()
+    def push_many(self, emails):
+        """
+        Push a list of emails in a single (atomic) round trip, all to the same partition. Emails with an idempotency
+        key are pushed to the partition given by their key, in a round trip per partition.
+        """
+
+        groups = {}
+        partition = None
+
+        for email in emails:
+            if email.get('idempotency_key', None) is not None:
+                groups.setdefault(self._push_partition(email), []).append(email)
+            else:
+                if partition is None:
+                    partition = self._push_partition()
+                groups.setdefault(partition, []).append(email)
+
+        return sum(self._partitions[i].push_many(group) for i, group in groups.items())
+
+    def _wait(self, timeout, deadline):
+        """
+        Block until an email is pushed to any partition, or until the deadline (unless timeout is 0, for no limit).
+
+        :return: True if an email was pushed, False on timeout
+        """
+
+        # A single instance is blocked on at once, several instances in turn for a slice each
+        wait_slice = timeout if len(self._servers) == 1 else _WAIT_SLICE
+
+        while 1:
+            for server in self._servers:
+                wait = wait_slice
+                if timeout != 0:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+
+                if self._engine._wait([self._partitions[i] for i in server], wait):
+                    return True
+
+    @connection_timeout_decorator()
+    def reserve(self, timeout=None):
+        """
+        Pops an email from the first non-empty partition. See DistributedQueue.reserve.
+
+        If all partitions are empty and a timeout is given, then block on all partitions of a redis instance at once
+        (e.g. a single BRPOP on their signal lists), such that an email pushed to any partition is reserved right away.
+        Partitions spread over several instances are blocked on an instance at a time, for up to _WAIT_SLICE seconds.
+        """
+
+        deadline = time.time() + (timeout or 0)
+
+        while 1:
+            for i in self._reserve_order():
+                try:
+                    email, token = self._partitions[i].reserve()
+                    return email, '%s:%s' % (i, token)
+                except DistributedQueueEmpty:
+                    pass
+
+            if timeout is None or not self._wait(timeout, deadline):
+                raise DistributedQueueEmpty()
+
+    @connection_timeout_decorator()
+    def reserve_many(self, n):
+        """
+        Pops up to n emails from the first non-empty partition. See DistributedQueue.reserve_many.
+        """
+
+        for i in self._reserve_order():
+            try:
+                return [(email, '%s:%s' % (i, token)) for email, token in self._partitions[i].reserve_many(n)]
+            except DistributedQueueEmpty:
+                pass
+
+        raise DistributedQueueEmpty()
+
+    @connection_timeout_decorator()
+    def complete(self, token):
+        partition, token = self._split(token)
+        partition.complete(token)
+
+    @connection_timeout_decorator()
+    def complete_many(self, tokens):
+        self._each(self._group(tokens), lambda partition, group: partition.complete_many(group))
+
+    @connection_timeout_decorator()
+    def discard(self, token, reason=None):
+        partition, token = self._split(token)
+        partition.discard(token, reason)
+
+    @connection_timeout_decorator()
+    def discard_many(self, tokens, reasons=None):
+        groups = {}
+
+        for token, reason in zip(tokens, reasons or [None] * len(tokens)):
+            partition, token = token.split(':', 1)
+            group = groups.setdefault(int(partition), ([], []))
+            group[0].append(token)
+            group[1].append(reason)
+
+        self._each(groups, lambda partition, group: partition.discard_many(*group))
+
+    @connection_timeout_decorator()
+    def extend_lease(self, token, lease_timeout=None):
+        partition, token = self._split(token)
+        partition.extend_lease(token, lease_timeout)
+
+    @connection_timeout_decorator()
+    def reap(self, batch_size=1000):
+        return sum(partition.reap(batch_size) for partition in self._partitions)
+
+    @connection_timeout_decorator()
+    def migrate(self, batch_size=1000):
+        return sum(partition.migrate(batch_size) for partition in self._partitions)
+
+    @connection_timeout_decorator()
+    def retry_many(self, tokens, **kwargs):
+        counts = self._each(self._group(tokens), lambda partition, group: partition.retry_many(group, **kwargs))
+
+        return sum(retried for retried, discarded in counts), sum(discarded for retried, discarded in counts)
+
+    @connection_timeout_decorator()
+    def promote(self, batch_size=1000):
+        return sum(partition.promote(batch_size) for partition in self._partitions)
+
+    @connection_timeout_decorator()
+    def requeue(self, source='discard', filters=None, limit=None, chunk_size=1000):
+        """
+        Move discarded (or processing) emails back to the queue, one partition at a time. See DistributedQueue.requeue.
+        """
+
+        requeued = 0
+
+        for partition in self._partitions:
+            if limit is not None and requeued >= limit:
+                break
+
+            requeued += partition.requeue(source, filters, None if limit is None else limit - requeued, chunk_size)
+
+        return requeued
+
+    def scan(self, source='queue', priority=None, chunk_size=1000):
+        """
+        Iterate over the emails in source, one partition at a time. See DistributedQueue.scan.
+        """
+
+        for partition in self._partitions:
+            for email in partition.scan(source, priority, chunk_size):
+                yield email
+
+    @property
+    def priorities(self):
+        return self._partitions[0].priorities
+
+    @connection_timeout_decorator()
+    def size(self, priority=None):
+        return sum(partition.size(priority) for partition in self._partitions)
+
+    @connection_timeout_decorator()
+    def size_processing(self):
+        return sum(partition.size_processing() for partition in self._partitions)
+
+    @connection_timeout_decorator()
+    def size_discarded(self):
+        return sum(partition.size_discarded() for partition in self._partitions)
+
+    @connection_timeout_decorator()
+    def size_retrying(self):
+        return sum(partition.size_retrying() for partition in self._partitions)
+
+    @connection_timeout_decorator()
+    def reset(self):
+        for partition in self._partitions:
+            partition.reset()
+
+
+def _engine(name):
+    """
+    :return: the queue class of the named engine
+    """
+
+    if name in (None, 'lists'):
+        return DistributedQueue
+
+    if name == 'streams':
+        from streams import StreamQueue
+        return StreamQueue
+
+    if name == 'sqlite':
+        from sqlite import SQLiteQueue
+        return SQLiteQueue
+
+    raise DistributedQueueException("Unknown queue engine: %s" % name)
+
+
+def create_queue(redis_urls, partitions=1, engine=None, **kwargs):
+    """
+    Create a DistributedQueue, or a PartitionedQueue if more than one partition is requested.
+
+    :param redis_urls: a redis url, or a list of urls to spread partitions over
+    :param engine: 'lists' (default), 'streams' (a StreamQueue, which needs redis 6.2) or 'sqlite' (a SQLiteQueue).
+                   Urls with a scheme ending in '+streams' (e.g. redis+streams://localhost:6379) select the streams
+                   engine, and sqlite:// urls (e.g. sqlite:////var/lib/reliable-email/queue.db) the sqlite engine, such
+                   that the engine can be chosen wherever a redis url is configured.
+    """
+
+    if isinstance(redis_urls, basestring):
+        redis_urls = [redis_urls]
+
+    urls = []
+    for url in redis_urls:
+        scheme, separator, rest = url.partition('://')
+        if scheme.endswith('+streams'):
+            engine = engine or 'streams'
+            url = scheme[:-len('+streams')] + separator + rest
+        elif scheme == 'sqlite':
+            engine = engine or 'sqlite'
+        urls.append(url)
+
+    queue_class = _engine(engine)
+
+    if partitions == 1 and len(urls) == 1:
+        return queue_class(urls[0], **kwargs)
+
+    return PartitionedQueue(urls, max(partitions, len(urls)), engine=queue_class, **kwargs)
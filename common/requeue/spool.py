@@ -0,0 +1,217 @@
+import os
+import json
+import fcntl
+import logging
+import threading
+
+logger = logging.getLogger('requeue.spool')
+logger.addHandler(logging.NullHandler())  # hide errors about missing handlers
+
+# Bytes of the spool read at once when recovering it
+_RECOVER_CHUNK_SIZE = 1 << 20
+
+
+class Spool(object):
+
+    def __init__(self, directory):
+        """
+        A local, append-only spool of emails, used when the queue in redis is unavailable.
+
+        Emails are appended as JSON lines to a file in directory, and fsync'ed before append returns, such that spooled
+        emails survive crashes. The drainer pushes spooled emails to the queue in batches, and records how far it got
+        in an offset file. An email can be pushed twice if the process dies between pushing a batch and recording the
+        offset.
+
+        A spool directory can only be used by a single process at a time.
+        """
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock_file = open(os.path.join(directory, 'spool.lock'), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise RuntimeError('Spool directory %s is used by another process' % directory)
+
+        self._offset_path = os.path.join(directory, 'spool.offset')
+        self._file = open(os.path.join(directory, 'spool.ndjson'), 'a+b')
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+
+        self.diverting = False
+
+        self._recover()
+
+    def _recover(self):
+        try:
+            with open(self._offset_path) as offset_file:
+                self._offset = int(offset_file.read())
+        except (IOError, ValueError):
+            self._offset = 0
+
+        # Count the spooled emails (in total, and after the offset) in chunks, such that a large spool is not read
+        # into memory at once
+        self._file.seek(0)
+        size = end = lines = remaining = 0
+
+        while 1:
+            chunk = self._file.read(_RECOVER_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            if '\n' in chunk:
+                end = size + chunk.rfind('\n') + 1
+            lines += chunk.count('\n')
+            remaining += chunk.count('\n', max(0, self._offset - size))
+            size += len(chunk)
+
+        # Drop a partially written line, left behind by a crash while appending
+        if end < size:
+            self._file.truncate(end)
+            self._sync(self._file)
+
+        if self._offset > end:
+            self._offset = 0  # the spool was truncated after being drained, but the offset was not reset
+            remaining = lines
+
+        self._depth = remaining
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    @property
+    def depth(self):
+        """
+        The number of spooled emails not yet pushed to the queue.
+        """
+        return self._depth
+
+    def divert(self):
+        """
+        Mark the queue as unavailable, such that emails are spooled until the drainer has caught up.
+        """
+        self.diverting = True
+
+    def append(self, email):
+        self.append_many([email])
+
+    def append_many(self, emails):
+        """
+        Append emails to the spool, returning once they are persisted on disk.
+
+        :raises: OSError if the emails could not be persisted (e.g. the disk is full), leaving the spool unchanged
+        """
+
+        data = ''.join(json.dumps(email) + '\n' for email in emails)
+
+        with self._lock:
+            # Written unbuffered, such that a failed write leaves nothing behind to be flushed later
+            fd = self._file.fileno()
+            end = os.fstat(fd).st_size
+
+            try:
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                os.fsync(fd)
+            except OSError:
+                os.ftruncate(fd, end)
+                raise
+
+            self._depth += len(emails)
+
+        self._wakeup.set()
+
+    def _read(self, n):
+        with self._lock:
+            self._file.seek(self._offset)
+
+            emails = []
+            while len(emails) < n:
+                line = self._file.readline()
+                if not line:
+                    break
+                emails.append(json.loads(line))
+
+            return emails, self._file.tell()
+
+    def _write_offset(self, offset):
+        temp_path = self._offset_path + '.tmp'
+
+        with open(temp_path, 'w') as offset_file:
+            offset_file.write(str(offset))
+            self._sync(offset_file)
+        os.rename(temp_path, self._offset_path)
+
+        self._offset = offset
+
+    def _commit(self, offset, count):
+        with self._lock:
+            self._write_offset(offset)
+            self._depth -= count
+
+            if self._depth == 0:
+                # Everything is drained, start over with an empty spool (truncated first, see _recover)
+                self._file.truncate(0)
+                self._sync(self._file)
+                self._write_offset(0)
+
+    def drain(self, queue, batch_size=1000):
+        """
+        Push all spooled emails to the queue, in batches of batch_size emails.
+
+        :return: the number of emails pushed
+        :raises: the exception raised by the queue if a batch could not be pushed
+        """
+
+        drained = 0
+
+        while 1:
+            emails, offset = self._read(batch_size)
+            if not emails:
+                return drained
+
+            queue.push_many(emails)
+            self._commit(offset, len(emails))
+            drained += len(emails)
+
+    def start_drainer(self, queue, batch_size=1000, interval=1):
+        """
+        Drain the spool from a background thread, whenever emails are spooled and at least every interval seconds.
+        The spool stops diverting emails once it has been drained.
+        """
+
+        def run():
+            while not self._closed.is_set():
+                self._wakeup.wait(interval)
+                self._wakeup.clear()
+
+                try:
+                    drained = self.drain(queue, batch_size)
+                except Exception:
+                    logger.exception('Failed to drain spool, %s emails spooled' % self._depth)
+                    self.diverting = True
+                    self._closed.wait(interval)  # do not hammer a queue which is down
+                    continue
+
+                if drained:
+                    logger.info('Drained %s emails from spool' % drained)
+
+                self.diverting = False
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._closed.set()
+        self._wakeup.set()
+
+        with self._lock:
+            self._file.close()
+            self._lock_file.close()
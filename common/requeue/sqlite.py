@@ -0,0 +1,640 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from requeue import DistributedQueueEmpty, DistributedQueueException, connection_timeout_decorator, DUPLICATES, \
+    _BODY_THRESHOLD, _LANES, _DEFAULT_LANE, _RETRY_BASE_DELAY, _RETRY_MAX_DELAY, _RETRY_MAX_ATTEMPTS, \
+    _IDEMPOTENCY_WINDOW, _encode_body, _decode_email, _digest_key
+
+# States of an email
+_QUEUED = 0
+_PROCESSING = 1
+_DISCARDED = 2
+_RETRYING = 3
+
+_SOURCES = {'queue': _QUEUED, 'processing': _PROCESSING, 'retrying': _RETRYING, 'discard': _DISCARDED}
+
+# Seconds between polls of a blocking reserve, as sqlite can not wake up other processes
+_POLL_INTERVAL = 0.05
+
+# Emails are read in the order of their lane and id, and due emails (expired leases and retries) by their due time.
+# due holds the lease deadline of processing emails and the time of the next attempt of retrying emails. generation
+# counts the reservations of an email, and tokens are the id and generation of an email, such that a worker whose lease
+# expired can not acknowledge the email once it was reaped and reserved by another worker.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    id INTEGER PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    state INTEGER NOT NULL,
+    lane INTEGER NOT NULL,
+    due REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    generation INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    body BLOB,
+    key TEXT,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS emails_lane ON emails (namespace, state, lane, id);
+CREATE INDEX IF NOT EXISTS emails_due ON emails (namespace, state, due);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    namespace TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (namespace, stage, key)
+);
+
+CREATE TABLE IF NOT EXISTS lane_state (
+    namespace TEXT NOT NULL,
+    lane INTEGER NOT NULL,
+    current INTEGER NOT NULL,
+    PRIMARY KEY (namespace, lane)
+);
+"""
+
+
+def _matches(filters, payload, reason):
+    """
+    :return: True if an email matches all filters, see DistributedQueue.requeue
+    """
+
+    email = None
+
+    for field, operator, value in filters:
+        if field == 'reason':
+            actual = reason
+        else:
+            email = email if email is not None else json.loads(payload)
+            if field == 'to_domain':
+                to_email = email.get('to_email')
+                actual = to_email.rsplit('@', 1)[1] if isinstance(to_email, basestring) and '@' in to_email else None
+            else:
+                actual = email.get(field)
+
+        if not isinstance(actual, basestring):
+            return False
+
+        actual, value = actual.lower(), value.lower()
+        if (operator == '=' and actual != value) or (operator == '~' and value not in actual):
+            return False
+
+    return True
+
+
+class SQLiteQueue(object):
+
+    def __init__(self, url, namespace='reliableemail', lease_timeout=600, body_threshold=_BODY_THRESHOLD,
+                 lanes=_LANES, default_lane=_DEFAULT_LANE, idempotency_window=_IDEMPOTENCY_WINDOW, socket_timeout=None,
+                 busy_timeout=30):
+        """
+        A persistent and reliable queue backed by a local sqlite database, for single machine deployments and tests.
+        Supports the same calls as DistributedQueue, and accepts the same arguments.
+
+        :param url: sqlite:///relative/path or sqlite:////absolute/path of the database, which is created if missing
+
+        Emails are rows holding their state (queued, processing, discarded or retrying) in an indexed column, such
+        that each call is a few index lookups. Each call is a single transaction, which takes the write lock up front
+        and is synced to disk before returning (write-ahead log, synchronous=FULL), such that the processes sharing the
+        database never reserve the same email and no acknowledged call is lost on a crash. Batch calls (push_many,
+        reserve_many, complete_many and discard_many) amortize the sync over the batch.
+
+        Processes wait up to busy_timeout seconds for the write lock (socket_timeout is ignored). The database must be
+        on a local disk, as the write-ahead log relies on shared memory. Blocking reserves poll the database, and
+        idempotency keys are remembered for idempotency_window seconds.
+        """
+
+        self._path = url.split('://', 1)[1][1:] if '://' in url else url
+        self._lanes = [name for name, weight in lanes]
+        self._weights = [weight for name, weight in lanes]
+        self._default_lane = self._lanes.index(default_lane)
+        self._local = threading.local()
+        self.namespace = namespace
+        self.lease_timeout = lease_timeout
+        self.body_threshold = body_threshold
+        self.idempotency_window = int(idempotency_window)
+        self.busy_timeout = busy_timeout
+
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        """
+        :return: the connection of the calling thread, as sqlite connections can not be shared by threads or processes
+        """
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=self.busy_timeout, isolation_level=None)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        A write transaction, which takes the write lock up front such that concurrent reserves wait for each other
+        instead of failing
+        """
+
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+
+    @property
+    def priorities(self):
+        """
+        Names of the priority lanes, highest priority first
+        """
+        return list(self._lanes)
+
+    def _lane(self, priority):
+        if priority is None:
+            return self._default_lane
+
+        try:
+            return self._lanes.index(priority)
+        except ValueError:
+            raise DistributedQueueException("Unknown priority: %s" % priority)
+
+    @staticmethod
+    def _token(token):
+        """
+        :return: the id and generation of a well formed token, or None
+        """
+
+        id, _, generation = str(token).partition(':')
+        if id.isdigit() and generation.isdigit():
+            return int(id), int(generation)
+
+    def _tokens(self, tokens):
+        """
+        :return: the ids and generations of the well formed tokens
+        """
+
+        return [pair for pair in map(self._token, tokens) if pair is not None]
+
+    def _remember(self, connection, stage, key, now):
+        """
+        Remember an idempotency key for the given stage ('submitted' or 'sent').
+
+        :return: False if the key was remembered already
+        """
+
+        connection.execute('DELETE FROM idempotency_keys '
+                           'WHERE namespace = ? AND stage = ? AND key = ? AND expires <= ?',
+                           (self.namespace, stage, key, now))
+        cursor = connection.execute('INSERT OR IGNORE INTO idempotency_keys VALUES (?, ?, ?, ?)',
+                                    (self.namespace, stage, key, now + self.idempotency_window))
+
+        return cursor.rowcount == 1
+
+    def _push_many(self, emails):
+        rows = []
+
+        for email in emails:
+            body = email.get('body', None)
+            key = email.get('idempotency_key', None)
+
+            envelope = dict(email)
+            envelope.pop('idempotency_key', None)
+            lane = self._lane(email.get('priority', None))
+            key = _digest_key(key) if key is not None else None
+
+            if self.body_threshold is None or body is None or len(body) < self.body_threshold:
+                rows.append((self.namespace, _QUEUED, lane, json.dumps(envelope), None, key))
+                continue
+
+            del envelope['body']
+            rows.append((self.namespace, _QUEUED, lane, json.dumps(envelope), sqlite3.Binary(_encode_body(body)[1]),
+                         key))
+
+        now = time.time()
+
+        with self._transaction() as connection:
+            rows = [row for row in rows if row[-1] is None or self._remember(connection, 'submitted', row[-1], now)]
+            connection.executemany('INSERT INTO emails (namespace, state, lane, payload, body, key) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+        if len(rows) < len(emails):
+            DUPLICATES.labels('push').inc(len(emails) - len(rows))
+
+        return len(rows)
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def push(self, email):
+        return self._push_many([email]) == 1
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def push_many(self, emails):
+        if not emails:
+            return 0
+
+        return self._push_many(emails)
+
+    def _shares(self, connection, n):
+        """
+        :return: the number of emails to reserve from each lane, by smooth weighted round robin over the lanes holding
+            queued emails, such that empty lanes earn no credit
+        """
+
+        sizes = [connection.execute('SELECT count(*) FROM (SELECT 1 FROM emails '
+                                    'WHERE namespace = ? AND state = ? AND lane = ? LIMIT ?)',
+                                    (self.namespace, _QUEUED, lane, n)).fetchone()[0]
+                 for lane in range(len(self._lanes))]
+        shares = [0] * len(self._lanes)
+
+        if not any(sizes):
+            return shares
+
+        state = dict(connection.execute('SELECT lane, current FROM lane_state WHERE namespace = ?',
+                                        (self.namespace,)).fetchall())
+        current = [state.get(lane, 0) for lane in range(len(self._lanes))]
+
+        for _ in range(n):
+            lanes = [lane for lane in range(len(self._lanes)) if shares[lane] < sizes[lane]]
+            if not lanes:
+                break
+
+            for lane in lanes:
+                current[lane] += self._weights[lane]
+
+            best = max(lanes, key=lambda lane: current[lane])
+            current[best] -= sum(self._weights[lane] for lane in lanes)
+            shares[best] += 1
+
+        connection.executemany('INSERT OR REPLACE INTO lane_state VALUES (?, ?, ?)',
+                               [(self.namespace, lane, value) for lane, value in enumerate(current)])
+        return shares
+
+    def _reserve_many(self, n):
+        while 1:
+            # Checked without taking the write lock, such that polling an empty queue writes nothing
+            if not self._has_queued():
+                return []
+
+            now = time.time()
+            rows = []
+
+            with self._transaction() as connection:
+                # The write lock is held, so no lane holds fewer emails than its share
+                for lane, share in enumerate(self._shares(connection, n)):
+                    if not share:
+                        continue
+
+                    selected = connection.execute(
+                        'SELECT id, payload, body, key, generation + 1 FROM emails '
+                        'WHERE namespace = ? AND state = ? AND lane = ? ORDER BY id LIMIT ?',
+                        (self.namespace, _QUEUED, lane, share)).fetchall()
+                    connection.executemany('UPDATE emails SET state = ?, due = ?, generation = ? WHERE id = ?',
+                                           [(_PROCESSING, now + self.lease_timeout, row[4], row[0])
+                                            for row in selected])
+                    rows.extend(selected)
+
+                # An email with the same idempotency key was sent already, e.g. before the lease of this email expired
+                duplicates = [row[0] for row in rows if row[3] is not None and connection.execute(
+                    'SELECT 1 FROM idempotency_keys WHERE namespace = ? AND stage = ? AND key = ? AND expires > ?',
+                    (self.namespace, 'sent', row[3], now)).fetchone()]
+                connection.executemany('DELETE FROM emails WHERE id = ?', [(id,) for id in duplicates])
+
+            if duplicates:
+                DUPLICATES.labels('send').inc(len(duplicates))
+
+            reserved = [(_decode_email(payload, str(body) if body is not None else ''), '%s:%s' % (id, generation))
+                        for id, payload, body, key, generation in rows if id not in duplicates]
+
+            if reserved or not duplicates:
+                return reserved
+
+    def _has_queued(self):
+        return self._connection().execute('SELECT 1 FROM emails WHERE namespace = ? AND state = ? LIMIT 1',
+                                          (self.namespace, _QUEUED)).fetchone() is not None
+
+    @staticmethod
+    def _wait(queues, timeout):
+        """
+        Block for up to timeout seconds (0 for no limit) until an email is pushed to any of the given queues, which
+        must share a database. See DistributedQueue._wait.
+        """
+
+        deadline = time.time() + timeout
+
+        while timeout == 0 or time.time() < deadline:
+            time.sleep(_POLL_INTERVAL)
+            if any(queue._has_queued() for queue in queues):
+                return True
+
+        return False
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def reserve(self, timeout=None):
+        """
+        Pops an email from the queue for processing. See DistributedQueue.reserve.
+
+        If no email is available and a timeout is given, then poll for emails every 50 milliseconds, reading without
+        taking the write lock.
+        """
+
+        reserved = self._reserve_many(1)
+
+        if not reserved and timeout is not None:
+            deadline = time.time() + timeout
+
+            while not reserved and (timeout == 0 or time.time() < deadline):
+                time.sleep(_POLL_INTERVAL)
+                if self._has_queued():
+                    reserved = self._reserve_many(1)
+
+        if not reserved:
+            raise DistributedQueueEmpty()
+
+        return reserved[0]
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def reserve_many(self, n):
+        reserved = self._reserve_many(n)
+        if not reserved:
+            raise DistributedQueueEmpty()
+
+        return reserved
+
+    def _complete_many(self, tokens):
+        pairs = self._tokens(tokens)
+        now = time.time()
+
+        with self._transaction() as connection:
+            # The key is marked as sent even if the lease expired and the email was reaped
+            for id, generation in pairs:
+                row = connection.execute('SELECT key FROM emails WHERE id = ? AND namespace = ?',
+                                         (id, self.namespace)).fetchone()
+                if row is not None and row[0] is not None:
+                    connection.execute('INSERT OR REPLACE INTO idempotency_keys VALUES (?, ?, ?, ?)',
+                                       (self.namespace, 'sent', row[0], now + self.idempotency_window))
+
+            return connection.executemany(
+                'DELETE FROM emails WHERE id = ? AND generation = ? AND namespace = ? AND state = ?',
+                [(id, generation, self.namespace, _PROCESSING) for id, generation in pairs]).rowcount
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def complete(self, token):
+        removed = self._complete_many([token])
+
+        if removed != 1:
+            raise DistributedQueueException("Token not found")
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def complete_many(self, tokens):
+        if not tokens:
+            return
+
+        removed = self._complete_many(tokens)
+
+        if removed != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - removed, len(tokens)))
+
+    def _discard_many(self, tokens, reasons):
+        rows = []
+        for token, reason in zip(tokens, reasons or [None] * len(tokens)):
+            pair = self._token(token)
+            if pair is not None:
+                rows.append((_DISCARDED, reason or '') + pair + (self.namespace, _PROCESSING))
+
+        with self._transaction() as connection:
+            return connection.executemany('UPDATE emails SET state = ?, reason = ?, attempts = 0, due = 0 '
+                                          'WHERE id = ? AND generation = ? AND namespace = ? AND state = ?',
+                                          rows).rowcount
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def discard(self, token, reason=None):
+        moved = self._discard_many([token], [reason])
+
+        if moved != 1:
+            raise DistributedQueueException("Token not found")
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def discard_many(self, tokens, reasons=None):
+        if not tokens:
+            return
+
+        moved = self._discard_many(tokens, reasons)
+
+        if moved != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - moved, len(tokens)))
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def extend_lease(self, token, lease_timeout=None):
+        if lease_timeout is None:
+            lease_timeout = self.lease_timeout
+
+        id, generation = self._token(token) or (None, None)
+        cursor = self._connection().execute(
+            'UPDATE emails SET due = ? WHERE id = ? AND generation = ? AND namespace = ? AND state = ?',
+            (time.time() + lease_timeout, id, generation, self.namespace, _PROCESSING))
+
+        if cursor.rowcount != 1:
+            raise DistributedQueueException("Token not found")
+
+    def _move_due(self, state, batch_size):
+        """
+        Move up to batch_size emails in the given state, which are due, back to the queue
+
+        :return: the number of moved emails
+        """
+
+        with self._transaction() as connection:
+            return connection.execute(
+                'UPDATE emails SET state = ?, due = 0 WHERE id IN ('
+                'SELECT id FROM emails WHERE namespace = ? AND state = ? AND due <= ? LIMIT ?)',
+                (_QUEUED, self.namespace, state, time.time(), batch_size)).rowcount
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def reap(self, batch_size=1000):
+        """
+        Move reserved emails with an expired lease back to the queue, in transactions of at most batch_size emails,
+        and forget expired idempotency keys.
+
+        :return: the number of recovered emails
+        """
+
+        self._connection().execute('DELETE FROM idempotency_keys WHERE namespace = ? AND expires <= ?',
+                                   (self.namespace, time.time()))
+
+        recovered = 0
+        while 1:
+            moved = self._move_due(_PROCESSING, batch_size)
+
+            recovered += moved
+            if moved < batch_size:
+                return recovered
+
+    def migrate(self, batch_size=1000):
+        """
+        No release stored emails as plain JSON in sqlite, so there is nothing to migrate. See DistributedQueue.migrate.
+        """
+
+        return 0
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def retry_many(self, tokens, base_delay=_RETRY_BASE_DELAY, max_delay=_RETRY_MAX_DELAY,
+                   max_attempts=_RETRY_MAX_ATTEMPTS):
+        if not tokens:
+            return 0, 0
+
+        retried, discarded = 0, 0
+        now = time.time()
+
+        with self._transaction() as connection:
+            for id, generation in self._tokens(tokens):
+                row = connection.execute('SELECT attempts FROM emails '
+                                         'WHERE id = ? AND generation = ? AND namespace = ? AND state = ?',
+                                         (id, generation, self.namespace, _PROCESSING)).fetchone()
+                if row is None:
+                    continue
+
+                attempts = row[0] + 1
+                if attempts >= max_attempts:
+                    connection.execute('UPDATE emails SET state = ?, reason = ?, attempts = 0, due = 0 '
+                                       'WHERE id = ? AND generation = ?',
+                                       (_DISCARDED, 'Too many attempts', id, generation))
+                    discarded += 1
+                else:
+                    delay = min(max_delay, base_delay * 2 ** (attempts - 1))
+                    delay = delay / 2.0 + delay / 2.0 * random.random()
+                    connection.execute('UPDATE emails SET state = ?, attempts = ?, due = ? '
+                                       'WHERE id = ? AND generation = ?',
+                                       (_RETRYING, attempts, now + delay, id, generation))
+                    retried += 1
+
+        if retried + discarded != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - retried - discarded,
+                                                                           len(tokens)))
+
+        return retried, discarded
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def promote(self, batch_size=1000):
+        promoted = 0
+        while 1:
+            moved = self._move_due(_RETRYING, batch_size)
+
+            promoted += moved
+            if moved < batch_size:
+                return promoted
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def requeue(self, source='discard', filters=None, limit=None, chunk_size=1000):
+        """
+        Move discarded emails (or emails stuck in processing with an expired lease) back to the queue. See
+        DistributedQueue.requeue.
+
+        Emails are filtered in chunks of chunk_size emails, each moved in a transaction of its own.
+        """
+
+        filters = filters or []
+
+        for field, operator, value in filters:
+            if operator not in ('=', '~'):
+                raise DistributedQueueException("Unknown filter operator: %s" % operator)
+
+        if source not in ('discard', 'processing'):
+            raise DistributedQueueException("Unknown source: %s" % source)
+
+        requeued = 0
+
+        # Emails in processing are only requeued once their lease expired (discarded emails are due at 0)
+        due = time.time() if source == 'processing' else 0
+
+        for lane in range(len(self._lanes)):
+            cursor = 0
+
+            while limit is None or requeued < limit:
+                with self._transaction() as connection:
+                    rows = connection.execute(
+                        'SELECT id, payload, reason FROM emails WHERE namespace = ? AND state = ? AND lane = ? '
+                        'AND id > ? AND due <= ? ORDER BY id LIMIT ?',
+                        (self.namespace, _SOURCES[source], lane, cursor, due, chunk_size)).fetchall()
+
+                    ids = [id for id, payload, reason in rows if _matches(filters, payload, reason)]
+                    if limit is not None:
+                        ids = ids[:limit - requeued]
+
+                    connection.executemany('UPDATE emails SET state = ?, reason = NULL, attempts = 0, due = 0 '
+                                           'WHERE id = ?', [(_QUEUED, id) for id in ids])
+
+                requeued += len(ids)
+                if len(rows) < chunk_size:
+                    break
+                cursor = rows[-1][0]
+
+        return requeued
+
+    def scan(self, source='queue', priority=None, chunk_size=1000):
+        """
+        Iterate over the emails in source. See DistributedQueue.scan.
+        """
+
+        if source not in _SOURCES:
+            raise DistributedQueueException("Unknown source: %s" % source)
+
+        lanes = range(len(self._lanes)) if source != 'queue' or priority is None else [self._lane(priority)]
+
+        for lane in lanes:
+            cursor = 0
+
+            while 1:
+                rows = self._connection().execute(
+                    'SELECT id, payload, body FROM emails WHERE namespace = ? AND state = ? AND lane = ? AND id > ? '
+                    'ORDER BY id LIMIT ?', (self.namespace, _SOURCES[source], lane, cursor, chunk_size)).fetchall()
+
+                for id, payload, body in rows:
+                    yield _decode_email(payload, str(body) if body is not None else '')
+
+                if len(rows) < chunk_size:
+                    break
+                cursor = rows[-1][0]
+
+    def _count(self, state, lane=None):
+        if lane is None:
+            query, args = 'SELECT count(*) FROM emails WHERE namespace = ? AND state = ?', (self.namespace, state)
+        else:
+            query = 'SELECT count(*) FROM emails WHERE namespace = ? AND state = ? AND lane = ?'
+            args = (self.namespace, state, lane)
+
+        return self._connection().execute(query, args).fetchone()[0]
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def size(self, priority=None):
+        return self._count(_QUEUED, None if priority is None else self._lane(priority))
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def size_processing(self):
+        return self._count(_PROCESSING)
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def size_discarded(self):
+        return self._count(_DISCARDED)
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def size_retrying(self):
+        return self._count(_RETRYING)
+
+    @connection_timeout_decorator(sqlite3.OperationalError)
+    def reset(self):
+        with self._transaction() as connection:
+            for table in ('emails', 'idempotency_keys', 'lane_state'):
+                connection.execute('DELETE FROM %s WHERE namespace = ?' % table, (self.namespace,))
@@ -0,0 +1,917 @@
+import os
+import json
+import time
+import uuid
+import random
+import socket
+
+import redis
+
+from requeue import DistributedQueueEmpty, DistributedQueueException, connection_timeout_decorator, DUPLICATES, \
+    _BODY_THRESHOLD, _LANES, _DEFAULT_LANE, _RETRY_BASE_DELAY, _RETRY_MAX_DELAY, _RETRY_MAX_ATTEMPTS, \
+    _IDEMPOTENCY_WINDOW, _encode_body, _decode_email, _digest_key
+
+# Consumer group shared by all workers reading a lane
+_GROUP = 'workers'
+
+# Functions shared by the scripts. Entries hold the fields email, body, attempts and key (the idempotency key digest),
+# in that order, followed by lane and reason (discarded emails) or lane (emails waiting for another attempt). Tokens are
+# the index of the lane and the id of the entry in the lane's stream.
+_STREAMS_LUA = """
+local function hash(flat)
+    local result = {}
+    for i = 1, #flat, 2 do
+        result[flat[i]] = flat[i + 1]
+    end
+    return result
+end
+
+local function entry(stream, id)
+    local entries = redis.call('XRANGE', stream, id, id)
+    return entries[1] and hash(entries[1][2])
+end
+
+local function append(stream, fields, attempts, ...)
+    return redis.call('XADD', stream, '*', 'email', fields.email, 'body', fields.body, 'attempts', attempts,
+                      'key', fields.key, ...)
+end
+
+local function split(token)
+    local lane, id = string.match(token, '^(%d+):(.+)$')
+    return tonumber(lane), id
+end
+
+-- Whether the entry is still reserved by the consumer, i.e. was not claimed by another consumer once its lease expired
+local function owned(stream, consumer, id)
+    local pending = redis.call('XPENDING', stream, ARGV[1], id, id, 1)
+    return pending[1] and pending[1][2] == consumer
+end
+
+local function group(stream)
+    for i, info in ipairs(redis.call('XINFO', 'GROUPS', stream)) do
+        info = hash(info)
+        if info['name'] == ARGV[1] then
+            return info
+        end
+    end
+end
+"""
+
+# KEYS holds the current and previous bucket of submitted idempotency keys followed by the lane streams. ARGV holds the
+# expiry time of the current bucket followed by (payload, lane, body, idempotency key) quadruples.
+_PUSH_MANY_SCRIPT = """
+redis.replicate_commands()
+local pushed, keyed = 0, false
+for i = 2, #ARGV, 4 do
+    local key = ARGV[i + 3]
+    if key == '' or (redis.call('SISMEMBER', KEYS[2], key) == 0 and redis.call('SADD', KEYS[1], key) == 1) then
+        keyed = keyed or key ~= ''
+        redis.call('XADD', KEYS[3 + tonumber(ARGV[i + 1])], '*', 'email', ARGV[i], 'body', ARGV[i + 2],
+                   'attempts', 0, 'key', key)
+        pushed = pushed + 1
+    end
+end
+if keyed then
+    redis.call('EXPIREAT', KEYS[1], ARGV[1])
+end
+return pushed
+"""
+
+# KEYS holds the current and previous bucket of sent idempotency keys, the lane state and the claim cursors followed by
+# the lane streams. ARGV holds the number of emails, the group, the consumer and the lease timeout in milliseconds
+# followed by the lane weights. Entries idle for longer than the lease timeout are claimed first. XAUTOCLAIM examines a
+# bounded number of entries per call, thus each lane's claim resumes where the previous reserve stopped, such that
+# expired entries behind many active leases are reached as well. New entries are then read from each lane
+# by smooth weighted round robin over the lanes holding new entries, such that empty lanes earn no credit, and lanes
+# holding fewer entries than their share leave room for the other lanes in order of priority. Returns (token, payload,
+# body, sent) quadruples, where sent is 1 if an email with the same idempotency key was sent already.
+_RESERVE_MANY_SCRIPT = _STREAMS_LUA + """
+redis.replicate_commands()
+local lanes = #KEYS - 4
+local n = tonumber(ARGV[1])
+local count = 0
+local items = {}
+
+local function add(lane, item)
+    local fields = hash(item[2])
+    local key = fields.key or ''
+    local sent = key ~= '' and (redis.call('SISMEMBER', KEYS[1], key) == 1 or
+                                redis.call('SISMEMBER', KEYS[2], key) == 1)
+    items[#items + 1] = (lane - 1) .. ':' .. item[1]
+    items[#items + 1] = fields.email
+    items[#items + 1] = fields.body
+    items[#items + 1] = sent and 1 or 0
+    count = count + 1
+end
+
+for lane = 1, lanes do
+    if count >= n then
+        break
+    end
+    local cursor = redis.call('HGET', KEYS[4], lane) or '0-0'
+    local claimed = redis.call('XAUTOCLAIM', KEYS[4 + lane], ARGV[2], ARGV[3], ARGV[4], cursor, 'COUNT', n - count)
+    if claimed[1] ~= cursor then
+        redis.call('HSET', KEYS[4], lane, claimed[1])
+    end
+    for i, item in ipairs(claimed[2]) do
+        if item then
+            add(lane, item)
+        end
+    end
+end
+
+-- The number of new entries (up to want) after the last entry delivered to the group
+local function undelivered(stream, want)
+    for i, info in ipairs(redis.call('XINFO', 'GROUPS', stream)) do
+        info = hash(info)
+        if info['name'] == ARGV[2] then
+            return #redis.call('XRANGE', stream, '(' .. info['last-delivered-id'], '+', 'COUNT', want)
+        end
+    end
+    return 0
+end
+
+local function read(lane, want)
+    local result = redis.call('XREADGROUP', 'GROUP', ARGV[2], ARGV[3], 'COUNT', want, 'STREAMS', KEYS[4 + lane], '>')
+    if result then
+        for i, item in ipairs(result[1][2]) do
+            add(lane, item)
+        end
+    end
+end
+
+if count < n then
+    local fields, weights, current, shares, sizes = {}, {}, {}, {}, {}
+    for lane = 1, lanes do
+        fields[lane] = lane
+    end
+    local state = redis.call('HMGET', KEYS[3], unpack(fields))
+    for lane = 1, lanes do
+        weights[lane] = tonumber(ARGV[4 + lane])
+        current[lane] = tonumber(state[lane]) or 0
+        shares[lane] = 0
+        sizes[lane] = undelivered(KEYS[4 + lane], n - count)
+    end
+
+    for i = 1, n - count do
+        local best, total = nil, 0
+        for lane = 1, lanes do
+            if sizes[lane] > 0 then
+                current[lane] = current[lane] + weights[lane]
+                total = total + weights[lane]
+                if not best or current[lane] > current[best] then
+                    best = lane
+                end
+            end
+        end
+        if not best then
+            break
+        end
+        current[best] = current[best] - total
+        shares[best] = shares[best] + 1
+        sizes[best] = sizes[best] - 1
+    end
+
+    for lane = 1, lanes do
+        if shares[lane] > 0 then
+            read(lane, shares[lane])
+        end
+    end
+    for lane = 1, lanes do
+        if count >= n then
+            break
+        end
+        read(lane, n - count)
+    end
+
+    local saved = {}
+    for lane = 1, lanes do
+        saved[#saved + 1] = lane
+        saved[#saved + 1] = current[lane]
+    end
+    redis.call('HMSET', KEYS[3], unpack(saved))
+end
+
+return items
+"""
+
+# KEYS holds the current bucket of sent idempotency keys followed by the lane streams. ARGV holds the group, the
+# consumer and the expiry time of the bucket followed by the tokens. Emails are only acknowledged and deleted while they
+# are reserved by the consumer, but their idempotency key is marked as sent even if the lease expired and the email was
+# claimed by another worker.
+_COMPLETE_MANY_SCRIPT = _STREAMS_LUA + """
+local removed, keyed = 0, false
+for i = 4, #ARGV do
+    local lane, id = split(ARGV[i])
+    local stream = lane and KEYS[2 + lane]
+    local fields = stream and entry(stream, id)
+    if fields and fields.key ~= '' then
+        redis.call('SADD', KEYS[1], fields.key)
+        keyed = true
+    end
+    if stream and owned(stream, ARGV[2], id) and redis.call('XACK', stream, ARGV[1], id) == 1 then
+        redis.call('XDEL', stream, id)
+        removed = removed + 1
+    end
+end
+if keyed then
+    redis.call('EXPIREAT', KEYS[1], ARGV[3])
+end
+return removed
+"""
+
+# KEYS holds the discard stream followed by the lane streams. ARGV holds the group and the consumer followed by
+# (token, reason) pairs. Only emails reserved by the consumer are discarded.
+_DISCARD_MANY_SCRIPT = _STREAMS_LUA + """
+redis.replicate_commands()
+local moved = 0
+for i = 3, #ARGV, 2 do
+    local lane, id = split(ARGV[i])
+    local stream = lane and KEYS[2 + lane]
+    if stream and owned(stream, ARGV[2], id) and redis.call('XACK', stream, ARGV[1], id) == 1 then
+        local fields = entry(stream, id)
+        if fields then
+            append(KEYS[1], fields, 0, 'lane', lane, 'reason', ARGV[i + 1])
+            moved = moved + 1
+        end
+        redis.call('XDEL', stream, id)
+    end
+end
+return moved
+"""
+
+# KEYS holds the retry schedule, the retrying stream and the discard stream followed by the lane streams. ARGV holds
+# the group, the consumer, the current time, the base delay, the maximum delay and the maximum number of attempts
+# followed by (token, jitter) pairs, see DistributedQueue.retry_many. Only emails reserved by the consumer are retried.
+_RETRY_MANY_SCRIPT = _STREAMS_LUA + """
+redis.replicate_commands()
+local now, base, cap, max_attempts = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local retried, discarded = 0, 0
+for i = 7, #ARGV, 2 do
+    local lane, id = split(ARGV[i])
+    local stream = lane and KEYS[4 + lane]
+    if stream and owned(stream, ARGV[2], id) and redis.call('XACK', stream, ARGV[1], id) == 1 then
+        local fields = entry(stream, id)
+        if fields then
+            local attempts = (tonumber(fields.attempts) or 0) + 1
+            if attempts >= max_attempts then
+                append(KEYS[3], fields, 0, 'lane', lane, 'reason', 'Too many attempts')
+                discarded = discarded + 1
+            else
+                local delay = math.min(cap, base * 2 ^ (attempts - 1))
+                delay = delay / 2 + delay / 2 * tonumber(ARGV[i + 1])
+                redis.call('ZADD', KEYS[1], now + delay, append(KEYS[2], fields, attempts, 'lane', lane))
+                retried = retried + 1
+            end
+        end
+        redis.call('XDEL', stream, id)
+    end
+end
+return {retried, discarded}
+"""
+
+# KEYS holds the retry schedule and the retrying stream followed by the lane streams. ARGV holds the current time and
+# the batch size.
+_PROMOTE_SCRIPT = _STREAMS_LUA + """
+redis.replicate_commands()
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for i, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    local fields = entry(KEYS[2], id)
+    if fields then
+        append(KEYS[3 + tonumber(fields.lane)], fields, fields.attempts)
+        redis.call('XDEL', KEYS[2], id)
+    end
+end
+return #ids
+"""
+
+# KEYS holds the lane stream. ARGV holds the group, the consumer, the id and the idle time to set in milliseconds.
+_EXTEND_LEASE_SCRIPT = """
+local pending = redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[3], ARGV[3], 1)
+if not pending[1] or pending[1][2] ~= ARGV[2] then
+    return 0
+end
+redis.call('XCLAIM', KEYS[1], ARGV[1], ARGV[2], 0, ARGV[3], 'IDLE', ARGV[4], 'JUSTID')
+return 1
+"""
+
+# KEYS holds the lane streams. ARGV holds the group, the lease timeout in milliseconds and the batch size. Counts the
+# entries idle for longer than the lease timeout (at most the batch size per lane), which are claimed by the next
+# reserve. As acknowledged entries are deleted, each stream is trimmed up to its oldest pending entry (or its last
+# delivered entry), and consumers without pending entries which have been idle for longer than the lease timeout are
+# removed from the group.
+_REAP_SCRIPT = _STREAMS_LUA + """
+redis.replicate_commands()
+local expired = 0
+for lane, stream in ipairs(KEYS) do
+    expired = expired + #redis.call('XPENDING', stream, ARGV[1], 'IDLE', ARGV[2], '-', '+', ARGV[3])
+
+    local minid = redis.call('XPENDING', stream, ARGV[1])[2]
+    if not minid then
+        minid = group(stream)['last-delivered-id']
+    end
+    redis.call('XTRIM', stream, 'MINID', minid)
+
+    for i, consumer in ipairs(redis.call('XINFO', 'CONSUMERS', stream, ARGV[1])) do
+        consumer = hash(consumer)
+        if tonumber(consumer['pending']) == 0 and tonumber(consumer['idle']) > tonumber(ARGV[2]) then
+            redis.call('XGROUP', 'DELCONSUMER', stream, ARGV[1], consumer['name'])
+        end
+    end
+end
+return expired
+"""
+
+# Functions shared by the requeue scripts, see DistributedQueue.requeue. ARGV holds the group, the maximum number of
+# emails moved, the number of entries examined, the exclusive start of the range examined and the lease timeout in
+# milliseconds, followed by (field, operator, value) filter triples.
+_REQUEUE_LUA = _STREAMS_LUA + """
+local function matches(fields)
+    local email
+    for i = 6, #ARGV, 3 do
+        local field, value, actual = ARGV[i], string.lower(ARGV[i + 2]), nil
+        if field == 'reason' then
+            actual = fields.reason
+        else
+            email = email or cjson.decode(fields.email)
+            if field == 'to_domain' then
+                actual = type(email.to_email) == 'string' and string.match(email.to_email, '@([^@]*)$')
+            else
+                actual = email[field]
+            end
+        end
+        if type(actual) ~= 'string' then
+            return false
+        end
+        actual = string.lower(actual)
+        if ARGV[i + 1] == '=' and actual ~= value then
+            return false
+        end
+        if ARGV[i + 1] == '~' and not string.find(actual, value, 1, true) then
+            return false
+        end
+    end
+    return true
+end
+"""
+
+# KEYS holds the discard stream followed by the lane streams
+_REQUEUE_DISCARDED_SCRIPT = _REQUEUE_LUA + """
+redis.replicate_commands()
+local items = redis.call('XRANGE', KEYS[1], ARGV[4], '+', 'COUNT', ARGV[3])
+local last, examined, moved = '', 0, 0
+for i, item in ipairs(items) do
+    if moved >= tonumber(ARGV[2]) then
+        break
+    end
+    last, examined = item[1], examined + 1
+    local fields = hash(item[2])
+    if matches(fields) then
+        append(KEYS[2 + tonumber(fields.lane)], fields, 0)
+        redis.call('XDEL', KEYS[1], item[1])
+        moved = moved + 1
+    end
+end
+return {last, examined, moved}
+"""
+
+# KEYS holds a lane stream, whose pending entries with an expired lease (idle for longer than the lease timeout) are
+# examined and appended to the lane again
+_REQUEUE_PROCESSING_SCRIPT = _REQUEUE_LUA + """
+redis.replicate_commands()
+local pending = redis.call('XPENDING', KEYS[1], ARGV[1], 'IDLE', ARGV[5], ARGV[4], '+', ARGV[3])
+local last, examined, moved = '', 0, 0
+for i, item in ipairs(pending) do
+    if moved >= tonumber(ARGV[2]) then
+        break
+    end
+    last, examined = item[1], examined + 1
+    local fields = entry(KEYS[1], item[1])
+    if fields and matches(fields) then
+        redis.call('XACK', KEYS[1], ARGV[1], item[1])
+        append(KEYS[1], fields, 0)
+        redis.call('XDEL', KEYS[1], item[1])
+        moved = moved + 1
+    end
+end
+return {last, examined, moved}
+"""
+
+
+def _fields(flat):
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+class StreamQueue(object):
+
+    def __init__(self, redis_url, namespace='reliableemail', lease_timeout=600, body_threshold=_BODY_THRESHOLD,
+                 lanes=_LANES, default_lane=_DEFAULT_LANE, idempotency_window=_IDEMPOTENCY_WINDOW, socket_timeout=None):
+        """
+        A persistent and reliable queue backed by redis streams (redis 6.2 or later). Supports the same calls as
+        DistributedQueue, and accepts the same arguments.
+
+        Each priority lane is a stream read by a consumer group shared by all workers, such that redis tracks which
+        worker reserved an email, for how long and how many times it was delivered. Reserving reads new emails with
+        XREADGROUP, after claiming emails whose lease expired with XAUTOCLAIM, such that the emails of a dead worker
+        are recovered by the next reserve. Completed emails are acknowledged and deleted, and reap trims each stream
+        up to its oldest reserved email.
+
+        Bodies of at least body_threshold bytes are compressed, but stored with each email rather than once per
+        distinct body. Leases can only be extended up to lease_timeout seconds.
+
+        Tokens hold the lane and the stream id of the email.
+        """
+
+        self._redis = redis.StrictRedis.from_url(redis_url, socket_timeout=socket_timeout)
+        self._lanes = [name for name, weight in lanes]
+        self._weights = [weight for name, weight in lanes]
+        self._default_lane = self._lanes.index(default_lane)
+        self._consumer = '%s-%s-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._groups = False  # whether the consumer groups are known to exist
+        self.namespace = namespace
+        self.lease_timeout = lease_timeout
+        self.body_threshold = body_threshold
+        self.idempotency_window = int(idempotency_window)
+
+        # redis-py does not know the stream commands, thus they are called by lua scripts or execute_command
+        self._push_many_script = self._redis.register_script(_PUSH_MANY_SCRIPT)
+        self._reserve_many_script = self._redis.register_script(_RESERVE_MANY_SCRIPT)
+        self._complete_many_script = self._redis.register_script(_COMPLETE_MANY_SCRIPT)
+        self._discard_many_script = self._redis.register_script(_DISCARD_MANY_SCRIPT)
+        self._extend_lease_script = self._redis.register_script(_EXTEND_LEASE_SCRIPT)
+        self._reap_script = self._redis.register_script(_REAP_SCRIPT)
+        self._retry_many_script = self._redis.register_script(_RETRY_MANY_SCRIPT)
+        self._promote_script = self._redis.register_script(_PROMOTE_SCRIPT)
+        self._requeue_discarded_script = self._redis.register_script(_REQUEUE_DISCARDED_SCRIPT)
+        self._requeue_processing_script = self._redis.register_script(_REQUEUE_PROCESSING_SCRIPT)
+
+    @property
+    def namespace(self):
+        return self._namespace
+
+    @namespace.setter
+    def namespace(self, value):
+        self._namespace = value
+        self._groups = False
+        self._key_lanes = [value + ".stream." + name for name in self._lanes]  # stream of emails per lane
+        self._key_discard = value + ".discard"  # stream of discarded emails
+        self._key_retrying = value + ".retrying"  # stream of emails waiting for another attempt
+        self._key_retries = value + ".retries"  # sorted set of retrying ids scored by the time of their next attempt
+        self._key_lane_state = value + ".lanestate"  # hash of lane -> scheduling state
+        self._key_claim_cursors = value + ".claimcursors"  # hash of lane -> id to resume claiming expired entries at
+        self._key_submitted = value + ".submitted"  # prefix of sets of idempotency keys pushed, per time bucket
+        self._key_sent = value + ".sent"  # prefix of sets of idempotency keys sent, per time bucket
+
+    @property
+    def priorities(self):
+        """
+        Names of the priority lanes, highest priority first
+        """
+        return list(self._lanes)
+
+    def _lane(self, priority):
+        if priority is None:
+            return self._default_lane
+
+        try:
+            return self._lanes.index(priority)
+        except ValueError:
+            raise DistributedQueueException("Unknown priority: %s" % priority)
+
+    def _idempotency_buckets(self, key):
+        bucket = int(time.time()) // self.idempotency_window
+        return ['%s.%s' % (key, bucket), '%s.%s' % (key, bucket - 1)], (bucket + 2) * self.idempotency_window
+
+    def _lease_ms(self):
+        return max(0, int(self.lease_timeout * 1000))
+
+    def _ensure_groups(self, force=False):
+        if self._groups and not force:
+            return
+
+        for key in self._key_lanes:
+            try:
+                self._redis.execute_command('XGROUP', 'CREATE', key, _GROUP, 0, 'MKSTREAM')
+            except redis.ResponseError, ex:
+                if 'BUSYGROUP' not in str(ex):
+                    raise
+
+        self._groups = True
+
+    def _call(self, script, keys, args):
+        """
+        Call a script reading the consumer groups, creating them first if needed (e.g. after a reset)
+        """
+
+        self._ensure_groups()
+
+        try:
+            return script(keys=keys, args=args)
+        except redis.ResponseError, ex:
+            if 'NOGROUP' not in str(ex):
+                raise
+
+        self._ensure_groups(force=True)
+        return script(keys=keys, args=args)
+
+    def _push_many(self, emails):
+        buckets, expire_at = self._idempotency_buckets(self._key_submitted)
+        args = [expire_at]
+
+        for email in emails:
+            body = email.get('body', None)
+            key = email.get('idempotency_key', None)
+
+            envelope = dict(email)
+            envelope.pop('idempotency_key', None)
+            lane = self._lane(email.get('priority', None))
+            key = _digest_key(key) if key is not None else ''
+
+            if self.body_threshold is None or body is None or len(body) < self.body_threshold:
+                args.extend([json.dumps(envelope), lane, '', key])
+                continue
+
+            del envelope['body']
+            args.extend([json.dumps(envelope), lane, _encode_body(body)[1], key])
+
+        pushed = self._push_many_script(keys=buckets + self._key_lanes, args=args)
+
+        if pushed < len(emails):
+            DUPLICATES.labels('push').inc(len(emails) - pushed)
+
+        return pushed
+
+    @connection_timeout_decorator()
+    def push(self, email):
+        return self._push_many([email]) == 1
+
+    @connection_timeout_decorator()
+    def push_many(self, emails):
+        if not emails:
+            return 0
+
+        return self._push_many(emails)
+
+    def _reserved(self, data):
+        """
+        Complete the emails which were sent already (see idempotency_key) and return the others as (email, token)
+        """
+
+        reserved = []
+        duplicates = []
+
+        for i in range(0, len(data), 4):
+            if data[i + 3] == 1:
+                duplicates.append(data[i])
+            else:
+                reserved.append((_decode_email(data[i + 1], data[i + 2]), data[i]))
+
+        if duplicates:
+            self._complete_many(duplicates)
+            DUPLICATES.labels('send').inc(len(duplicates))
+
+        return reserved, duplicates
+
+    def _reserve_many(self, n):
+        while 1:
+            buckets, _ = self._idempotency_buckets(self._key_sent)
+            keys = buckets + [self._key_lane_state, self._key_claim_cursors] + self._key_lanes
+            data = self._call(self._reserve_many_script, keys=keys,
+                              args=[n, _GROUP, self._consumer, self._lease_ms()] + self._weights)
+
+            reserved, duplicates = self._reserved(data)
+            if reserved or not duplicates:
+                return reserved
+
+    def _reserve_blocking(self, timeout):
+        """
+        Block on all lanes until an email is pushed, reading it for this consumer
+        """
+
+        self._ensure_groups()
+        response = self._redis.execute_command('XREADGROUP', 'GROUP', _GROUP, self._consumer, 'COUNT', 1,
+                                               'BLOCK', int(timeout * 1000), 'STREAMS',
+                                               *(self._key_lanes + ['>'] * len(self._key_lanes)))
+        if not response:
+            return []
+
+        key, items = response[0]
+        buckets, _ = self._idempotency_buckets(self._key_sent)
+        data = []
+
+        for id, flat in items:
+            fields = _fields(flat)
+            sent = fields['key'] and any(self._redis.sismember(bucket, fields['key']) for bucket in buckets)
+            data.extend(['%s:%s' % (self._key_lanes.index(key), id), fields['email'], fields['body'],
+                         1 if sent else 0])
+
+        return self._reserved(data)[0]
+
+    @staticmethod
+    def _wait(queues, timeout):
+        """
+        Block for up to timeout seconds (0 for no limit) until an email is pushed to any of the given queues, which
+        must share a redis instance. See DistributedQueue._wait.
+
+        The lanes are read with XREAD after the last entry delivered to the group, such that emails pushed before
+        blocking are seen as well, while the emails are left to reserve.
+        """
+
+        keys = []
+        for queue in queues:
+            queue._ensure_groups()
+            keys.extend(queue._key_lanes)
+
+        ids = [queue._last_delivered(key) for queue in queues for key in queue._key_lanes]
+        block = max(1, int(timeout * 1000)) if timeout else 0
+
+        return bool(queues[0]._redis.execute_command('XREAD', 'COUNT', 1, 'BLOCK', block, 'STREAMS', *(keys + ids)))
+
+    @connection_timeout_decorator()
+    def reserve(self, timeout=None):
+        """
+        Pops an email from the queue for processing. See DistributedQueue.reserve.
+
+        If no email is available and a timeout is given, then block on all lanes with XREADGROUP until an email is
+        pushed.
+        """
+
+        reserved = self._reserve_many(1)
+
+        if not reserved and timeout is not None:
+            reserved = self._reserve_blocking(timeout)
+
+        if not reserved:
+            raise DistributedQueueEmpty()
+
+        return reserved[0]
+
+    @connection_timeout_decorator()
+    def reserve_many(self, n):
+        reserved = self._reserve_many(n)
+        if not reserved:
+            raise DistributedQueueEmpty()
+
+        return reserved
+
+    def _complete_many(self, tokens):
+        buckets, expire_at = self._idempotency_buckets(self._key_sent)
+        return self._complete_many_script(keys=buckets[:1] + self._key_lanes,
+                                          args=[_GROUP, self._consumer, expire_at] + list(tokens))
+
+    @connection_timeout_decorator()
+    def complete(self, token):
+        removed = self._complete_many([token])
+
+        if removed != 1:
+            raise DistributedQueueException("Token not found")
+
+    @connection_timeout_decorator()
+    def complete_many(self, tokens):
+        if not tokens:
+            return
+
+        removed = self._complete_many(tokens)
+
+        if removed != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - removed, len(tokens)))
+
+    def _discard_many(self, tokens, reasons):
+        args = [_GROUP, self._consumer]
+        for token, reason in zip(tokens, reasons or [None] * len(tokens)):
+            args.extend([token, reason or ''])
+
+        return self._discard_many_script(keys=[self._key_discard] + self._key_lanes, args=args)
+
+    @connection_timeout_decorator()
+    def discard(self, token, reason=None):
+        moved = self._discard_many([token], [reason])
+
+        if moved != 1:
+            raise DistributedQueueException("Token not found")
+
+    @connection_timeout_decorator()
+    def discard_many(self, tokens, reasons=None):
+        if not tokens:
+            return
+
+        moved = self._discard_many(tokens, reasons)
+
+        if moved != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - moved, len(tokens)))
+
+    def _split(self, token):
+        lane, id = token.split(':', 1)
+        return self._key_lanes[int(lane)], id
+
+    @connection_timeout_decorator()
+    def extend_lease(self, token, lease_timeout=None):
+        """
+        Extend the lease of a reserved email to lease_timeout seconds from now (at most the queue's lease timeout).
+
+        Raises DistributedQueueException if the email is no longer reserved by this queue, e.g. if the lease expired
+        and the email was claimed by another worker.
+        """
+
+        if lease_timeout is None:
+            lease_timeout = self.lease_timeout
+
+        key, id = self._split(token)
+        idle = int(max(0, self.lease_timeout - lease_timeout) * 1000)
+
+        if self._call(self._extend_lease_script, keys=[key], args=[_GROUP, self._consumer, id, idle]) != 1:
+            raise DistributedQueueException("Token not found")
+
+    @connection_timeout_decorator()
+    def reap(self, batch_size=1000):
+        """
+        Trim the streams and remove idle consumers. Emails with an expired lease stay reserved until they are claimed
+        by the next reserve, such that the worker holding them can still complete them until they are claimed.
+
+        :return: the number of emails with an expired lease (at most batch_size per lane)
+        """
+
+        return self._call(self._reap_script, keys=self._key_lanes, args=[_GROUP, self._lease_ms(), batch_size])
+
+    def migrate(self, batch_size=1000):
+        """
+        No release stored emails as plain JSON in redis streams, so there is nothing to migrate. See
+        DistributedQueue.migrate.
+        """
+
+        return 0
+
+    @connection_timeout_decorator()
+    def retry_many(self, tokens, base_delay=_RETRY_BASE_DELAY, max_delay=_RETRY_MAX_DELAY,
+                   max_attempts=_RETRY_MAX_ATTEMPTS):
+        if not tokens:
+            return 0, 0
+
+        args = [_GROUP, self._consumer, time.time(), base_delay, max_delay, max_attempts]
+        for token in tokens:
+            args.extend([token, random.random()])
+
+        retried, discarded = self._retry_many_script(
+            keys=[self._key_retries, self._key_retrying, self._key_discard] + self._key_lanes, args=args)
+
+        if retried + discarded != len(tokens):
+            raise DistributedQueueException("%s of %s tokens not found" % (len(tokens) - retried - discarded,
+                                                                           len(tokens)))
+
+        return retried, discarded
+
+    @connection_timeout_decorator()
+    def promote(self, batch_size=1000):
+        promoted = 0
+        while 1:
+            moved = self._promote_script(keys=[self._key_retries, self._key_retrying] + self._key_lanes,
+                                         args=[time.time(), batch_size])
+
+            promoted += moved
+            if moved < batch_size:
+                return promoted
+
+    @connection_timeout_decorator()
+    def requeue(self, source='discard', filters=None, limit=None, chunk_size=1000):
+        """
+        Move discarded emails (or emails stuck in processing with an expired lease) back to the back of their lane.
+        See DistributedQueue.requeue.
+        """
+
+        filters = filters or []
+        args = []
+
+        for field, operator, value in filters:
+            if operator not in ('=', '~'):
+                raise DistributedQueueException("Unknown filter operator: %s" % operator)
+            args.extend([field, operator, value])
+
+        if source == 'discard':
+            calls = [(self._requeue_discarded_script, [self._key_discard] + self._key_lanes)]
+        elif source == 'processing':
+            calls = [(self._requeue_processing_script, [key]) for key in self._key_lanes]
+        else:
+            raise DistributedQueueException("Unknown source: %s" % source)
+
+        requeued = 0
+
+        for script, keys in calls:
+            start = '-'
+
+            while limit is None or requeued < limit:
+                last, examined, moved = self._call(
+                    script, keys=keys,
+                    args=[_GROUP, chunk_size if limit is None else limit - requeued, chunk_size, start,
+                          self._lease_ms()] + args)
+
+                requeued += moved
+                if examined < chunk_size:
+                    break
+                start = '(' + last
+
+        return requeued
+
+    def _scan_range(self, key, start, chunk_size):
+        """
+        :return: generator of (id, fields) of the entries in the stream after start
+        """
+
+        while 1:
+            items = self._redis.execute_command('XRANGE', key, start, '+', 'COUNT', chunk_size)
+            for id, flat in items:
+                yield id, _fields(flat)
+            if len(items) < chunk_size:
+                return
+            start = '(' + items[-1][0]
+
+    def _scan_pending(self, key, chunk_size):
+        start = '-'
+        while 1:
+            pending = self._redis.execute_command('XPENDING', key, _GROUP, start, '+', chunk_size)
+
+            pipeline = self._redis.pipeline(transaction=False)
+            for item in pending:
+                pipeline.execute_command('XRANGE', key, item[0], item[0])
+
+            for items in pipeline.execute():
+                for id, flat in items:
+                    yield id, _fields(flat)
+
+            if len(pending) < chunk_size:
+                return
+            start = '(' + pending[-1][0]
+
+    def _last_delivered(self, key):
+        for info in self._redis.execute_command('XINFO', 'GROUPS', key):
+            info = _fields(info)
+            if info['name'] == _GROUP:
+                return info['last-delivered-id']
+
+    def scan(self, source='queue', priority=None, chunk_size=1000):
+        """
+        Iterate over the emails in source. See DistributedQueue.scan.
+        """
+
+        self._ensure_groups()
+
+        if source == 'queue':
+            keys = self._key_lanes if priority is None else [self._key_lanes[self._lane(priority)]]
+            entries = [self._scan_range(key, '(' + self._last_delivered(key), chunk_size) for key in keys]
+        elif source == 'processing':
+            entries = [self._scan_pending(key, chunk_size) for key in self._key_lanes]
+        elif source == 'retrying':
+            entries = [self._scan_range(self._key_retrying, '-', chunk_size)]
+        elif source == 'discard':
+            entries = [self._scan_range(self._key_discard, '-', chunk_size)]
+        else:
+            raise DistributedQueueException("Unknown source: %s" % source)
+
+        for items in entries:
+            for id, fields in items:
+                yield _decode_email(fields['email'], fields['body'])
+
+    def _sizes(self):
+        """
+        :return: list of (queued, pending) number of emails per lane
+        """
+
+        self._ensure_groups()
+
+        pipeline = self._redis.pipeline(transaction=False)
+        for key in self._key_lanes:
+            pipeline.execute_command('XLEN', key)
+            pipeline.execute_command('XPENDING', key, _GROUP)
+
+        # Acknowledged emails are deleted, thus a stream holds the queued and the pending emails of its lane
+        results = pipeline.execute()
+        return [(length - summary[0], summary[0]) for length, summary in zip(results[::2], results[1::2])]
+
+    @connection_timeout_decorator()
+    def size(self, priority=None):
+        sizes = self._sizes()
+
+        if priority is not None:
+            return sizes[self._lane(priority)][0]
+
+        return sum(queued for queued, pending in sizes)
+
+    @connection_timeout_decorator()
+    def size_processing(self):
+        return sum(pending for queued, pending in self._sizes())
+
+    @connection_timeout_decorator()
+    def size_discarded(self):
+        return self._redis.execute_command('XLEN', self._key_discard)
+
+    @connection_timeout_decorator()
+    def size_retrying(self):
+        return self._redis.zcard(self._key_retries)
+
+    @connection_timeout_decorator()
+    def reset(self):
+        buckets = self._idempotency_buckets(self._key_submitted)[0] + self._idempotency_buckets(self._key_sent)[0]
+
+        self._redis.delete(self._key_discard, self._key_retrying, self._key_retries, self._key_lane_state,
+                           self._key_claim_cursors, *(buckets + self._key_lanes))
+        self._groups = False
@@ -0,0 +1,1032 @@
+import os
+import json
+import errno
+import time
+import unittest
+import shutil
+import tempfile
+import threading
+
+import redis
+
+from requeue import DistributedQueue, PartitionedQueue, DistributedQueueEmpty, DistributedQueueException, \
+    create_queue, _digest_key
+from streams import StreamQueue
+from sqlite import SQLiteQueue
+from ratelimit import RateLimiter
+from validation import EmailValidator
+from metrics import Registry, Counter, Histogram
+from groupcommit import GroupCommitter
+from spool import Spool
+import spool as spool_module
+
+RE_REDIS_URL = os.getenv('RE_REDIS_URL')
+if RE_REDIS_URL is None:
+    raise RuntimeError("RE_REDIS_URL environment variable must be set and point to the reliable-email redis cluster!")
+
+_asset_dummy_email = {
+    'subject': 'Test email',
+    'body': 'test test',
+    'to_email': 'example@example.org',
+    'from_email': 'example@example.org'
+}
+
+
+class DistributedQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = DistributedQueue(RE_REDIS_URL)
+        self.queue.namespace += "__TESTING"  # make sure we do not hit anything bad
+        self.queue.reset()
+
+    def test_reserve_complete(self):
+        self.queue.push(_asset_dummy_email)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(email, _asset_dummy_email)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 1)
+
+        self.queue.complete(token)
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_reserve_empty(self):
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve)
+
+    def test_reserve_blocking(self):
+        self.queue.push(_asset_dummy_email)
+
+        email, token = self.queue.reserve(timeout=1)
+        self.assertEqual(email, _asset_dummy_email)
+        self.assertEqual(self.queue.size_processing(), 1)
+
+    def test_reserve_blocking_empty(self):
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve, timeout=1)
+
+    def test_reserve_many(self):
+        for i in range(5):
+            self.queue.push(dict(_asset_dummy_email, subject='Test email %s' % i))
+
+        reserved = self.queue.reserve_many(3)
+        self.assertEqual([email['subject'] for email, token in reserved],
+                         ['Test email 0', 'Test email 1', 'Test email 2'])
+        self.assertEqual(self.queue.size(), 2)
+        self.assertEqual(self.queue.size_processing(), 3)
+
+        reserved += self.queue.reserve_many(3)
+        self.assertEqual(len(reserved), 5)
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve_many, 3)
+
+    def test_complete_and_discard_many(self):
+        for i in range(4):
+            self.queue.push(dict(_asset_dummy_email, subject='Test email %s' % i))
+
+        tokens = [token for email, token in self.queue.reserve_many(4)]
+
+        self.queue.complete_many(tokens[:2])
+        self.queue.discard_many(tokens[2:])
+
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 2)
+
+    def test_priority_lanes(self):
+        for i in range(20):
+            self.queue.push(dict(_asset_dummy_email, priority='bulk'))
+        for i in range(4):
+            self.queue.push(dict(_asset_dummy_email, priority='high'))
+
+        self.assertEqual(self.queue.size(), 24)
+        self.assertEqual(self.queue.size('bulk'), 20)
+        self.assertEqual(self.queue.size('high'), 4)
+
+        # high is weighted 16 to 1 over bulk, so all high priority emails are reserved within the first 5 emails
+        priorities = [email['priority'] for email, token in self.queue.reserve_many(5)]
+        self.assertEqual(priorities.count('high'), 4)
+        self.assertEqual(priorities.count('bulk'), 1)
+
+    def test_reserve_empty(self):
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve_many, 5)
+        self.assertEqual(self.queue.promote(), 0)
+
+        # Nothing is written when nothing is reserved or promoted
+        self.assertFalse(self.queue._redis.exists(self.queue._key_lane_state))
+        self.assertFalse(self.queue._redis.exists(self.queue._key_signal))
+
+    def test_priority_lane_reaped(self):
+        self.queue.push(dict(_asset_dummy_email, priority='high'))
+
+        self.queue.lease_timeout = -1
+        self.queue.reserve()
+        self.queue.reap()
+
+        self.assertEqual(self.queue.size('high'), 1)
+
+    def test_unknown_priority(self):
+        self.assertRaises(DistributedQueueException, self.queue.push, dict(_asset_dummy_email, priority='unknown'))
+
+    def test_duplicate_payloads(self):
+        self.queue.push(_asset_dummy_email)
+        self.queue.push(_asset_dummy_email)
+
+        (email_a, token_a), (email_b, token_b) = self.queue.reserve_many(2)
+        self.assertNotEqual(token_a, token_b)
+
+        self.queue.complete(token_a)
+        self.assertEqual(self.queue.size_processing(), 1)
+        self.assertRaises(DistributedQueueException, self.queue.complete, token_a)
+
+        self.queue.discard(token_b)
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+    def test_reap_expired_lease(self):
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1  # reserve with an already expired lease
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.reap(), 1)
+
+        self.assertEqual(self.queue.size(), 1)
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+
+    def test_reap_active_lease(self):
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1
+        email, token = self.queue.reserve()
+        self.queue.extend_lease(token, 60)
+
+        self.assertEqual(self.queue.reap(), 0)
+        self.assertEqual(self.queue.size_processing(), 1)
+
+        self.queue.complete(token)
+        self.assertRaises(DistributedQueueException, self.queue.extend_lease, token)
+
+    def test_reserved_again_after_reap(self):
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1
+        email, token = self.queue.reserve()
+        self.queue.reap()
+
+        # The email is reserved by another worker, after which the token of the expired lease is rejected
+        email, other_token = self.queue.reserve()
+        self.assertNotEqual(other_token, token)
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+        self.assertRaises(DistributedQueueException, self.queue.discard, token)
+        self.assertRaises(DistributedQueueException, self.queue.retry_many, [token])
+        self.assertRaises(DistributedQueueException, self.queue.extend_lease, token)
+
+        self.queue.complete(other_token)
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_reap_batches(self):
+        for i in range(5):
+            self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1
+        self.queue.reserve_many(5)
+
+        self.assertEqual(self.queue.reap(batch_size=2), 5)
+        self.assertEqual(self.queue.size(), 5)
+
+    def test_idempotency_key(self):
+        email = dict(_asset_dummy_email, idempotency_key='order-1')
+
+        self.assertTrue(self.queue.push(email))
+        self.assertFalse(self.queue.push(email))
+        self.assertEqual(self.queue.push_many([email, dict(email, idempotency_key='order-2'), email]), 1)
+        self.assertEqual(self.queue.size(), 2)
+
+        reserved, token = self.queue.reserve()
+        self.assertNotIn('idempotency_key', reserved)
+
+    def test_idempotency_key_sent(self):
+        self.queue.push(dict(_asset_dummy_email, idempotency_key='order-1'))
+
+        # The lease expires while the email is sent, such that the email is reaped before it is completed
+        self.queue.lease_timeout = -1
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.reap(), 1)
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+
+        # The reaped email is completed without being returned, as its key was sent
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_scan(self):
+        large_email = dict(_asset_dummy_email, body='x' * 2048)
+        high_email = dict(_asset_dummy_email, priority='high')
+
+        self.queue.push_many([_asset_dummy_email, large_email, high_email, _asset_dummy_email])
+        email, token = self.queue.reserve()
+        self.queue.discard(token)
+
+        self.assertEqual(sorted(self.queue.scan(chunk_size=2)), sorted([_asset_dummy_email, large_email,
+                                                                        _asset_dummy_email]))
+        self.assertEqual(list(self.queue.scan(priority='high')), [])
+        self.assertEqual(list(self.queue.scan('discard')), [high_email])
+        self.assertEqual(list(self.queue.scan('processing')), [])
+
+    def test_requeue_discarded(self):
+        emails = [dict(_asset_dummy_email, to_email='%s@%s' % (i, 'Example.org' if i % 2 else 'example.com'))
+                  for i in range(6)]
+        self.queue.push_many(emails)
+
+        tokens = [token for email, token in self.queue.reserve_many(6)]
+        self.queue.discard_many(tokens[:5], ['Rejected by backend: SendGridClientError'] * 4 + ['Body is empty'])
+        self.queue.discard(tokens[5])
+
+        filters = [('to_domain', '=', 'example.org'), ('reason', '~', 'sendgrid')]
+        self.assertEqual(self.queue.requeue(filters=filters, chunk_size=2), 2)
+        self.assertEqual(self.queue.requeue(filters=filters), 0)
+        self.assertEqual(self.queue.size(), 2)
+        self.assertEqual(self.queue.size_discarded(), 4)
+
+        self.assertEqual(self.queue.requeue(limit=3, chunk_size=2), 3)
+        self.assertEqual(self.queue.size(), 5)
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+    def test_requeue_processing(self):
+        stuck_email = dict(_asset_dummy_email, subject='Stuck')
+        self.queue.push_many([stuck_email, _asset_dummy_email, stuck_email, _asset_dummy_email])
+
+        self.queue.reserve()  # held by a live worker
+        self.queue.lease_timeout = -1
+        self.queue.reserve_many(3)
+
+        # Only emails with an expired lease are requeued, as the others may still be sent by the worker holding them
+        self.assertEqual(self.queue.requeue('processing', [('subject', '=', 'stuck')], chunk_size=1), 1)
+        self.assertEqual(self.queue.size_processing(), 3)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(email['subject'], 'Stuck')
+        self.queue.complete(token)
+
+        self.assertEqual(self.queue.requeue('processing', chunk_size=1), 2)
+        self.assertEqual(self.queue.size_processing(), 1)
+
+    def test_retry(self):
+        self.queue.push(_asset_dummy_email)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.retry_many([token], base_delay=0.1), (1, 0))
+
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_retrying(), 1)
+        self.assertEqual(self.queue.promote(), 0)  # not due yet
+
+        time.sleep(0.2)
+        self.assertEqual(self.queue.promote(), 1)
+        self.assertEqual(self.queue.size_retrying(), 0)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(email, _asset_dummy_email)
+        self.queue.complete(token)
+
+    def test_retry_max_attempts(self):
+        self.queue.push(_asset_dummy_email)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.retry_many([token], base_delay=0, max_attempts=2), (1, 0))
+        self.queue.promote()
+
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.retry_many([token], base_delay=0, max_attempts=2), (0, 1))
+
+        self.assertEqual(self.queue.size_retrying(), 0)
+        self.assertEqual(self.queue.size_discarded(), 1)
+        self.assertRaises(DistributedQueueException, self.queue.retry_many, [token])
+
+    def test_stored_body(self):
+        large_email = dict(_asset_dummy_email, body=u'Large body \u00e6\u00f8\u00e5 ' * 1000)
+
+        self.queue.push_many([large_email, large_email])
+        self.queue.push(large_email)
+        self.assertEqual(self.queue._redis.hlen(self.queue._key_bodies), 1)
+
+        reserved = self.queue.reserve_many(3)
+        self.assertEqual([email for email, token in reserved], [large_email] * 3)
+
+        self.queue.complete_many([token for email, token in reserved[:2]])
+        self.assertEqual(self.queue._redis.hlen(self.queue._key_bodies), 1)
+
+        self.queue.complete(reserved[2][1])
+        self.assertEqual(self.queue._redis.hlen(self.queue._key_bodies), 0)
+        self.assertEqual(self.queue._redis.hlen(self.queue._key_body_counts), 0)
+
+    def test_legacy_queue(self):
+        # Releases before ids were introduced queued emails as plain JSON
+        self.queue._redis.lpush(self.queue._key_queue, json.dumps(dict(_asset_dummy_email, subject='Legacy')))
+        self.queue.push(_asset_dummy_email)
+
+        reserved = self.queue.reserve_many(2)
+        self.assertEqual([email['subject'] for email, token in reserved], ['Legacy', 'Test email'])
+
+        self.queue.complete_many([token for email, token in reserved])
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue._redis.hlen(self.queue._key_payloads), 0)
+
+    def test_migrate(self):
+        # Releases before ids were introduced kept reserved emails as plain JSON in a processing list
+        self.queue._redis.lpush(self.queue._key_processing, json.dumps(_asset_dummy_email))
+        self.queue.push(_asset_dummy_email)
+
+        self.assertRaises(redis.ResponseError, self.queue.reserve)
+        self.assertEqual(self.queue.size(), 1)
+
+        self.assertEqual(self.queue.migrate(), 1)
+        self.assertEqual(self.queue.migrate(), 0)
+
+        self.assertEqual([email for email, token in self.queue.reserve_many(3)], [_asset_dummy_email] * 2)
+        self.assertEqual(self.queue.size_processing(), 2)
+
+    def test_legacy_large_body(self):
+        # Releases before bodies were stored separately kept large bodies inline in the queued JSON
+        large_email = dict(_asset_dummy_email, body=u'Large body \u00e6\u00f8\u00e5 ' * 1000)
+        self.queue._redis.lpush(self.queue._key_queue, json.dumps(large_email))
+
+        self.assertEqual(list(self.queue.scan()), [large_email])
+
+        email, token = self.queue.reserve()
+        self.assertEqual(email, large_email)
+        self.assertEqual(list(self.queue.scan('processing')), [large_email])
+
+        self.queue.complete(token)
+        self.assertEqual(self.queue._redis.hlen(self.queue._key_payloads), 0)
+
+    def test_legacy_discard(self):
+        # Releases before ids were introduced discarded emails as plain JSON
+        large_email = dict(_asset_dummy_email, to_email='large@example.com', body='x' * 2048)
+        self.queue._redis.lpush(self.queue._key_discard, json.dumps(_asset_dummy_email), json.dumps(large_email))
+
+        self.assertEqual(sorted(self.queue.scan('discard')), sorted([_asset_dummy_email, large_email]))
+
+        self.assertEqual(self.queue.requeue('discard', [('to_domain', '=', 'example.com')]), 1)
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(email, large_email)
+
+        self.queue.discard(token)
+        self.assertEqual(sorted(self.queue.scan('discard')), sorted([_asset_dummy_email, large_email]))
+
+    def test_complete_many_unknown_token(self):
+        self.assertRaises(DistributedQueueException, self.queue.complete_many, ['unknown'])
+
+
+def _assert_reserve_wakes(test, queue):
+    # A blocking reserve wakes as soon as an email is pushed to any partition
+    for i in range(len(queue._partitions)):
+        timer = threading.Timer(0.2, queue._partitions[i].push, args=(_asset_dummy_email,))
+        timer.start()
+
+        started = time.time()
+        email, token = queue.reserve(timeout=10)
+        timer.join()
+
+        test.assertTrue(token.startswith('%s:' % i))
+        test.assertTrue(time.time() - started < 5)
+        queue.complete(token)
+
+
+class PartitionedQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = PartitionedQueue(RE_REDIS_URL, 4)
+        self.queue.namespace += "__TESTING"  # make sure we do not hit anything bad
+        self.queue.reset()
+
+    def test_push_spreads_partitions(self):
+        for i in range(8):
+            self.queue.push(_asset_dummy_email)
+
+        self.assertEqual(self.queue.size(), 8)
+        self.assertEqual([partition.size() for partition in self.queue._partitions], [2, 2, 2, 2])
+
+    def test_reserve_steals_work(self):
+        for i in range(4):
+            # Whichever partition we start from, the email is found
+            self.queue.reset()
+            self.queue._partitions[2].push(_asset_dummy_email)
+
+            email, token = self.queue.reserve()
+            self.assertTrue(token.startswith('2:'))
+
+            self.queue.complete(token)
+            self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_batches(self):
+        self.queue.push_many([_asset_dummy_email] * 3)
+        self.queue.push_many([_asset_dummy_email] * 3)
+
+        tokens = [token for email, token in self.queue.reserve_many(3) + self.queue.reserve_many(3)]
+        self.assertEqual(self.queue.size_processing(), 6)
+
+        self.queue.complete_many(tokens[:4])
+        self.queue.discard_many(tokens[4:])
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 2)
+
+    def test_complete_many_expired_lease(self):
+        self.queue.push(_asset_dummy_email)
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1
+        tokens = [token for email, token in self.queue.reserve_many(1) + self.queue.reserve_many(1)]
+        self.queue._partitions[int(tokens[0].split(':')[0])].reap()
+        self.queue.reserve()
+
+        # The other partition's email is completed, although the first email was reaped and reserved again
+        self.assertRaises(DistributedQueueException, self.queue.complete_many, tokens)
+        self.assertEqual(self.queue.size_processing(), 1)
+
+    def test_idempotency_key(self):
+        emails = [dict(_asset_dummy_email, idempotency_key='order-%s' % (i % 4)) for i in range(8)]
+
+        # Duplicates are pushed to the same partition, whichever partition the batch starts from
+        self.assertEqual(self.queue.push_many(emails), 4)
+        self.assertEqual(self.queue.push_many(emails), 0)
+        self.assertEqual(self.queue.size(), 4)
+
+    def test_reserve_empty(self):
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve)
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve, timeout=1)
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve_many, 2)
+
+    def test_reserve_blocking(self):
+        _assert_reserve_wakes(self, self.queue)
+
+    def test_reserve_blocking_instances(self):
+        # Partitions on several redis instances are blocked on in turn
+        queue = PartitionedQueue([RE_REDIS_URL, RE_REDIS_URL + '/0'], 4, namespace=self.queue.namespace)
+        self.assertEqual(queue._servers, [[0, 2], [1, 3]])
+
+        _assert_reserve_wakes(self, queue)
+        self.assertRaises(DistributedQueueEmpty, queue.reserve, timeout=1)
+
+
+class StreamQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = StreamQueue(RE_REDIS_URL)
+        self.queue.namespace += "__TESTING"  # make sure we do not hit anything bad
+        self.queue.reset()
+
+    def test_create_queue(self):
+        scheme, rest = RE_REDIS_URL.split('://', 1)
+
+        self.assertIsInstance(create_queue(RE_REDIS_URL), DistributedQueue)
+        self.assertIsInstance(create_queue(RE_REDIS_URL, engine='streams'), StreamQueue)
+        self.assertIsInstance(create_queue('%s+streams://%s' % (scheme, rest)), StreamQueue)
+        self.assertIsInstance(create_queue('%s+streams://%s' % (scheme, rest), 2)._partitions[1], StreamQueue)
+
+    def test_reserve_complete(self):
+        self.queue.push(_asset_dummy_email)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(email, _asset_dummy_email)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 1)
+
+        self.queue.complete(token)
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+
+    def test_reserve_blocking(self):
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve, timeout=0.1)
+
+        self.queue.push(_asset_dummy_email)
+        email, token = self.queue.reserve(timeout=1)
+        self.assertEqual(email, _asset_dummy_email)
+
+    def test_partitioned_reserve_blocking(self):
+        queue = PartitionedQueue(RE_REDIS_URL, 3, namespace=self.queue.namespace, engine=StreamQueue)
+        queue.reset()
+
+        _assert_reserve_wakes(self, queue)
+
+    def test_reserve_many(self):
+        large_email = dict(_asset_dummy_email, body=u'Large body \u00e6\u00f8\u00e5 ' * 1000)
+        self.queue.push_many([dict(_asset_dummy_email, subject='Test email %s' % i) for i in range(4)] +
+                             [large_email])
+
+        reserved = self.queue.reserve_many(3)
+        self.assertEqual([email['subject'] for email, token in reserved],
+                         ['Test email 0', 'Test email 1', 'Test email 2'])
+        self.assertEqual(self.queue.size(), 2)
+        self.assertEqual(self.queue.size_processing(), 3)
+
+        reserved = self.queue.reserve_many(3)
+        self.assertEqual(reserved[1][0], large_email)
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve_many, 3)
+
+    def test_complete_and_discard_many(self):
+        self.queue.push_many([_asset_dummy_email] * 4)
+        tokens = [token for email, token in self.queue.reserve_many(4)]
+
+        self.queue.complete_many(tokens[:2])
+        self.queue.discard_many(tokens[2:], ['Body is empty', None])
+
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 2)
+        self.assertRaises(DistributedQueueException, self.queue.complete_many, tokens[2:] + ['unknown'])
+
+    def test_priority_lanes(self):
+        self.queue.push_many([dict(_asset_dummy_email, priority='bulk')] * 20)
+        self.queue.push_many([dict(_asset_dummy_email, priority='high')] * 4)
+
+        self.assertEqual(self.queue.size(), 24)
+        self.assertEqual(self.queue.size('bulk'), 20)
+        self.assertEqual(self.queue.size('high'), 4)
+
+        # high is weighted 16 to 1 over bulk, so all high priority emails are reserved within the first 5 emails
+        priorities = [email['priority'] for email, token in self.queue.reserve_many(5)]
+        self.assertEqual(priorities.count('high'), 4)
+        self.assertEqual(priorities.count('bulk'), 1)
+
+    def test_priority_lanes_empty(self):
+        self.queue.push_many([dict(_asset_dummy_email, priority='normal')] * 20)
+        for i in range(4):
+            self.queue.reserve_many(5)
+
+        # The bulk lane earns no credit while it is empty, such that it gets no more than its share afterwards
+        self.queue.push_many([dict(_asset_dummy_email, priority='normal')] * 20)
+        self.queue.push_many([dict(_asset_dummy_email, priority='bulk')] * 20)
+
+        priorities = [email['priority'] for email, token in self.queue.reserve_many(5)]
+        self.assertEqual(priorities.count('normal'), 4)
+        self.assertEqual(priorities.count('bulk'), 1)
+
+    def test_reserve_claims_expired_lease(self):
+        self.queue.push(dict(_asset_dummy_email, priority='high'))
+
+        self.queue.lease_timeout = -1
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.reap(), 1)
+
+        # Another worker claims the email, after which the first worker can not extend its lease
+        other = StreamQueue(RE_REDIS_URL, namespace=self.queue.namespace, lease_timeout=0)
+        email, other_token = other.reserve()
+        self.assertRaises(DistributedQueueException, self.queue.extend_lease, token)
+
+        other.complete(other_token)
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+
+    def test_reserve_claims_behind_active_leases(self):
+        active = StreamQueue(RE_REDIS_URL, namespace=self.queue.namespace)
+        self.queue.push_many([_asset_dummy_email] * 20)
+        tokens = [token for email, token in active.reserve_many(20)]
+
+        self.queue.push(dict(_asset_dummy_email, subject='Expired'))
+        self.queue.reserve()
+
+        other = StreamQueue(RE_REDIS_URL, namespace=self.queue.namespace, lease_timeout=0.05)
+        time.sleep(0.1)
+        for token in tokens:
+            active.extend_lease(token)
+
+        # Each reserve examines up to 10 entries per email, and the next reserve resumes after them
+        subjects = []
+        for i in range(3):
+            try:
+                subjects.extend(email['subject'] for email, token in other.reserve_many(1))
+            except DistributedQueueEmpty:
+                pass
+
+        self.assertEqual(subjects, ['Expired'])
+
+    def test_stale_token_rejected(self):
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1
+        email, token = self.queue.reserve()
+
+        # The email is claimed by another worker, which the first worker can not take it away from
+        other = StreamQueue(RE_REDIS_URL, namespace=self.queue.namespace, lease_timeout=0)
+        email, other_token = other.reserve()
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+        self.assertRaises(DistributedQueueException, self.queue.discard, token)
+        self.assertRaises(DistributedQueueException, self.queue.retry_many, [token])
+        self.assertEqual(self.queue.size_processing(), 1)
+        self.assertEqual(self.queue.size_discarded(), 0)
+        self.assertEqual(self.queue.size_retrying(), 0)
+
+        other.complete(other_token)
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_reap_active_lease(self):
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = 0.05
+        email, token = self.queue.reserve()
+        time.sleep(0.1)
+        self.queue.extend_lease(token)
+
+        self.assertEqual(self.queue.reap(), 0)
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve)
+
+    def test_idempotency_key(self):
+        email = dict(_asset_dummy_email, idempotency_key='order-1')
+        self.assertEqual(self.queue.push_many([email, email, dict(email, idempotency_key='order-2')]), 2)
+        self.assertFalse(self.queue.push(email))
+
+        # An email whose key was sent after it was pushed (e.g. by another partition) is completed without being
+        # returned
+        email, token = self.queue.reserve()
+        self.queue._redis.sadd(self.queue._idempotency_buckets(self.queue._key_sent)[0][0], _digest_key('order-2'))
+        self.queue.complete(token)
+
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_scan(self):
+        high_email = dict(_asset_dummy_email, priority='high')
+
+        self.queue.push_many([_asset_dummy_email, high_email, _asset_dummy_email])
+        email, token = self.queue.reserve()
+        self.queue.discard(token)
+
+        self.assertEqual(list(self.queue.scan(chunk_size=1)), [_asset_dummy_email] * 2)
+        self.assertEqual(list(self.queue.scan('discard')), [high_email])
+
+        email, token = self.queue.reserve()
+        self.assertEqual(list(self.queue.scan('processing')), [_asset_dummy_email])
+        self.assertEqual(list(self.queue.scan()), [_asset_dummy_email])
+
+    def test_requeue(self):
+        self.queue.push_many([dict(_asset_dummy_email, subject='Test email %s' % i) for i in range(4)])
+        tokens = [token for email, token in self.queue.reserve_many(4)]
+
+        self.queue.discard_many(tokens[:3], ['Rejected by backend: SendGridClientError'] * 2 + ['Body is empty'])
+        self.assertEqual(self.queue.requeue(filters=[('reason', '~', 'sendgrid')], chunk_size=1), 2)
+        self.assertEqual(self.queue.size(), 2)
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+        # Only emails with an expired lease are requeued
+        self.assertEqual(self.queue.requeue('processing', [('subject', '=', 'test email 3')]), 0)
+        self.queue.lease_timeout = 0
+        self.assertEqual(self.queue.requeue('processing', [('subject', '=', 'test email 3')]), 1)
+        self.assertEqual(self.queue.size(), 3)
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_retry(self):
+        self.queue.push(dict(_asset_dummy_email, priority='bulk'))
+
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.retry_many([token], base_delay=0.1, max_attempts=2), (1, 0))
+        self.assertEqual(self.queue.size_retrying(), 1)
+        self.assertEqual(self.queue.promote(), 0)  # not due yet
+
+        time.sleep(0.2)
+        self.assertEqual(self.queue.promote(), 1)
+        self.assertEqual(self.queue.size('bulk'), 1)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.retry_many([token], max_attempts=2), (0, 1))
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+
+class SQLiteQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'queue.db')
+        self.queue = SQLiteQueue(self.url)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_create_queue(self):
+        self.assertIsInstance(create_queue(self.url), SQLiteQueue)
+        self.assertIsInstance(create_queue(self.url, 2)._partitions[1], SQLiteQueue)
+
+    def test_reserve_complete(self):
+        large_email = dict(_asset_dummy_email, body=u'Large body \u00e6\u00f8\u00e5 ' * 1000)
+        self.queue.push_many([_asset_dummy_email, large_email])
+
+        reserved = self.queue.reserve_many(3)
+        self.assertEqual([email for email, token in reserved], [_asset_dummy_email, large_email])
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 2)
+
+        self.queue.complete(reserved[0][1])
+        self.queue.discard_many([reserved[1][1]], ['Body is empty'])
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 1)
+        self.assertRaises(DistributedQueueException, self.queue.complete_many, [reserved[0][1], 'unknown'])
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve, timeout=0.1)
+
+    def test_partitioned_reserve_blocking(self):
+        _assert_reserve_wakes(self, create_queue(self.url, 3))
+
+    def test_priority_lanes(self):
+        self.queue.push_many([dict(_asset_dummy_email, priority='bulk')] * 20)
+        self.queue.push_many([dict(_asset_dummy_email, priority='high')] * 4)
+        self.assertEqual(self.queue.size('bulk'), 20)
+
+        # high is weighted 16 to 1 over bulk, so all high priority emails are reserved within the first 5 emails
+        priorities = [email['priority'] for email, token in self.queue.reserve_many(5)]
+        self.assertEqual(priorities.count('high'), 4)
+        self.assertEqual(priorities.count('bulk'), 1)
+
+    def test_priority_lanes_empty(self):
+        self.queue.push_many([dict(_asset_dummy_email, priority='normal')] * 20)
+        for i in range(4):
+            self.queue.reserve_many(5)
+
+        # The bulk lane earns no credit while it is empty, such that it gets no more than its share afterwards
+        self.queue.push_many([dict(_asset_dummy_email, priority='normal')] * 20)
+        self.queue.push_many([dict(_asset_dummy_email, priority='bulk')] * 20)
+
+        priorities = [email['priority'] for email, token in self.queue.reserve_many(5)]
+        self.assertEqual(priorities.count('normal'), 4)
+        self.assertEqual(priorities.count('bulk'), 1)
+
+    def test_reserve_empty(self):
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve_many, 5)
+
+        # Nothing is written when nothing is reserved
+        self.assertEqual(self.queue._connection().execute('SELECT count(*) FROM lane_state').fetchone()[0], 0)
+
+    def test_reserved_again_after_reap(self):
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1
+        email, token = self.queue.reserve()
+        self.queue.reap()
+
+        # The email is reserved by another worker, after which the token of the expired lease is rejected
+        email, other_token = self.queue.reserve()
+        self.assertNotEqual(other_token, token)
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+        self.assertRaises(DistributedQueueException, self.queue.discard, token)
+        self.assertRaises(DistributedQueueException, self.queue.retry_many, [token])
+        self.assertRaises(DistributedQueueException, self.queue.extend_lease, token)
+
+        self.queue.complete(other_token)
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_concurrent_reserve(self):
+        self.queue.push_many([dict(_asset_dummy_email, subject='Test email %s' % i) for i in range(200)])
+        reserved = []
+
+        # Each thread uses a connection of its own, as each process does
+        def reserve():
+            while 1:
+                try:
+                    reserved.extend(self.queue.reserve_many(7))
+                except DistributedQueueEmpty:
+                    return
+
+        threads = [threading.Thread(target=reserve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(email['subject'] for email, token in reserved)), 200)
+        self.assertEqual(len(reserved), 200)
+
+    def test_reap_expired_lease(self):
+        self.queue.push(_asset_dummy_email)
+
+        self.queue.lease_timeout = -1
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.reap(batch_size=1), 1)
+        self.assertRaises(DistributedQueueException, self.queue.extend_lease, token)
+
+        email, token = self.queue.reserve()
+        self.queue.extend_lease(token, 60)
+        self.assertEqual(self.queue.reap(), 0)
+
+    def test_idempotency_key(self):
+        email = dict(_asset_dummy_email, idempotency_key='order-1')
+        self.assertEqual(self.queue.push_many([email, email]), 1)
+        self.assertFalse(self.queue.push(email))
+
+        # The lease expires while the email is sent, such that the reaped email is completed without being returned
+        self.queue.lease_timeout = -1
+        reserved, token = self.queue.reserve()
+        self.assertNotIn('idempotency_key', reserved)
+        self.queue.reap()
+        self.assertRaises(DistributedQueueException, self.queue.complete, token)
+
+        self.assertRaises(DistributedQueueEmpty, self.queue.reserve)
+        self.assertEqual(self.queue.size(), 0)
+
+    def test_scan_and_requeue(self):
+        self.queue.push_many([dict(_asset_dummy_email, to_email='%s@example.%s' % (i, 'org' if i % 2 else 'com'))
+                              for i in range(4)])
+        tokens = [token for email, token in self.queue.reserve_many(4)]
+        self.queue.discard_many(tokens[:3], ['Rejected by backend: SendGridClientError'] * 3)
+
+        self.assertEqual(len(list(self.queue.scan('discard', chunk_size=2))), 3)
+        self.assertEqual(self.queue.requeue(filters=[('to_domain', '=', 'Example.org')], chunk_size=1), 1)
+        self.assertEqual(self.queue.requeue('processing', [('reason', '~', 'sendgrid')]), 0)
+        self.assertEqual(self.queue.requeue('processing'), 0)  # the lease has not expired
+
+        self.queue.extend_lease(tokens[3], -1)
+        self.assertEqual(self.queue.requeue('processing'), 1)
+        self.assertEqual(list(self.queue.scan(chunk_size=1)), [dict(_asset_dummy_email, to_email='1@example.org'),
+                                                               dict(_asset_dummy_email, to_email='3@example.org')])
+
+    def test_retry(self):
+        self.queue.push(_asset_dummy_email)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.retry_many([token], base_delay=0.1, max_attempts=2), (1, 0))
+        self.assertEqual(self.queue.size_retrying(), 1)
+        self.assertEqual(self.queue.promote(), 0)  # not due yet
+
+        time.sleep(0.2)
+        self.assertEqual(self.queue.promote(), 1)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(self.queue.retry_many([token], max_attempts=2), (0, 1))
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+
+class GroupCommitterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = DistributedQueue(RE_REDIS_URL)
+        self.queue.namespace += "__TESTING"  # make sure we do not hit anything bad
+        self.queue.reset()
+
+    def test_push(self):
+        committer = GroupCommitter(self.queue, window=0.01)
+
+        threads = [threading.Thread(target=committer.push, args=(dict(_asset_dummy_email),)) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.queue.size(), 20)
+
+    def test_push_failure(self):
+        committer = GroupCommitter(DistributedQueue('redis://localhost:1'))
+
+        self.assertRaises(redis.ConnectionError, committer.push, dict(_asset_dummy_email))
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        self.queue = DistributedQueue(RE_REDIS_URL)
+        self.queue.namespace += "__TESTING"  # make sure we do not hit anything bad
+        self.queue.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_drain(self):
+        spool = Spool(self.directory)
+        spool.append(_asset_dummy_email)
+        spool.append_many([_asset_dummy_email, _asset_dummy_email])
+
+        self.assertEqual(spool.depth, 3)
+        self.assertEqual(spool.drain(self.queue, batch_size=2), 3)
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(self.queue.size(), 3)
+
+        email, token = self.queue.reserve()
+        self.assertEqual(email, _asset_dummy_email)
+
+    def test_drain_failure(self):
+        spool = Spool(self.directory)
+        spool.append(_asset_dummy_email)
+
+        self.assertRaises(redis.ConnectionError, spool.drain, DistributedQueue('redis://localhost:1'))
+        self.assertEqual(spool.depth, 1)
+
+    def test_recover(self):
+        spool = Spool(self.directory)
+        spool.append_many([_asset_dummy_email, _asset_dummy_email])
+        spool.close()
+
+        with open(os.path.join(self.directory, 'spool.ndjson'), 'ab') as spool_file:
+            spool_file.write('{"subject": "partial')  # crashed while appending
+
+        spool = Spool(self.directory)
+        self.assertEqual(spool.depth, 2)
+        self.assertRaises(RuntimeError, Spool, self.directory)
+
+        self.assertEqual(spool.drain(self.queue), 2)
+        spool.close()
+
+    def test_recover_chunks(self):
+        spool = Spool(self.directory)
+        spool.append_many([dict(_asset_dummy_email, subject='Test email %s' % i) for i in range(10)])
+        spool._write_offset(spool._read(4)[1])  # drained up to the fifth email
+        spool.close()
+
+        chunk_size = spool_module._RECOVER_CHUNK_SIZE
+        spool_module._RECOVER_CHUNK_SIZE = 7
+        try:
+            spool = Spool(self.directory)
+        finally:
+            spool_module._RECOVER_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(spool.depth, 6)
+        self.assertEqual(spool._read(1)[0][0]['subject'], 'Test email 4')
+        spool.close()
+
+    def test_append_failure(self):
+        spool = Spool(self.directory)
+        spool.append(_asset_dummy_email)
+
+        write = os.write
+
+        def partial_write(fd, data):
+            write(fd, data[:10])
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+        os.write = partial_write
+        try:
+            self.assertRaises(OSError, spool.append_many, [_asset_dummy_email] * 2)
+        finally:
+            os.write = write
+
+        # The partially written emails are dropped, such that the spool stays readable
+        spool.append(_asset_dummy_email)
+        self.assertEqual(spool.depth, 2)
+        self.assertEqual(spool.drain(self.queue), 2)
+        spool.close()
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_rate(self):
+        limiter = RateLimiter(RE_REDIS_URL, 'test', 20, namespace='reliableemail__TESTING')
+        limiter.reset()
+
+        start = time.time()
+        for i in range(5):
+            limiter.acquire()
+
+        self.assertTrue(time.time() - start >= 0.2 - 0.01)
+
+    def test_burst(self):
+        limiter = RateLimiter(RE_REDIS_URL, 'test', 1, burst=5, namespace='reliableemail__TESTING')
+        limiter.reset()
+
+        for i in range(5):
+            self.assertEqual(limiter.acquire(), 0)
+
+        self.assertTrue(limiter.acquire() > 0.5)
+
+
+class EmailValidatorTest(unittest.TestCase):
+
+    def test_validate_email(self):
+        validator = EmailValidator()
+
+        self.assertEqual(validator.validate_email(dict(_asset_dummy_email)), (True, ''))
+        self.assertFalse(validator.validate_email(dict(_asset_dummy_email, subject=' '))[0])
+        self.assertFalse(validator.validate_email(dict(_asset_dummy_email, to_email='example@eample'))[0])
+        self.assertFalse(validator.validate_email(dict(_asset_dummy_email, from_email='example'))[0])
+
+    def test_cache(self):
+        validator = EmailValidator(cache_size=2)
+
+        validator.validate_emails([dict(_asset_dummy_email) for _ in range(3)])
+        self.assertEqual(validator.misses, 1)
+        self.assertEqual(validator.hits, 5)
+
+        validator.parse_address('a@example.org')
+        validator.parse_address('b@example.org')  # evicts example@example.org
+        validator.parse_address('example@example.org')
+        self.assertEqual(validator.misses, 4)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_expose(self):
+        registry = Registry()
+        counter = Counter('test_total', 'Test counter', ['backend'], registry=registry)
+        histogram = Histogram('test_seconds', 'Test histogram', registry=registry, buckets=(0.1, 1))
+
+        counter.labels('dummy').inc()
+        counter.labels('dummy').inc(2)
+        histogram.observe(0.5)
+
+        output = registry.expose()
+
+        self.assertIn('# TYPE test_total counter', output)
+        self.assertIn('test_total{backend="dummy"} 3.0', output)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0', output)
+        self.assertIn('test_seconds_bucket{le="1"} 1', output)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 1', output)
+        self.assertIn('test_seconds_count 1', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
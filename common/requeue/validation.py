@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict
+
+from flanker.addresslib import address
+
+
+class EmailValidator(object):
+
+    def __init__(self, cache_size=10000):
+        """
+        Validates emails, caching the results of parsing addresses in a bounded LRU cache.
+
+        Parsing addresses is expensive, while most emails share a handful of sender addresses.
+        The cache is thread safe. hits and misses count the lookups in the cache.
+        """
+
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def parse_address(self, value):
+        """
+        :return: the parsed address, or None if value is not a valid address
+        """
+
+        with self._lock:
+            try:
+                parsed = self._cache.pop(value)
+            except KeyError:
+                pass
+            else:
+                self._cache[value] = parsed  # most recently used
+                self.hits += 1
+                return parsed
+
+        # We use mailgun's flanker (https://github.com/mailgun/flanker) for the heavy lifting
+        parsed = address.parse(value, addr_spec_only=True)
+
+        with self._lock:
+            self.misses += 1
+            self._cache[value] = parsed
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return parsed
+
+    def validate_email(self, email):
+        """
+        Validate well-formness of email
+
+        E.g. that subject and body are non-empty, and to and from email addresses are valid.
+        The addresses of a valid email are replaced with their parsed values.
+
+        :return: valid, reason where valid is a boolean and reason is a string
+        """
+
+        # TODO This should be more defensive. What if subject and body are not strings?
+        # We could also return better error messages.
+
+        # 1. subject and body are non-empty
+        if email.get('subject', '').strip() == '':
+            return False, 'Subject is empty'
+        if email.get('body', '').strip() == '':
+            return False, 'Body is empty'
+
+        # 2. to_email and from_email are valid e-mails
+        to_email = self.parse_address(email.get('to_email', ''))
+        from_email = self.parse_address(email.get('from_email', ''))
+
+        if to_email is None:
+            return False, 'To-Email is not valid'
+
+        if from_email is None:
+            return False, 'From-Email is not valid'
+
+        email['to_email'] = to_email
+        email['from_email'] = from_email
+
+        return True, ''
+
+    def validate_emails(self, emails):
+        """
+        Validate a batch of emails, see validate_email.
+
+        :return: list of (valid, reason) for each email
+        """
+
+        return [self.validate_email(email) for email in emails]
@@ -1,8 +1,15 @@
 import json
+import time
+import uuid
 import logging
+import sqlite3
 from flask import Flask, request
 import redis
-from requeue.requeue import DistributedQueue
+from requeue.requeue import create_queue
+from requeue.validation import EmailValidator
+from requeue.groupcommit import GroupCommitter
+from requeue.spool import Spool
+from requeue.metrics import REGISTRY, CONTENT_TYPE, Counter, Gauge, Histogram
 
 DEBUG = False
 LOG = None  # path to logfile
@@ -10,7 +17,22 @@ LOG = None  # path to logfile
 DEFAULT_FROM_EMAIL = None
 DEFAULT_FROM_NAME = ''
 
-REDIS_SERVER_URL = 'redis://localhost:6379?db=0'  # default installation
+REDIS_SERVER_URL = 'redis://localhost:6379?db=0'  # default installation, or a list of urls to spread partitions over
+QUEUE_PARTITIONS = 1  # number of partitions the email queue is split into
+
+MAX_BATCH_SIZE = 10000  # maximum number of emails accepted in a single /batch request
+
+IDEMPOTENCY_WINDOW = 3600  # seconds an idempotency key is remembered (for up to twice as long)
+
+# Milliseconds to collect concurrent submissions to "/" into a single push to redis, 0 pushes each email on its own
+GROUP_COMMIT_WINDOW = 0
+GROUP_COMMIT_MAX_BATCH = 1000  # maximum number of emails pushed at once
+
+# Directory of a local spool, persisting accepted emails while redis is unavailable (None disables the spool).
+# Each frontend process needs its own spool directory.
+SPOOL_DIRECTORY = None
+SPOOL_LATENCY_BUDGET = None  # milliseconds, slower pushes to redis divert emails to the spool until it is drained
+SPOOL_DRAIN_BATCH_SIZE = 1000  # maximum number of spooled emails pushed to redis at once
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -29,7 +51,45 @@ if app.config.get('LOG', None) is not None:
 
 # Connections
 
-queue = DistributedQueue(app.config['REDIS_SERVER_URL'])
+# Pushes to redis time out once the latency budget is spent, such that the emails are spooled instead
+socket_timeout = None
+if app.config['SPOOL_DIRECTORY'] is not None and app.config['SPOOL_LATENCY_BUDGET'] is not None:
+    socket_timeout = app.config['SPOOL_LATENCY_BUDGET'] / 1000.0
+
+queue = create_queue(app.config['REDIS_SERVER_URL'], app.config['QUEUE_PARTITIONS'],
+                     idempotency_window=app.config['IDEMPOTENCY_WINDOW'], socket_timeout=socket_timeout)
+
+committer = None
+if app.config['GROUP_COMMIT_WINDOW'] > 0:
+    committer = GroupCommitter(queue, app.config['GROUP_COMMIT_WINDOW'] / 1000.0, app.config['GROUP_COMMIT_MAX_BATCH'])
+
+spool = None
+if app.config['SPOOL_DIRECTORY'] is not None:
+    spool = Spool(app.config['SPOOL_DIRECTORY'])
+
+    # The drainer pushes large batches off the request path, so it is not held to the latency budget
+    drain_queue = queue
+    if socket_timeout is not None:
+        drain_queue = create_queue(app.config['REDIS_SERVER_URL'], app.config['QUEUE_PARTITIONS'],
+                                   idempotency_window=app.config['IDEMPOTENCY_WINDOW'])
+
+    spool.start_drainer(drain_queue, app.config['SPOOL_DRAIN_BATCH_SIZE'])
+
+validator = EmailValidator()
+
+# Errors raised when emails can not be pushed to the queue (of any engine), or written to the spool
+PUSH_ERRORS = (redis.RedisError, sqlite3.Error)
+SPOOL_ERRORS = (IOError, OSError)
+
+# Metrics
+
+SUBMISSIONS = Counter('reliableemail_frontend_emails_total', 'Submitted emails by result', ['endpoint', 'result'])
+PUSH_SECONDS = Histogram('reliableemail_frontend_push_seconds', 'Time spent pushing emails to redis', ['endpoint'])
+SPOOLED = Counter('reliableemail_frontend_spooled_total', 'Emails persisted in the local spool', ['endpoint'])
+SPOOL_DEPTH = Gauge('reliableemail_frontend_spool_depth', 'Emails in the local spool not yet pushed to redis')
+
+if spool is not None:
+    SPOOL_DEPTH.set_function(lambda: spool.depth)
 
 
 def _normalize(form, key, default=None):
@@ -37,10 +97,132 @@ def _normalize(form, key, default=None):
     Return form.get(key, default).
     However, if form[key] is the empty string then default is also used.
     """
-    value = form.get(key, '').strip()
+    value = form.get(key, '')
+    if not isinstance(value, basestring):
+        return default
+
+    value = value.strip()
     return value if value != '' else default
 
 
+def _parse_email(form):
+    """
+    Build an email from submitted values (see submit_email)
+
+    :return: email, error_message where email is None if the submission is illformed
+    """
+
+    subject = _normalize(form, 'subject')
+    body = _normalize(form, 'body')
+
+    to_email = _normalize(form, 'to')
+    to_name = _normalize(form, 'to_name', None)
+
+    from_email = _normalize(form, 'from', app.config['DEFAULT_FROM_EMAIL'])
+    from_name = _normalize(form, 'from_name', app.config['DEFAULT_FROM_NAME'])
+
+    priority = _normalize(form, 'priority')
+    idempotency_key = _normalize(form, 'idempotency_key')
+
+    if subject is None or body is None or to_email is None:
+        return None, 'Application sent malformed request missing one of arguments: subject, body or to'
+
+    if validator.parse_address(to_email) is None:
+        return None, 'Application sent invalid recipient email: %s' % to_email
+
+    if validator.parse_address(from_email) is None:
+        return None, 'Application sent invalid sender email: %s' % from_email
+
+    if priority is not None and priority not in queue.priorities:
+        return None, 'Application sent unknown priority, expected one of: %s' % ', '.join(queue.priorities)
+
+    email = {
+        'subject': subject,
+        'body': body,
+
+        'to_email': to_email,
+        'to_name': to_name,
+
+        'from_email': from_email,
+        'from_name': from_name
+    }
+
+    if priority is not None:
+        email['priority'] = priority
+
+    if idempotency_key is not None:
+        email['idempotency_key'] = idempotency_key
+
+    return email, None
+
+
+def _parse_batch(request):
+    """
+    Read the emails of a batch submission, either a JSON array or newline delimited JSON objects (NDJSON).
+
+    :return: list of submitted values, or None if the request body is illformed
+    """
+
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            return [json.loads(line) for line in request.get_data().splitlines() if line.strip() != '']
+        except ValueError:
+            return None
+
+    submissions = request.get_json(force=True, silent=True)
+    return submissions if isinstance(submissions, list) else None
+
+
+def _spool(endpoint, emails):
+    spool.append_many(emails)
+    SPOOLED.labels(endpoint).inc(len(emails))
+
+
+def _persist(endpoint, emails):
+    """
+    Persist emails in redis, or in the local spool (if configured) while redis is unavailable or slow.
+
+    :raises: one of PUSH_ERRORS or SPOOL_ERRORS if the emails could not be persisted
+    """
+
+    if spool is not None:
+        # A push may time out after redis stored its emails, which are then spooled and pushed again by the drainer.
+        # Keyed emails are dropped when pushed again, such that they are not sent twice.
+        for email in emails:
+            if 'idempotency_key' not in email:
+                email['idempotency_key'] = uuid.uuid4().hex
+
+    if spool is not None and spool.diverting:
+        try:
+            return _spool(endpoint, emails)
+        except SPOOL_ERRORS:
+            app.logger.exception('Failed to write emails to the spool, pushing emails to redis')
+
+    start = time.time()
+
+    try:
+        with PUSH_SECONDS.labels(endpoint).time():
+            if len(emails) != 1:
+                queue.push_many(emails)
+            elif committer is not None:
+                committer.push(emails[0])
+            else:
+                queue.push(emails[0])
+
+    except PUSH_ERRORS:
+        if spool is None:
+            raise
+
+        app.logger.exception('Failed to push emails to redis, spooling emails')
+        spool.divert()
+        return _spool(endpoint, emails)
+
+    budget = app.config['SPOOL_LATENCY_BUDGET']
+    if spool is not None and budget is not None and (time.time() - start) * 1000 > budget:
+        app.logger.warning('Pushing to redis exceeded the latency budget, spooling emails')
+        spool.divert()
+
+
 @app.route('/', methods=['POST'])
 def submit_email():
     """
@@ -53,42 +235,93 @@ def submit_email():
     to_name (optional): name of the recipient
     from (optional): sender email
     from_name (optional): name of the sender
+    priority (optional): priority lane of the email, e.g. high, normal or bulk
+    idempotency_key (optional): unique key of the email, a resubmitted email with the same key is accepted but dropped
     """
 
-    subject = _normalize(request.form, 'subject')
-    body = _normalize(request.form, 'body')
+    email, message = _parse_email(request.form)
+
+    if email is None:
+        app.logger.debug(message)
+        SUBMISSIONS.labels('/', 'rejected').inc()
+        return json.dumps({'ok': False, 'error_message': message}), 400, None
 
-    to_email = _normalize(request.form, 'to')
-    to_name = _normalize(request.form, 'to_name', None)
+    try:
+        _persist('/', [email])
 
-    from_email = _normalize(request.form, 'from', app.config['DEFAULT_FROM_EMAIL'])
-    from_name = _normalize(request.form, 'from_name', app.config['DEFAULT_FROM_NAME'])
+        SUBMISSIONS.labels('/', 'accepted').inc()
+        app.logger.debug('Added email subject: %s, body: %s, to: %s' % (email['subject'], email['body'],
+                                                                          email['to_email']))
+        return json.dumps({'ok': True})
 
-    if subject is None or body is None or to_email is None:
-        message = 'Application sent malformed request missing one of arguments: subject, body or to'
+    except PUSH_ERRORS + SPOOL_ERRORS:
+        message = 'Failed to persist email, email rejected'
+        app.logger.error(message)
+        SUBMISSIONS.labels('/', 'failed').inc()
+        return json.dumps({'ok': False, 'error_message': message}), 500, None
+
+
+@app.route('/batch', methods=['POST'])
+def submit_batch():
+    """
+    Accepts a JSON array (or newline delimited JSON objects with content type application/x-ndjson) of emails,
+    each with the same keys as the POST parameters accepted by submit_email.
+
+    All valid emails are pushed in a single round trip, while invalid emails are rejected.
+    The response contains a result for each submitted email, in order.
+    """
+
+    submissions = _parse_batch(request)
+
+    if submissions is None:
+        message = 'Application sent malformed batch, expected a JSON array or NDJSON of emails'
         app.logger.debug(message)
         return json.dumps({'ok': False, 'error_message': message}), 400, None
 
-    try:
-        queue.push({
-            'subject': subject,
-            'body': body,
+    if len(submissions) > app.config['MAX_BATCH_SIZE']:
+        message = 'Batch too large, at most %s emails are accepted per request' % app.config['MAX_BATCH_SIZE']
+        app.logger.debug(message)
+        return json.dumps({'ok': False, 'error_message': message}), 400, None
 
-            'to_email': to_email,
-            'to_name': to_name,
+    emails = []
+    results = []
 
-            'from_email': from_email,
-            'from_name': from_name
-        })
+    for submission in submissions:
+        if isinstance(submission, dict):
+            email, message = _parse_email(submission)
+        else:
+            email, message = None, 'Application sent malformed email, expected a JSON object'
 
-        app.logger.debug('Added email subject: %s, body: %s, to: %s' % (subject, body, to_email))
-        return json.dumps({'ok': True})
+        if email is None:
+            results.append({'ok': False, 'error_message': message})
+        else:
+            emails.append(email)
+            results.append({'ok': True})
+
+    SUBMISSIONS.labels('/batch', 'rejected').inc(len(submissions) - len(emails))
+
+    try:
+        _persist('/batch', emails)
+
+        SUBMISSIONS.labels('/batch', 'accepted').inc(len(emails))
+        app.logger.debug('Added batch of %s emails, rejected %s' % (len(emails), len(submissions) - len(emails)))
+        return json.dumps({'ok': True, 'results': results})
 
-    except redis.ConnectionError:
-        message = 'Connection to redis refused, email rejected'
+    except PUSH_ERRORS + SPOOL_ERRORS:
+        message = 'Failed to persist emails, emails rejected'
         app.logger.error(message)
+        SUBMISSIONS.labels('/batch', 'failed').inc(len(emails))
         return json.dumps({'ok': False, 'error_message': message}), 500, None
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Exposes the metrics of this frontend in the Prometheus text format
+    """
+
+    return REGISTRY.expose(), 200, {'Content-Type': CONTENT_TYPE}
+
+
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    app.run(threaded=True)
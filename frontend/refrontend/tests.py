@@ -1,7 +1,13 @@
 
+import json
+import errno
+import shutil
+import tempfile
 import unittest
+import redis
 import refrontend
 from requeue.requeue import DistributedQueue
+from requeue.spool import Spool
 
 
 class ReliableEmailTestCase(unittest.TestCase):
@@ -53,6 +59,59 @@ class ReliableEmailTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(refrontend.queue.size(), 1)
 
+    def test_valid_submission_priority(self):
+        refrontend.queue.reset()
+
+        response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org',
+            'priority': 'high'
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(refrontend.queue.size('high'), 1)
+
+    def test_valid_submission_idempotency_key(self):
+        refrontend.queue.reset()
+
+        for i in range(2):
+            response = self.app.post('/', data={
+                'subject': 'Test',
+                'body': 'Test',
+                'to': 'test@example.org',
+                'idempotency_key': 'order-1'
+            })
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(refrontend.queue.size(), 1)
+
+    def test_invalid_submission_priority(self):
+        refrontend.queue.reset()
+
+        response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org',
+            'priority': 'urgent!'
+        })
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(refrontend.queue.size(), 0)
+
+    def test_invalid_submission_email(self):
+        refrontend.queue.reset()
+
+        response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'example@eample',
+            'from': 'example'
+        })
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(refrontend.queue.size(), 0)
+
     def test_invalid_submission_empty_values(self):
         refrontend.queue.reset()
 
@@ -65,6 +124,40 @@ class ReliableEmailTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(refrontend.queue.size(), 0)
 
+    def test_batch_submission(self):
+        refrontend.queue.reset()
+
+        response = self.app.post('/batch', content_type='application/json', data=json.dumps([
+            {'subject': 'Test', 'body': 'Test', 'to': 'test@example.org'},
+            {'subject': 'Test', 'body': 'Test', 'to': ''},
+            'not an email',
+            {'subject': 'Test', 'body': 'Test', 'to': 'test@example.org', 'from_name': 'John Doe'}
+        ]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['ok'] for result in json.loads(response.data)['results']],
+                         [True, False, False, True])
+        self.assertEqual(refrontend.queue.size(), 2)
+
+    def test_batch_submission_ndjson(self):
+        refrontend.queue.reset()
+
+        response = self.app.post('/batch', content_type='application/x-ndjson', data='\n'.join([
+            json.dumps({'subject': 'Test', 'body': 'Test', 'to': 'test@example.org'}),
+            json.dumps({'subject': 'Test', 'body': 'Test', 'to': 'test@example.org'})
+        ]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(refrontend.queue.size(), 2)
+
+    def test_batch_submission_malformed(self):
+        refrontend.queue.reset()
+
+        response = self.app.post('/batch', content_type='application/json', data='{"subject": "Test"}')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(refrontend.queue.size(), 0)
+
     def test_redis_cluster_down(self):
         old_queue = refrontend.queue
         refrontend.queue = DistributedQueue('redis://localhost:1')
@@ -78,6 +171,139 @@ class ReliableEmailTestCase(unittest.TestCase):
         refrontend.queue = old_queue
         self.assertEqual(response.status_code, 500)
 
+    def test_redis_cluster_down_spooled(self):
+        directory = tempfile.mkdtemp()
+
+        old_queue = refrontend.queue
+        refrontend.queue = DistributedQueue('redis://localhost:1')
+        refrontend.spool = Spool(directory)
+
+        response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org'
+        })
+
+        depth = refrontend.spool.depth
+        diverting = refrontend.spool.diverting
+
+        refrontend.spool.close()
+        refrontend.spool = None
+        refrontend.queue = old_queue
+        shutil.rmtree(directory)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(depth, 1)
+        self.assertTrue(diverting)
+
+    def test_redis_timeout_spooled(self):
+        directory = tempfile.mkdtemp()
+
+        def push(email):
+            raise redis.TimeoutError('Timeout reading from socket')
+
+        old_push = refrontend.queue.push
+        refrontend.queue.push = push
+        refrontend.spool = Spool(directory)
+
+        response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org'
+        })
+
+        depth = refrontend.spool.depth
+
+        refrontend.spool.close()
+        refrontend.spool = None
+        refrontend.queue.push = old_push
+        shutil.rmtree(directory)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(depth, 1)
+
+    def test_redis_timeout_after_push(self):
+        directory = tempfile.mkdtemp()
+        refrontend.queue.reset()
+
+        def push(email):
+            old_push(email)
+            raise redis.TimeoutError('Timeout reading from socket')
+
+        old_push = refrontend.queue.push
+        refrontend.queue.push = push
+        refrontend.spool = Spool(directory)
+
+        response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org'
+        })
+
+        refrontend.queue.push = old_push
+
+        # The spooled email was stored by redis already, and is dropped when drained
+        depth = refrontend.spool.depth
+        refrontend.spool.drain(refrontend.queue)
+
+        refrontend.spool.close()
+        refrontend.spool = None
+        shutil.rmtree(directory)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(depth, 1)
+        self.assertEqual(refrontend.queue.size(), 1)
+
+    def test_spool_failure(self):
+        directory = tempfile.mkdtemp()
+        refrontend.queue.reset()
+
+        def append_many(emails):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+        refrontend.spool = Spool(directory)
+        refrontend.spool.append_many = append_many
+        refrontend.spool.divert()
+
+        # Emails are pushed to redis instead, and rejected if redis is down as well
+        response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org'
+        })
+
+        old_queue = refrontend.queue
+        refrontend.queue = DistributedQueue('redis://localhost:1')
+
+        failed_response = self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org'
+        })
+
+        refrontend.queue = old_queue
+        refrontend.spool.close()
+        refrontend.spool = None
+        shutil.rmtree(directory)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(refrontend.queue.size(), 1)
+        self.assertEqual(failed_response.status_code, 500)
+
+    def test_metrics(self):
+        refrontend.queue.reset()
+
+        self.app.post('/', data={
+            'subject': 'Test',
+            'body': 'Test',
+            'to': 'test@example.org'
+        })
+
+        response = self.app.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('reliableemail_frontend_emails_total{endpoint="/",result="accepted"}', response.data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,145 @@
+import os
+import errno
+import time
+import signal
+import logging
+import threading
+
+logger = logging.getLogger('reworker.supervisor')
+logger.addHandler(logging.NullHandler())  # hide errors about missing handlers
+
+
+class Supervisor(object):
+
+    def __init__(self, target, processes, min_backoff=0.1, max_backoff=30, backoff_reset=10, interval=0.05):
+        """
+        Runs target in a number of forked processes, and restarts processes which exit.
+
+        target is called with a threading.Event in each process, which is set when the process should stop
+        (on SIGTERM), and the slot of the process (0 to processes - 1). target is expected to finish the work at hand
+        and return when the event is set.
+
+        A process which exits within backoff_reset seconds of being started is restarted with an exponential
+        backoff between min_backoff and max_backoff seconds, otherwise it is restarted immediately.
+
+        :param interval: seconds between checks for exited processes
+        """
+
+        self._target = target
+        self._processes = processes
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._backoff_reset = backoff_reset
+        self._interval = interval
+
+        self._stopping = False
+
+        self._children = {}  # pid -> slot
+        self._started = {}  # slot -> start time
+        self._failures = {}  # slot -> number of consecutive fast failures
+        self._restart_at = {}  # slot -> time
+
+    def _spawn(self, slot):
+        pid = os.fork()
+
+        if pid == 0:
+            self._run_child(slot)
+
+        self._children[pid] = slot
+        self._started[slot] = time.time()
+        logger.info('Started worker process %s (pid %s)' % (slot, pid))
+
+    def _run_child(self, slot):
+        # Never return into the loop of the parent, whatever is raised (e.g. SystemExit or KeyboardInterrupt)
+        code = 1
+
+        try:
+            stop = threading.Event()
+
+            def handle_stop(signum, frame):
+                stop.set()
+
+            signal.signal(signal.SIGTERM, handle_stop)
+            signal.signal(signal.SIGINT, handle_stop)
+
+            # Restart interrupted system calls (e.g. blocking reads from redis), the stop event is checked afterwards
+            signal.siginterrupt(signal.SIGTERM, False)
+            signal.siginterrupt(signal.SIGINT, False)
+
+            try:
+                self._target(stop, slot)
+                code = 0
+            except Exception:
+                logger.exception('Worker process failed')
+        finally:
+            os._exit(code)
+
+    def _reap_children(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                raise
+
+            if pid == 0:
+                return
+
+            slot = self._children.pop(pid, None)
+            if slot is None:
+                continue
+
+            if self._stopping:
+                logger.info('Worker process %s (pid %s) stopped' % (slot, pid))
+                continue
+
+            if time.time() - self._started[slot] < self._backoff_reset:
+                self._failures[slot] = self._failures.get(slot, 0) + 1
+            else:
+                self._failures[slot] = 0
+
+            backoff = min(self._max_backoff, self._min_backoff * (2 ** self._failures[slot] - 1))
+            self._restart_at[slot] = time.time() + backoff
+
+            logger.error('Worker process %s (pid %s) exited with status %s, restarting in %.1f seconds' %
+                         (slot, pid, status, backoff))
+
+    def stop(self):
+        """
+        Stop all processes. The processes are asked to stop using SIGTERM, and run returns once all have exited.
+        """
+
+        self._stopping = True
+        self._restart_at.clear()
+
+        for pid in self._children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # already exited
+
+    def run(self, install_signal_handlers=True):
+        """
+        Start the processes, and supervise them until stopped.
+
+        :param install_signal_handlers: stop on SIGTERM and SIGINT (only possible from the main thread)
+        """
+
+        if install_signal_handlers:
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+        for slot in range(self._processes):
+            self._spawn(slot)
+
+        while self._children or not self._stopping:
+            self._reap_children()
+
+            now = time.time()
+            for slot, restart_at in self._restart_at.items():
+                if restart_at <= now and not self._stopping:
+                    del self._restart_at[slot]
+                    self._spawn(slot)
+
+            time.sleep(self._interval)
@@ -1,13 +1,26 @@
 
 import os
+import time
+import tempfile
+import threading
 import unittest
 import logging
+import urlparse
+import BaseHTTPServer
 
 import redis
-from requeue.requeue import DistributedQueue
+from requeue.requeue import DistributedQueue, create_queue
+from requeue.ratelimit import RateLimiter
 
 import worker
 from workers.logger import LoggerBackend
+from workers.aws import AWSBackend
+from workers.sg import SendgridBackend
+from workers.batch import SENT, INVALID, TEMPORARY
+from workers.ratelimited import RateLimitedBackend
+from workers.router import RouterBackend, CircuitBreaker, OPEN, CLOSED
+from workers.exceptions import WorkerRemoteError
+from supervisor import Supervisor
 
 RE_REDIS_URL = os.getenv('RE_REDIS_URL')
 if RE_REDIS_URL is None:
@@ -42,10 +55,81 @@ class AlwaysWorkingWorkerMock(object):
         self.send_count += 1
 
 
+class BatchWorkerMock(object):
+    def __init__(self):
+        self.batches = []
+
+    def send(self, **kwargs):
+        self.batches.append(1)
+
+    def send_batch(self, emails, **kwargs):
+        self.batches.append(len(emails))
+        return [INVALID if email['subject'] == 'Rejected' else SENT for email in emails]
+
+
+class ReapedWorkerMock(object):
+    """
+    Outlives the leases of the emails it sends, such that they are reaped and reserved by another worker meanwhile.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.send_count = 0
+        self.reserved = []
+
+    def send(self, **kwargs):
+        self.send_count += 1
+        self.queue.reap()
+        self.reserved.extend(self.queue.reserve_many(10))
+
+
+class StandInServer(object):
+    """
+    A local stand-in for the HTTP API of an email service, answering every request with the given status and body.
+    """
+
+    def __init__(self, status=200, body=''):
+        requests = self.requests = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                requests.append(urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length']))))
+
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_ses_response = """<SendEmailResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <SendEmailResult><MessageId>1</MessageId></SendEmailResult>
+  <ResponseMetadata><RequestId>1</RequestId></ResponseMetadata>
+</SendEmailResponse>"""
+
+_ses_illegal_address_response = """<ErrorResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <Error><Type>Sender</Type><Code>InvalidParameterValue</Code><Message>Illegal address</Message></Error>
+  <RequestId>1</RequestId>
+</ErrorResponse>"""
+
+
 class ReWorkerTest(unittest.TestCase):
 
     def setUp(self):
-        self.queue = DistributedQueue(RE_REDIS_URL)
+        self.queue = create_queue(RE_REDIS_URL)
         self.queue.namespace += "__TESTING"  # make sure we do not hit anything bad
 
     def test_iteration_expected_path(self):
@@ -71,6 +155,16 @@ class ReWorkerTest(unittest.TestCase):
         self.assertEqual(self.queue.size_processing(), 0)
         self.assertEqual(self.queue.size_discarded(), 0)
 
+    def test_iteration_empty_queue_blocking(self):
+        self.queue.reset()
+
+        w = AlwaysWorkingWorkerMock()
+        worker.run(w, self.queue, True, wait_on_empty=1, block=True)
+
+        self.assertEqual(w.send_count, 0)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 0)
+
     def test_iteration_invalid_email(self):
         self.queue.reset()
         self.queue.push(_asset_invalid_email_dummy_email)
@@ -83,6 +177,9 @@ class ReWorkerTest(unittest.TestCase):
         self.assertEqual(self.queue.size_processing(), 0)
         self.assertEqual(self.queue.size_discarded(), 1)
 
+        # The reason is recorded with the discarded email
+        self.assertEqual(self.queue.requeue(filters=[('reason', '=', 'To-Email is not valid')]), 1)
+
     def test_iteration_missing_subject(self):
         self.queue.reset()
         self.queue.push(_asset_invalid_subject_dummy_email)
@@ -95,6 +192,87 @@ class ReWorkerTest(unittest.TestCase):
         self.assertEqual(self.queue.size_processing(), 0)
         self.assertEqual(self.queue.size_discarded(), 1)
 
+    def test_iteration_batch(self):
+        self.queue.reset()
+        for i in range(3):
+            self.queue.push(_asset_dummy_email)
+        self.queue.push(_asset_invalid_email_dummy_email)
+        self.queue.push(_asset_dummy_email)
+
+        w = AlwaysWorkingWorkerMock()
+        worker.run(w, self.queue, True, batch_size=4)
+
+        self.assertEqual(w.send_count, 3)
+        self.assertEqual(self.queue.size(), 1)
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+    def test_iteration_concurrent(self):
+        self.queue.reset()
+        for i in range(3):
+            self.queue.push(_asset_dummy_email)
+        self.queue.push(_asset_invalid_email_dummy_email)
+
+        workers = [AlwaysWorkingWorkerMock() for _ in range(2)]
+        worker.run(workers, self.queue, True, batch_size=4)
+
+        self.assertEqual(sum(w.send_count for w in workers), 3)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+    def test_iteration_send_batch(self):
+        self.queue.reset()
+        for i in range(3):
+            self.queue.push(_asset_dummy_email)
+        self.queue.push(dict(_asset_dummy_email, subject='Rejected'))
+
+        w = BatchWorkerMock()
+        worker.run(w, self.queue, True, batch_size=4)
+
+        self.assertEqual(w.batches, [4])
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_discarded(), 1)
+
+    def test_iteration_temporary_failure(self):
+        self.queue.reset()
+        self.queue.push(_asset_dummy_email)
+
+        w = FlakyWorkerMock(True)
+        worker.run(w, self.queue, True)
+
+        self.assertEqual(w.send_count, 1)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.size_processing(), 0)
+        self.assertEqual(self.queue.size_retrying(), 1)
+
+    def test_iteration_lease_expired(self):
+        self.queue.reset()
+        self.queue.push_many([_asset_dummy_email] * 2)
+        self.queue.lease_timeout = -1
+
+        # The second email is skipped, and neither email is acknowledged by this worker
+        w = ReapedWorkerMock(self.queue)
+        worker.run(w, self.queue, True, batch_size=2)
+
+        self.assertEqual(w.send_count, 1)
+        self.assertEqual(self.queue.size_processing(), 2)
+
+        self.queue.complete_many([token for email, token in w.reserved])
+        self.assertEqual(self.queue.size_processing(), 0)
+
+    def test_iteration_concurrent_lease_expired(self):
+        self.queue.reset()
+        self.queue.push(_asset_dummy_email)
+        self.queue.lease_timeout = -1
+
+        w = ReapedWorkerMock(self.queue)
+        worker.run([w], self.queue, True)
+
+        self.assertEqual(w.send_count, 1)
+        self.queue.complete(w.reserved[0][1])
+        self.assertEqual(self.queue.size_processing(), 0)
+
     def test_cant_connect_to_redis(self):
         w = AlwaysWorkingWorkerMock()
         queue = DistributedQueue('redis://localhost:1')
@@ -110,10 +288,207 @@ class ReWorkerTest(unittest.TestCase):
         self.assertEqual(w.send_count, 0)
 
 
+class BatchBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.emails = [dict(_asset_dummy_email, to_email='example%s@example.org' % i) for i in range(3)]
+
+        os.environ.update({'AWS_KEY': 'key', 'AWS_SECRET': 'secret',
+                           'SENDGRID_USERNAME': 'username', 'SENDGRID_PASSWORD': 'password'})
+
+    def test_aws_send_batch(self):
+        server = StandInServer(body=_ses_response)
+        os.environ['AWS_SES_ENDPOINT'] = server.url
+
+        outcomes = AWSBackend().send_batch(self.emails)
+        server.close()
+
+        # Each email is sent on its own, such that each recipient receives its own To header
+        self.assertEqual(outcomes, [SENT] * 3)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(server.requests[2]['Destination.ToAddresses.member.1'], ['example2@example.org'])
+        self.assertNotIn('Destination.BccAddresses.member.1', server.requests[2])
+
+    def test_aws_send_batch_invalid(self):
+        server = StandInServer(status=400, body=_ses_illegal_address_response)
+        os.environ['AWS_SES_ENDPOINT'] = server.url
+
+        outcomes = AWSBackend().send_batch(self.emails)
+        server.close()
+
+        self.assertEqual(outcomes, [INVALID] * 3)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_sendgrid_send_batch(self):
+        server = StandInServer(body='{"message": "success"}')
+        os.environ['SENDGRID_URL'] = server.url
+
+        outcomes = SendgridBackend().send_batch(self.emails)
+        server.close()
+
+        self.assertEqual(outcomes, [SENT] * 3)
+        self.assertEqual(len(server.requests), 1)
+        self.assertIn('example2@example.org', server.requests[0]['x-smtpapi'][0])
+
+    def test_sendgrid_send_batch_names(self):
+        server = StandInServer(body='{"message": "success"}')
+        os.environ['SENDGRID_URL'] = server.url
+
+        emails = [dict(email, to_name='Jane Doe') for email in self.emails] + [dict(self.emails[0], to_name='John Doe')]
+        outcomes = SendgridBackend().send_batch(emails)
+        server.close()
+
+        # Only emails to recipients with the same name are merged, each recipient addressed by its own name
+        self.assertEqual(outcomes, [SENT] * 4)
+        self.assertEqual(len(server.requests), 2)
+        self.assertIn('Jane Doe <example2@example.org>', server.requests[0]['x-smtpapi'][0])
+        self.assertIn('John Doe', server.requests[1]['toname[]'])
+
+
+class RateLimitedBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = RateLimiter(RE_REDIS_URL, 'test', 100, burst=2, namespace='reliableemail__TESTING')
+        self.limiter.reset()
+
+    def test_send_batch_chunks(self):
+        backend = BatchWorkerMock()
+        outcomes = RateLimitedBackend(backend, self.limiter).send_batch([_asset_dummy_email] * 5)
+
+        # No more emails are sent at once than the burst allows
+        self.assertEqual(backend.batches, [2, 2, 1])
+        self.assertEqual(outcomes, [SENT] * 5)
+
+    def test_send_batch_failure(self):
+        backend = BatchWorkerMock()
+        send_batch = backend.send_batch
+
+        def failing_send_batch(emails, **kwargs):
+            if backend.batches:
+                raise WorkerRemoteError('Backend is down')
+            return send_batch(emails, **kwargs)
+
+        backend.send_batch = failing_send_batch
+        outcomes = RateLimitedBackend(backend, self.limiter).send_batch([_asset_dummy_email] * 5)
+
+        # Only the emails not sent yet are retried
+        self.assertEqual(outcomes, [SENT] * 2 + [TEMPORARY] * 3)
+
+        backend.batches = [1]
+        self.assertRaises(WorkerRemoteError, RateLimitedBackend(backend, self.limiter).send_batch,
+                          [_asset_dummy_email] * 5)
+
+
+class FlakyWorkerMock(object):
+    def __init__(self, failing):
+        self.failing = failing
+        self.send_count = 0
+
+    def send(self, **kwargs):
+        self.send_count += 1
+        if self.failing:
+            raise WorkerRemoteError('Backend is down')
+
+
+class RouterTest(unittest.TestCase):
+
+    def test_failover(self):
+        failing = FlakyWorkerMock(True)
+        working = FlakyWorkerMock(False)
+
+        circuits = {'failing': CircuitBreaker('failing', min_requests=2, open_seconds=0.2)}
+        router = RouterBackend([('failing', failing), ('working', working)], circuits)
+
+        for i in range(5):
+            router.send(**_asset_dummy_email)
+
+        # The failing backend is skipped once its circuit opens
+        self.assertEqual(working.send_count, 5)
+        self.assertEqual(failing.send_count, 2)
+        self.assertEqual(circuits['failing'].state, OPEN)
+
+        # After open_seconds, the next email probes the backend again
+        failing.failing = False
+        time.sleep(0.3)
+        router.send(**_asset_dummy_email)
+
+        self.assertEqual(failing.send_count, 3)
+        self.assertEqual(circuits['failing'].state, CLOSED)
+
+    def test_all_failing(self):
+        router = RouterBackend([('failing', FlakyWorkerMock(True))])
+
+        self.assertRaises(WorkerRemoteError, router.send, connection_timeout=None, **_asset_dummy_email)
+
+    def test_fastest(self):
+        slow = FlakyWorkerMock(False)
+        fast = FlakyWorkerMock(False)
+
+        router = RouterBackend([('slow', slow), ('fast', fast)])
+        router.circuits['slow'].record(True, 1.0)
+        router.circuits['fast'].record(True, 0.1)
+
+        router.send(**_asset_dummy_email)
+        self.assertEqual(fast.send_count, 1)
+        self.assertEqual(slow.send_count, 0)
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def test_restart_and_stop(self):
+        self._assert_restarted(RuntimeError('crash'))
+
+    def test_restart_after_exit(self):
+        self._assert_restarted(SystemExit(0))
+        self._assert_restarted(KeyboardInterrupt())
+
+    def _assert_restarted(self, exception):
+        log = tempfile.NamedTemporaryFile()
+
+        def crashing_target(stop, slot):
+            with open(log.name, 'a') as f:
+                f.write('started\n')
+            raise exception
+
+        supervisor = Supervisor(crashing_target, 2, min_backoff=0.01, max_backoff=0.01)
+        thread = threading.Thread(target=supervisor.run, kwargs={'install_signal_handlers': False})
+        thread.start()
+
+        deadline = time.time() + 10
+        while len(open(log.name).readlines()) < 6 and time.time() < deadline:
+            time.sleep(0.01)
+
+        supervisor.stop()
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(len(open(log.name).readlines()) >= 6)
+
+    def test_graceful_stop(self):
+        log = tempfile.NamedTemporaryFile()
+
+        def target(stop, slot):
+            while not stop.is_set():
+                time.sleep(0.01)
+            with open(log.name, 'a') as f:
+                f.write('stopped\n')
+
+        supervisor = Supervisor(target, 2)
+        thread = threading.Thread(target=supervisor.run, kwargs={'install_signal_handlers': False})
+        thread.start()
+
+        time.sleep(0.5)
+        supervisor.stop()
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(open(log.name).readlines()), 2)
+
+
 class LoggerTest(unittest.TestCase):
 
     def setUp(self):
-        self.queue = DistributedQueue(RE_REDIS_URL)
+        self.queue = create_queue(RE_REDIS_URL)
         self.queue.namespace += "__TESTING"  # make sure we do not hit anything bad
 
     def test_expected_path(self):
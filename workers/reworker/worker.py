@@ -1,80 +1,488 @@
 #!/usr/bin/env python
 
 import click
-from flanker.addresslib import address
 import time
 import logging
-
-from requeue.requeue import DistributedQueue, DistributedQueueEmpty
+import sys
+import threading
+import Queue
+
+from requeue.requeue import create_queue, DistributedQueueEmpty, DistributedQueueException
+from requeue.ratelimit import RateLimiter
+from requeue.validation import EmailValidator
+from requeue.metrics import Counter, Histogram, start_http_server
 from workers.logger import LoggerBackend
 from workers.aws import AWSBackend
 from workers.sg import SendgridBackend
-from workers.exceptions import WorkerInvalidEmail
+from workers.exceptions import WorkerInvalidEmail, WorkerTemporaryError, WorkerRemoteError
+from workers.batch import SENT, INVALID, TEMPORARY
+from workers.ratelimited import RateLimitedBackend
+from workers.router import RouterBackend
+from supervisor import Supervisor
 
 workers = {
     'logger': LoggerBackend,
     'aws': AWSBackend,
-    'sendgrid': SendgridBackend
+    'sendgrid': SendgridBackend,
+    'router': RouterBackend  # routes to the backends given with --route
 }
 
 logger = logging.getLogger('reworker')
 logger.addHandler(logging.NullHandler())  # hide errors about missing handlers
 
+# Seconds between moving emails due for another attempt back to the queue, thus the most an attempt is delayed by. Longer
+# than the default wait on an empty queue, such that idle workers do not promote on every wakeup.
+_PROMOTE_INTERVAL = 10
+
+# Reason of emails discarded as rejected by the backend
+_REJECTED = 'Rejected by backend'
+
+validator = EmailValidator()
+
+RESERVE_SECONDS = Histogram('reliableemail_worker_reserve_seconds',
+                            'Time spent reserving emails, including time blocked waiting for emails', ['backend'])
+SEND_SECONDS = Histogram('reliableemail_worker_send_seconds', 'Time spent sending an email', ['backend'])
+ACK_SECONDS = Histogram('reliableemail_worker_ack_seconds', 'Time spent acknowledging a batch of emails', ['backend'])
+SENT_TOTAL = Counter('reliableemail_worker_sent_total', 'Emails sent', ['backend'])
+DISCARDED_TOTAL = Counter('reliableemail_worker_discarded_total', 'Emails discarded', ['backend', 'reason'])
+RETRIED_TOTAL = Counter('reliableemail_worker_retried_total', 'Emails scheduled for another attempt', ['backend'])
+
+
+class _WorkerMetrics(object):
+    """
+    The metrics of a worker, labelled by its backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.reserve = RESERVE_SECONDS.labels(backend)
+        self.send = SEND_SECONDS.labels(backend)
+        self.ack = ACK_SECONDS.labels(backend)
+        self.sent = SENT_TOTAL.labels(backend)
+        self.retried = RETRIED_TOTAL.labels(backend)
+
+    def discarded(self, reason, count=1):
+        DISCARDED_TOTAL.labels(self.backend, reason).inc(count)
+
+
+def _validate(reserved, metrics):
+    """
+    Validate a batch of reserved emails.
+
+    :return: valid, invalid where valid is a list of (email, token) and invalid a list of (token, reason) to discard
+    """
+
+    valid = []
+    invalid = []
+
+    for (email, token), (ok, reason) in zip(reserved, validator.validate_emails([email for email, _ in reserved])):
+        if ok:
+            valid.append((email, token))
+        else:
+            logger.info('Discarding invalid email: %s' % reason)
+            metrics.discarded(reason)
+            invalid.append((token, reason))
 
-def _validate_email(email):
+    return valid, invalid
+
+
+def _send(worker, email, metrics):
     """
-    Validate well-formness of email
+    Send a single (valid) email.
 
-    E.g. that subject and body are non-empty, and to and from email addresses are valid.
+    The backend makes a single attempt (connection_timeout None), as emails failing temporarily are retried later
+    through the queue instead of holding up the worker.
 
-    :return: valid, reason where valid is a boolean and reason is a string
+    :return: (outcome, reason) where the outcome is SENT, INVALID if the email should be discarded (for the given
+             reason) or TEMPORARY if it should be retried later
     """
 
-    # TODO This should be more defensive. What if subject and body are not strings?
-    # We could also return better error messages.
+    try:
+        email['connection_timeout'] = None
+        with metrics.send.time():
+            worker.send(**email)
+    except WorkerInvalidEmail, ex:
+        metrics.discarded(_REJECTED)
+        return INVALID, '%s: %s' % (_REJECTED, ex)
+    except (WorkerTemporaryError, WorkerRemoteError), ex:
+        logger.warning('Sending failed temporarily, retrying later: %s' % ex)
+        return TEMPORARY, None
 
-    # 1. subject and body are non-empty
-    if email.get('subject', '').strip() == '':
-        return False, 'Subject is empty'
-    if email.get('body', '').strip() == '':
-        return False, 'Body is empty'
+    metrics.sent.inc()
+    return SENT, None
 
-    # 2. to_email and from_email are valid e-mails
-    # We use mailgun's flanker (https://github.com/mailgun/flanker) for the heavy lifting
-    email['to_email'] = address.parse(email.get('to_email', ''), addr_spec_only=True)
-    email['from_email'] = address.parse(email.get('from_email', ''), addr_spec_only=True)  # TODO cache this check?
 
-    if email['to_email'] is None:
-        return False, 'To-Email is not valid'
+def _send_batch(worker, emails, metrics):
+    """
+    Send a batch of (valid) emails using the send_batch method of the worker, see _send.
+
+    :return: list with the outcome (SENT, INVALID or TEMPORARY) of each email
+    """
 
-    if email['from_email'] is None:
-        return False, 'From-Email is not valid'
+    with metrics.send.time():
+        outcomes = worker.send_batch(emails, connection_timeout=None)
 
-    return True, ''
+    for outcome in outcomes:
+        if outcome == SENT:
+            metrics.sent.inc()
+        elif outcome == INVALID:
+            metrics.discarded(_REJECTED)
 
+    return outcomes
 
-def run(worker, queue, terminate_after_one_iteration=False, wait_on_empty=5, connection_timeout=0):
 
-    while 1:
+def _extend_lease(queue, token, connection_timeout):
+    """
+    Extend the lease of a reserved email before sending it.
+
+    :return: False if the lease expired already and the email was reaped, such that it must be neither sent nor
+             acknowledged, as it is back in the queue (or held by another worker)
+    """
+
+    try:
+        queue.extend_lease(token, connection_timeout=connection_timeout)
+    except DistributedQueueException, ex:
+        logger.warning('Skipping email reaped before it was sent, as its lease expired: %s' % ex)
+        return False
+
+    return True
+
+
+def _reserve(queue, batch_size, timeout, connection_timeout, metrics):
+    with metrics.reserve.time():
+        return _reserve_batch(queue, batch_size, timeout, connection_timeout)
+
+
+def _reserve_batch(queue, batch_size, timeout, connection_timeout):
+    """
+    Reserve up to batch_size emails. If timeout is not None, then block for up to timeout seconds
+    if the queue is empty.
+
+    :return: [(email, token), ...]
+    """
+
+    if batch_size > 1:
         try:
-            email, token = queue.reserve(connection_timeout=connection_timeout)
-            valid, reason = _validate_email(email)
+            return queue.reserve_many(batch_size, connection_timeout=connection_timeout)
+        except DistributedQueueEmpty:
+            if timeout is None:
+                raise
+
+    # Either a single email is requested, or we block until the next email arrives after which
+    # the next iteration picks up a full batch
+    return [queue.reserve(timeout=timeout, connection_timeout=connection_timeout)]
+
+
+class _SenderPool(object):
+    """
+    Sends emails concurrently, using a thread per worker (backend).
+
+    Outcomes are collected by the owning thread, which is responsible for acknowledging the emails.
+    """
+
+    def __init__(self, workers, queue, connection_timeout, metrics):
+        self._queue = queue
+        self._connection_timeout = connection_timeout
+        self._metrics = metrics
+
+        self._pending = Queue.Queue()
+        self._done = Queue.Queue()
+        self.in_flight = 0  # emails submitted but not yet collected
+
+        self._threads = [threading.Thread(target=self._send_loop, args=(worker,)) for worker in workers]
+        for thread in self._threads:
+            thread.daemon = True  # a sender stuck in a retry loop must not keep the process alive
+            thread.start()
+
+    def _send_loop(self, worker):
+        while 1:
+            item = self._pending.get()
+            if item is None:
+                return
+
+            batch, renew_lease_at = item
+
+            if len(batch) > 1:
+                self._send_batch(worker, batch, renew_lease_at)
+                continue
+
+            email, token = batch[0]
+
+            try:
+                # The email waited for long, make sure it is not reaped while we are still working on it
+                if time.time() > renew_lease_at and not _extend_lease(self._queue, token, self._connection_timeout):
+                    self._done.put((token, None, None, None))
+                    continue
+
+                outcome, reason = _send(worker, email, self._metrics)
+                self._done.put((token, outcome, reason, None))
+            except Exception:
+                self._done.put((token, None, None, sys.exc_info()))
+
+    def _send_batch(self, worker, batch, renew_lease_at):
+        try:
+            if time.time() > renew_lease_at:
+                leased = []
+                for email, token in batch:
+                    if _extend_lease(self._queue, token, self._connection_timeout):
+                        leased.append((email, token))
+                    else:
+                        self._done.put((token, None, None, None))
+                batch = leased
+
+            outcomes = _send_batch(worker, [email for email, token in batch], self._metrics) if batch else []
+        except Exception:
+            exc_info = sys.exc_info()
+            for email, token in batch:
+                self._done.put((token, None, None, exc_info))
+            return
+
+        for (email, token), outcome in zip(batch, outcomes):
+            self._done.put((token, outcome, _REJECTED, None))
+
+    def submit(self, batch, renew_lease_at):
+        """
+        Send a list of (email, token). Lists of more than one email are sent using send_batch of the workers.
+        """
+
+        self.in_flight += len(batch)
+        self._pending.put((batch, renew_lease_at))
+
+    def collect(self, block):
+        """
+        Collect the outcome of finished sends, waiting for at least one if block is True. Emails skipped as their
+        lease expired before they were sent have no outcome.
+
+        If a send failed unexpectedly, then the exception is re-raised after the remaining outcomes are collected.
+
+        :return: the outcomes (see _Outcomes) and the exc_info of a failed send (or None)
+        """
+
+        outcomes = _Outcomes()
+        exc_info = None
+
+        while self.in_flight > 0:
+            try:
+                token, outcome, reason, error = self._done.get(block)
+            except Queue.Empty:
+                break
+
+            block = False
+            self.in_flight -= 1
+
+            if error is not None:
+                exc_info = exc_info or error
+            elif outcome is not None:
+                outcomes.add(token, outcome, reason)
+
+        return outcomes, exc_info
+
+    def close(self, wait=True):
+        for _ in self._threads:
+            self._pending.put(None)
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
 
-            if valid:
+
+class _Outcomes(object):
+    """
+    Tokens of handled emails, by outcome. Discarded emails are kept as (token, reason).
+    """
+
+    def __init__(self, discarded=None):
+        self.completed = []
+        self.discarded = discarded or []
+        self.retried = []
+
+    def add(self, token, outcome, reason=_REJECTED):
+        if outcome == SENT:
+            self.completed.append(token)
+        elif outcome == INVALID:
+            self.discarded.append((token, reason))
+        else:
+            self.retried.append(token)
+
+
+def _release(call, *args, **kwargs):
+    """
+    Acknowledge reserved emails by call (complete_many, discard_many or retry_many of the queue).
+
+    The queue rejects the tokens of emails whose lease expired before they were acknowledged, as they were reaped and
+    may be held by another worker by now, while the other emails are acknowledged. This is logged rather than raised,
+    as whoever holds such an email now is responsible for it.
+
+    :return: the result of call, or None if some tokens were rejected
+    """
+
+    try:
+        return call(*args, **kwargs)
+    except DistributedQueueException, ex:
+        logger.warning('Emails were reaped before they were acknowledged, as their lease expired: %s' % ex)
+
+
+def _acknowledge(queue, outcomes, connection_timeout, metrics, retry):
+    if not outcomes.completed and not outcomes.discarded and not outcomes.retried:
+        return
+
+    with metrics.ack.time():
+        if outcomes.completed:
+            _release(queue.complete_many, outcomes.completed, connection_timeout=connection_timeout)
+        if outcomes.discarded:
+            _release(queue.discard_many, [token for token, reason in outcomes.discarded],
+                     [reason for token, reason in outcomes.discarded], connection_timeout=connection_timeout)
+        if outcomes.retried:
+            counts = _release(queue.retry_many, outcomes.retried, connection_timeout=connection_timeout, **retry)
+            retried, discarded = counts or (0, 0)
+            metrics.retried.inc(retried)
+            if discarded:
+                logger.info('Discarding %s emails which failed too many times' % discarded)
+                metrics.discarded('Too many attempts', discarded)
+
+
+class _Promoter(object):
+    """
+    Moves emails due for another attempt back to the queue, at most every interval seconds.
+    """
+
+    def __init__(self, queue, connection_timeout, interval=_PROMOTE_INTERVAL):
+        self._queue = queue
+        self._connection_timeout = connection_timeout
+        self._interval = interval
+        self._next = 0
+
+    def __call__(self):
+        if time.time() >= self._next:
+            self._queue.promote(connection_timeout=self._connection_timeout)
+            self._next = time.time() + self._interval
+
+
+def _run_concurrent(workers, queue, terminate_after_one_iteration, wait_on_empty, timeout, connection_timeout,
+                    batch_size, stop, metrics, retry):
+    """
+    Keep up to len(workers) sends in flight, while prefetching at most as many emails again from the queue.
+    """
+
+    pool = _SenderPool(workers, queue, connection_timeout, metrics)
+    promote = _Promoter(queue, connection_timeout)
+    batching = hasattr(workers[0], 'send_batch')
+    prefetch = 2 * len(workers) * (batch_size if batching else 1)
+    reserved_any = False
+
+    try:
+        while 1:
+            stopping = stop is not None and stop.is_set()
+            room = prefetch - pool.in_flight
+            reserved = []
+
+            if room > 0 and not stopping and not (terminate_after_one_iteration and reserved_any):
+                promote()
 
                 try:
-                    email['connection_timeout'] = connection_timeout  # pass connection timeout settings to worker
-                    worker.send(**email)
-                except WorkerInvalidEmail:
-                    queue.discard(token, connection_timeout=connection_timeout)
+                    # Only block waiting for new emails if there is nothing else to do
+                    reserved = _reserve(queue, min(batch_size, room), timeout if pool.in_flight == 0 else None,
+                                        connection_timeout, metrics)
+                except DistributedQueueEmpty:
+                    if timeout is None and pool.in_flight == 0 and not terminate_after_one_iteration:
+                        time.sleep(wait_on_empty)
+
+                renew_lease_at = time.time() + queue.lease_timeout / 2.0
+                valid, invalid = _validate(reserved, metrics)
+
+                _acknowledge(queue, _Outcomes(invalid), connection_timeout, metrics, retry)
+                if batching and valid:
+                    pool.submit(valid, renew_lease_at)
+                else:
+                    for email, token in valid:
+                        pool.submit([(email, token)], renew_lease_at)
+
+                reserved_any = reserved_any or len(reserved) > 0
+
+            # Wait for a send to finish if we can not reserve more emails right now
+            outcomes, exc_info = pool.collect(block=not reserved and pool.in_flight > 0)
+            _acknowledge(queue, outcomes, connection_timeout, metrics, retry)
+
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            if (terminate_after_one_iteration or stopping) and pool.in_flight == 0:
+                break
+
+    except Exception:
+        # This should never happen, log the error and stop running so we can restart (let the exception bubble up)
+        # Emails still reserved by the pool are recovered when their leases expire.
+        logger.exception('An exception occurred when processing emails')
+        pool.close(wait=False)
+        raise
+
+    pool.close()
+
+
+def run(worker, queue, terminate_after_one_iteration=False, wait_on_empty=5, connection_timeout=0, batch_size=1,
+        block=True, stop=None, backend_name=None, retry_delay=30, max_attempts=10):
+    """
+    Process emails from the queue using the given worker (backend).
+
+    If worker is a list of workers, then emails are sent concurrently using a thread per worker.
+
+    Workers with a send_batch method are given each reserved batch at once.
+
+    Emails failing temporarily (WorkerTemporaryError or WorkerRemoteError) are retried after retry_delay seconds,
+    doubling the delay with each failed attempt, and are discarded after max_attempts failed attempts. Meanwhile,
+    the worker continues with other emails.
+
+    If block is True (default), then the worker blocks in redis for up to wait_on_empty seconds waiting for new
+    emails, and is woken as soon as an email is submitted. Otherwise the queue is polled, sleeping wait_on_empty
+    seconds every time it is found empty.
+
+    If stop (a threading.Event) is given, then processing stops once it is set and emails at hand are handled.
+
+    Metrics are labelled with backend_name (default: the class name of the worker).
+    """
+
+    timeout = wait_on_empty if block and wait_on_empty > 0 else None
+
+    if backend_name is None:
+        backend_name = (worker[0] if isinstance(worker, list) else worker).__class__.__name__
+    metrics = _WorkerMetrics(backend_name)
+    retry = {'base_delay': retry_delay, 'max_attempts': max_attempts}
+
+    if isinstance(worker, list):
+        return _run_concurrent(worker, queue, terminate_after_one_iteration, wait_on_empty, timeout,
+                               connection_timeout, batch_size, stop, metrics, retry)
+
+    promote = _Promoter(queue, connection_timeout)
+
+    while stop is None or not stop.is_set():
+        try:
+            promote()
+
+            reserved = _reserve(queue, batch_size, timeout, connection_timeout, metrics)
+            renew_lease_at = time.time() + queue.lease_timeout / 2.0
+
+            reserved, discarded = _validate(reserved, metrics)
+            outcomes = _Outcomes(discarded)
+
+            try:
+                if len(reserved) > 1 and hasattr(worker, 'send_batch'):
+                    sent = _send_batch(worker, [email for email, token in reserved], metrics)
+                    for (email, token), outcome in zip(reserved, sent):
+                        outcomes.add(token, outcome)
                 else:
-                    queue.complete(token, connection_timeout=connection_timeout)
+                    for email, token in reserved:
+                        # Slow batch, make sure the remaining emails are not reaped while we are still working on them
+                        if time.time() > renew_lease_at and not _extend_lease(queue, token, connection_timeout):
+                            continue
 
-            else:
-                queue.discard(token, connection_timeout=connection_timeout)
+                        outcomes.add(token, *_send(worker, email, metrics))
+            finally:
+                # Acknowledge whatever was handled, also if a send failed unexpectedly half way through the batch
+                _acknowledge(queue, outcomes, connection_timeout, metrics, retry)
 
         except DistributedQueueEmpty:
-            time.sleep(wait_on_empty)
+            if timeout is None:
+                time.sleep(wait_on_empty)
         except Exception:
             # This should never happen, log the error and stop running so we can restart (let the exception bubble up)
             logger.exception('An exception occurred when processing emails')
@@ -90,14 +498,46 @@ def cli():
 
 
 @cli.command()
-@click.option('--redis-url', default=None, help='Redis cluster used to persist email queue.')
+@click.option('--redis-url', multiple=True,
+              help='Redis cluster used to persist email queue. Repeat to spread partitions over several instances.')
+@click.option('--partitions', default=1, type=click.IntRange(1, None),
+              help='Number of partitions the email queue is split into.')
 @click.option('--log', default=None, help='Path to log file')
 @click.option('--verbose', default=False, is_flag=True)
+@click.option('--batch-size', default=1, type=click.IntRange(1, None),
+              help='Maximum number of emails reserved and acknowledged per round trip to redis.')
+@click.option('--wait-on-empty', default=5, type=click.IntRange(0, None),
+              help='Seconds to block (or sleep, if polling) waiting for new emails when the queue is empty.')
+@click.option('--poll', default=False, is_flag=True,
+              help='Poll the queue instead of blocking in redis when the queue is empty.')
+@click.option('--lease-timeout', default=600, type=click.IntRange(1, None),
+              help='Seconds a reserved email may be processed before it is recovered by the reaper.')
+@click.option('--concurrency', default=1, type=click.IntRange(1, None),
+              help='Number of emails sent concurrently, each using its own backend instance.')
+@click.option('--processes', default=1, type=click.IntRange(1, None),
+              help='Number of worker processes, restarted if they crash. Stopped gracefully on SIGTERM.')
+@click.option('--rate', default=None, type=float,
+              help='Maximum number of emails sent per second, shared by all workers using this backend and redis.')
+@click.option('--burst', default=1, type=click.IntRange(1, None),
+              help='Number of emails which may be sent at once when the rate limit has not been reached.')
+@click.option('--rate-limit-redis-url', default=None,
+              help='Redis used to enforce the rate limit (default: the first --redis-url, if the queue is in redis).')
+@click.option('--metrics-port', default=None, type=click.IntRange(1, 65535),
+              help='Expose metrics over HTTP on this port. Worker processes use consecutive ports from this port.')
+@click.option('--retry-delay', default=30, type=click.IntRange(1, None),
+              help='Seconds before retrying an email which failed temporarily, doubled with each failed attempt.')
+@click.option('--max-attempts', default=10, type=click.IntRange(1, None),
+              help='Number of failed attempts after which an email is discarded.')
+@click.option('--idempotency-window', default=3600, type=click.IntRange(1, None),
+              help='Seconds an email is remembered as sent by its idempotency key (for up to twice as long).')
+@click.option('--route', multiple=True,
+              help='Backend used by the router backend. Repeat to route to several backends.')
 @click.argument('backend')
 @click.pass_context
-def start(ctx, redis_url, log, verbose, backend):
-    if redis_url is None:
-        redis_url = 'redis://localhost:6379?db=0'
+def start(ctx, redis_url, partitions, log, verbose, batch_size, wait_on_empty, poll, lease_timeout, concurrency,
+          processes, rate, burst, rate_limit_redis_url, metrics_port, retry_delay, max_attempts, idempotency_window,
+          route, backend):
+    redis_urls = list(redis_url) or ['redis://localhost:6379?db=0']
 
     if log is not None:
         handler = logging.FileHandler(log)
@@ -120,10 +560,54 @@ def start(ctx, redis_url, log, verbose, backend):
     if worker is None:
         ctx.fail('Unknown backend: %s' % backend)
 
+    if worker is RouterBackend:
+        if not route:
+            ctx.fail('The router backend needs at least one --route')
+
+        for name in route:
+            if workers.get(name, RouterBackend) is RouterBackend:
+                ctx.fail('Unknown route backend: %s' % name)
+
+    if rate is not None and rate_limit_redis_url is None:
+        # The rate limiter needs redis, which is only implied by a queue kept in redis
+        scheme, separator, rest = redis_urls[0].partition('://')
+        scheme = scheme[:-len('+streams')] if scheme.endswith('+streams') else scheme
+
+        if scheme not in ('redis', 'rediss', 'unix'):
+            ctx.fail('--rate needs redis, give its url with --rate-limit-redis-url as the queue is not kept in redis')
+
+        rate_limit_redis_url = scheme + separator + rest
+
     click.echo('Starting worker using backend: %s' % backend)
 
-    queue = DistributedQueue(redis_url)
-    run(worker(), queue)
+    circuits = {}  # health of routed backends, shared by the senders of a process
+
+    def create_backend():
+        if worker is RouterBackend:
+            return RouterBackend([(name, workers[name]()) for name in route], circuits)
+
+        return worker()
+
+    def create_worker():
+        if rate is None:
+            return create_backend()
+
+        return RateLimitedBackend(create_backend(), RateLimiter(rate_limit_redis_url, backend, rate, burst))
+
+    def run_worker(stop=None, slot=0):
+        if metrics_port is not None:
+            start_http_server(metrics_port + slot)
+
+        queue = create_queue(redis_urls, partitions, lease_timeout=lease_timeout,
+                             idempotency_window=idempotency_window)
+        run(create_worker() if concurrency == 1 else [create_worker() for _ in range(concurrency)], queue,
+            wait_on_empty=wait_on_empty, batch_size=batch_size, block=not poll, stop=stop, backend_name=backend,
+            retry_delay=retry_delay, max_attempts=max_attempts)
+
+    if processes == 1:
+        run_worker()
+    else:
+        Supervisor(run_worker, processes).run()
 
 
 @cli.command()
@@ -1,11 +1,14 @@
 
 import os
 import logging
+import urlparse
 import boto.ses
+from boto.regioninfo import RegionInfo
 from boto.ses.exceptions import SESDailyQuotaExceededError, SESMaxSendingRateExceededError, SESError
 from boto.exception import StandardError
 
 from exceptions import WorkerTemporaryError, WorkerInvalidEmail, WorkerRemoteError
+from batch import SENT, INVALID, TEMPORARY
 from requeue.requeue import connection_timeout_decorator
 
 logger = logging.getLogger('reworker.AWSBackend')
@@ -23,10 +26,22 @@ class AWSBackend(object):
         if aws_secret is None:
             raise RuntimeError("AWS_SECRET environment variable must be set to your AWS secret key!")
 
-        self.conn = boto.ses.connect_to_region(
-            'us-east-1',
-            aws_access_key_id=aws_key,
-            aws_secret_access_key=aws_secret)
+        # AWS_SES_ENDPOINT overrides the SES endpoint, e.g. http://localhost:8025 for a local stand-in
+        endpoint = os.getenv('AWS_SES_ENDPOINT')
+
+        if endpoint is None:
+            self.conn = boto.ses.connect_to_region(
+                'us-east-1',
+                aws_access_key_id=aws_key,
+                aws_secret_access_key=aws_secret)
+        else:
+            url = urlparse.urlsplit(endpoint)
+            self.conn = boto.ses.SESConnection(
+                aws_access_key_id=aws_key,
+                aws_secret_access_key=aws_secret,
+                region=RegionInfo(name='custom', endpoint=url.hostname),
+                port=url.port,
+                is_secure=url.scheme == 'https')
 
     @connection_timeout_decorator((WorkerTemporaryError, WorkerRemoteError))
     def send(self, **kwargs):
@@ -42,12 +57,37 @@ class AWSBackend(object):
         logger.info('Sending email with subject "%s" to %s %s from %s %s' %
                     (subject, unicode(to_name), to_email, unicode(from_name), from_email))
 
+        self._send_email(from_email, subject, body, [to_email])
+
+    def send_batch(self, emails, connection_timeout=None, connection_timeout_interval=5):
+        """
+        Send a batch of emails, one SES call each. A single SES message to multiple recipients can not give each
+        recipient its own To header, thus emails with the same content are not merged into one message.
+
+        :return: list with the outcome (SENT, INVALID or TEMPORARY) of each email
+        """
+
+        outcomes = []
+
+        for email in emails:
+            try:
+                self.send(connection_timeout=connection_timeout,
+                          connection_timeout_interval=connection_timeout_interval, **email)
+                outcomes.append(SENT)
+            except WorkerInvalidEmail:
+                outcomes.append(INVALID)
+            except (WorkerTemporaryError, WorkerRemoteError):
+                outcomes.append(TEMPORARY)
+
+        return outcomes
+
+    def _send_email(self, from_email, subject, body, to_addresses):
         try:
             self.conn.send_email(
                 from_email,
                 subject,
                 body,
-                [to_email]
+                to_addresses
             )
 
         except SESDailyQuotaExceededError:
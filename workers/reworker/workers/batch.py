@@ -0,0 +1,27 @@
+# Outcomes of sending an email with send_batch
+SENT = 'sent'
+INVALID = 'invalid'  # the email is discarded
+TEMPORARY = 'temporary'  # the email should be retried later
+
+
+def group_by_content(emails, max_recipients):
+    """
+    Group emails with the same subject, body, sender and recipient name, such that each group can be sent as a single
+    message to multiple recipients, while each recipient receives the To header of its own email.
+
+    :return: list of lists of indexes into emails, each with at most max_recipients indexes
+    """
+
+    groups = {}
+    order = []
+
+    for i, email in enumerate(emails):
+        key = (email['subject'], email['body'], email['from_email'], email.get('from_name'), email.get('to_name'))
+
+        if key not in groups or len(groups[key][-1]) == max_recipients:
+            groups.setdefault(key, []).append([])
+            order.append((key, len(groups[key]) - 1))
+
+        groups[key][-1].append(i)
+
+    return [groups[key][n] for key, n in order]
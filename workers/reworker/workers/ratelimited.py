@@ -0,0 +1,56 @@
+import logging
+
+from batch import TEMPORARY
+
+logger = logging.getLogger('reworker.RateLimitedBackend')
+logger.setLevel(logging.DEBUG)
+
+
+class RateLimitedBackend(object):
+    """
+    Wraps a backend, such that emails are only sent once a slot is acquired from a (shared) rate limiter.
+    """
+
+    def __init__(self, backend, limiter):
+        self.backend = backend
+        self.limiter = limiter
+
+        if hasattr(backend, 'send_batch'):
+            self.send_batch = self._send_batch
+
+    def send(self, **kwargs):
+        delay = self.limiter.acquire(connection_timeout=kwargs.get('connection_timeout', None))
+
+        if delay > 0:
+            logger.debug('Sending rate limited, waited %.3f seconds' % delay)
+
+        return self.backend.send(**kwargs)
+
+    def _send_batch(self, emails, **kwargs):
+        """
+        Send a batch in chunks of at most burst emails, acquiring the slots of each chunk before sending it, as the
+        emails of a chunk are sent at once.
+        """
+
+        outcomes = []
+
+        for offset in range(0, len(emails), self.limiter.burst):
+            chunk = emails[offset:offset + self.limiter.burst]
+
+            try:
+                delay = self.limiter.acquire(len(chunk), connection_timeout=kwargs.get('connection_timeout', None))
+
+                if delay > 0:
+                    logger.debug('Sending rate limited, waited %.3f seconds for %s emails' % (delay, len(chunk)))
+
+                outcomes.extend(self.backend.send_batch(chunk, **kwargs))
+            except Exception:
+                if not outcomes:
+                    raise
+
+                # The previous chunks were sent, such that only the remaining emails may be retried
+                logger.exception('Failed to send rate limited batch, retrying %s emails' % (len(emails) - offset))
+                outcomes.extend([TEMPORARY] * (len(emails) - offset))
+                break
+
+        return outcomes
@@ -0,0 +1,179 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from exceptions import WorkerTemporaryError, WorkerRemoteError, WorkerInvalidEmail
+from requeue.requeue import connection_timeout_decorator
+
+logger = logging.getLogger('reworker.RouterBackend')
+logger.setLevel(logging.DEBUG)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, window=30, min_requests=5, failure_threshold=0.5, open_seconds=10, alpha=0.2):
+        """
+        Tracks the health of a backend: its latency (exponentially weighted moving average) and error rate over the
+        last window seconds.
+
+        The circuit opens when at least min_requests sends were made in the window, and at least failure_threshold of
+        them failed. After open_seconds a single probe is let through (half-open), which closes the circuit again on
+        success. The circuit breaker is thread safe, such that it can be shared by the routers of concurrent senders.
+        """
+
+        self.name = name
+        self.state = CLOSED
+        self.latency = None
+
+        self._window = window
+        self._min_requests = min_requests
+        self._failure_threshold = failure_threshold
+        self._open_seconds = open_seconds
+        self._alpha = alpha
+
+        self._outcomes = deque()  # (time, ok)
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self._window:
+            self._outcomes.popleft()
+
+    def error_rate(self, now=None):
+        with self._lock:
+            self._prune(now or time.time())
+
+            if not self._outcomes:
+                return 0.0
+
+            return len([ok for _, ok in self._outcomes if not ok]) / float(len(self._outcomes))
+
+    def score(self, now=None):
+        """
+        :return: the expected cost of sending using this backend, lower is better
+        """
+
+        latency = self.latency or 0.0  # untried backends are tried first
+        return latency / max(0.05, 1 - self.error_rate(now))
+
+    def acquire(self, now=None):
+        """
+        :return: True if an email may be sent using the backend, which for a half-open circuit claims the probe
+        """
+
+        now = now or time.time()
+
+        with self._lock:
+            # A probe which never reported back (e.g. its sender died) is replaced after another open_seconds
+            stale_probe = self.state == HALF_OPEN and now >= self._open_until + self._open_seconds
+
+            if (self.state == OPEN and now >= self._open_until) or stale_probe:
+                logger.info('Probing backend %s' % self.name)
+                self._open_until = now
+                self.state = HALF_OPEN
+                return True
+
+            return self.state == CLOSED
+
+    def record(self, ok, latency, now=None):
+        now = now or time.time()
+
+        with self._lock:
+            if ok:
+                self.latency = latency if self.latency is None else \
+                    self._alpha * latency + (1 - self._alpha) * self.latency
+
+            if self.state == HALF_OPEN:
+                if ok:
+                    logger.info('Backend %s recovered, closing circuit' % self.name)
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open(now)
+                return
+
+            self._outcomes.append((now, ok))
+            self._prune(now)
+
+            failures = len([outcome for _, outcome in self._outcomes if not outcome])
+            if self.state == CLOSED and len(self._outcomes) >= self._min_requests and \
+                    failures >= self._failure_threshold * len(self._outcomes):
+                self._open(now)
+
+    def _open(self, now):
+        logger.warning('Backend %s is failing, opening circuit for %s seconds' % (self.name, self._open_seconds))
+        self.state = OPEN
+        self._open_until = now + self._open_seconds
+        self._outcomes.clear()
+
+
+class RouterBackend(object):
+
+    def __init__(self, routes, circuits=None):
+        """
+        Sends each email using the healthiest and fastest of several backends, failing over to the next backend if
+        a send fails temporarily.
+
+        :param routes: list of (name, backend)
+        :param circuits: dict of name -> CircuitBreaker, shared between routers of concurrent senders (optional)
+        """
+
+        if not routes:
+            raise RuntimeError('The router backend needs at least one backend to route to')
+
+        self.routes = routes
+        self.circuits = circuits if circuits is not None else {}
+
+        for name, _ in routes:
+            self.circuits.setdefault(name, CircuitBreaker(name))
+
+    def _candidates(self):
+        now = time.time()
+
+        # A probe goes first, such that a recovered backend takes load again within open_seconds
+        probes = []
+        closed = []
+
+        for name, backend in self.routes:
+            circuit = self.circuits[name]
+
+            if circuit.state == CLOSED:
+                closed.append((name, backend, circuit))
+            elif not probes and circuit.acquire(now):
+                probes.append((name, backend, circuit))
+
+        closed.sort(key=lambda candidate: candidate[2].score(now))
+        return probes + closed
+
+    @connection_timeout_decorator((WorkerTemporaryError, WorkerRemoteError))
+    def send(self, **kwargs):
+        # Each backend is tried once (without connection_timeout), such that the router fails over instead of the
+        # backend retrying. Retries of the router itself re-evaluate the health of the backends.
+        error = WorkerTemporaryError('No healthy backend available')
+
+        for name, backend, circuit in self._candidates():
+            start = time.time()
+
+            try:
+                backend.send(**kwargs)
+            except WorkerInvalidEmail:
+                circuit.record(True, time.time() - start)  # the backend works, the email does not
+                raise
+            except (WorkerTemporaryError, WorkerRemoteError), ex:
+                circuit.record(False, time.time() - start)
+                logger.warning('Backend %s failed, failing over: %s' % (name, ex))
+                error = ex
+                continue
+            except Exception:
+                circuit.record(False, time.time() - start)
+                raise
+
+            circuit.record(True, time.time() - start)
+            return
+
+        raise error
@@ -1,14 +1,19 @@
 
 import os
 import logging
+import urlparse
 from sendgrid import SendGridClient, SendGridClientError, SendGridServerError, Mail
 
 from exceptions import WorkerTemporaryError, WorkerInvalidEmail, WorkerRemoteError
+from batch import SENT, INVALID, TEMPORARY, group_by_content
 from requeue.requeue import connection_timeout_decorator
 
 logger = logging.getLogger('reworker.SendgridBackend')
 logger.setLevel(logging.DEBUG)
 
+# Maximum number of recipients of a single Sendgrid message (X-SMTPAPI to)
+_MAX_RECIPIENTS = 1000
+
 
 class SendgridBackend(object):
 
@@ -21,7 +26,16 @@ class SendgridBackend(object):
         if sendgrid_password is None:
             raise RuntimeError("SENDGRID_PASSWORD environment variable must be set to your Sendgrid password!")
 
-        self.client = SendGridClient(sendgrid_username, sendgrid_password, raise_errors=True)
+        # SENDGRID_URL overrides the Sendgrid API location, e.g. http://localhost:8025 for a local stand-in
+        options = {}
+
+        url = os.getenv('SENDGRID_URL')
+        if url is not None:
+            url = urlparse.urlsplit(url)
+            options['host'] = '%s://%s' % (url.scheme, url.hostname)
+            options['port'] = url.port or (443 if url.scheme == 'https' else 80)
+
+        self.client = SendGridClient(sendgrid_username, sendgrid_password, raise_errors=True, **options)
 
     @connection_timeout_decorator((WorkerTemporaryError, WorkerRemoteError))
     def send(self, **kwargs):
@@ -37,11 +51,69 @@ class SendgridBackend(object):
         logger.info('Sending email with subject "%s" to %s %s from %s %s' %
                     (subject, unicode(to_name), to_email, unicode(from_name), from_email))
 
-        try:
-            mail = Mail(subject=subject, html=body,
-                        to=[to_email], to_name=[to_name],
-                        from_email=from_email, from_name=from_name)
+        self._send_mail(Mail(subject=subject, html=body,
+                             to=[to_email], to_name=[to_name],
+                             from_email=from_email, from_name=from_name))
 
+    @connection_timeout_decorator((WorkerTemporaryError, WorkerRemoteError))
+    def _send_group(self, emails):
+        """
+        Send emails with the same content and recipient name as a single message, with the recipients in the
+        X-SMTPAPI header such that each recipient receives its own copy, addressed to itself.
+        """
+
+        email = emails[0]
+
+        if len(emails) == 1:
+            return self.send(**email)
+
+        logger.info('Sending email with subject "%s" to %s recipients from %s' %
+                    (email['subject'], len(emails), email['from_email']))
+
+        # The to parameter is required, but ignored by Sendgrid when recipients are given in the X-SMTPAPI header
+        mail = Mail(subject=email['subject'], html=email['body'],
+                    to=[email['from_email']],
+                    from_email=email['from_email'], from_name=email.get('from_name') or '')
+
+        for other in emails:
+            to_name = other.get('to_name')
+            mail.smtpapi.add_to('%s <%s>' % (to_name, other['to_email']) if to_name else other['to_email'])
+
+        self._send_mail(mail)
+
+    def send_batch(self, emails, connection_timeout=None, connection_timeout_interval=5):
+        """
+        Send a batch of emails, using a single Sendgrid call for each group of emails with the same content and
+        recipient name.
+
+        :return: list with the outcome (SENT, INVALID or TEMPORARY) of each email
+        """
+
+        outcomes = [None] * len(emails)
+
+        for group in group_by_content(emails, _MAX_RECIPIENTS):
+            try:
+                self._send_group([emails[i] for i in group], connection_timeout=connection_timeout,
+                                 connection_timeout_interval=connection_timeout_interval)
+                outcome = SENT
+            except WorkerInvalidEmail:
+                if len(group) > 1:
+                    # Find the invalid emails by sending the group one by one
+                    for i in group:
+                        outcomes[i] = self.send_batch([emails[i]], connection_timeout,
+                                                      connection_timeout_interval)[0]
+                    continue
+                outcome = INVALID
+            except (WorkerTemporaryError, WorkerRemoteError):
+                outcome = TEMPORARY
+
+            for i in group:
+                outcomes[i] = outcome
+
+        return outcomes
+
+    def _send_mail(self, mail):
+        try:
             self.client.send(mail)
 
         except SendGridServerError, ex: